@@ -1,9 +1,20 @@
 from django.contrib import admin
 
-from control.models import DASFileGrouping, MessageControl, PdfFile, TicketLink
+from control.models import (
+    CompaniesSync,
+    CompanyMirror,
+    ContactMirror,
+    DASFileGrouping,
+    MessageControl,
+    PdfFile,
+    TicketLink,
+)
 
 # Register your models here.
 admin.site.register(MessageControl)
 admin.site.register(TicketLink)
 admin.site.register(DASFileGrouping)
 admin.site.register(PdfFile)
+admin.site.register(ContactMirror)
+admin.site.register(CompanyMirror)
+admin.site.register(CompaniesSync)
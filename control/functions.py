@@ -1,27 +1,37 @@
+import asyncio
 import os
 import re
-from datetime import datetime
+import time
+import zlib
+from datetime import datetime, timedelta
 
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Q
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from control.models import DASFileGrouping
+from control.models import DASFileGrouping, MessageControl, annotate_visualized
 from webhook.exceptions import ContactNotFound, ObjectNotFound, UserBadRequest
 from webhook.functions.model_obj import create_new_pdf_file
+from webhook.utils import gather, metrics
+from webhook.utils.dependencies import DependencyTask, require
+from webhook.utils.fanout import fan_out
 from webhook.utils.get_objects import (get_all_companies_by_digisac_contact,
                                        get_company_contact_by_cnpj,
                                        get_company_name_by_id,
                                        get_contact_pendencies,
                                        get_das_grouping,
                                        get_digisac_contact_by_id,
-                                       get_message_control)
+                                       warm_contact_pendencies)
 from webhook.utils.logger import Logger
 from webhook.utils.text import Answers, BaseText
 from webhook.utils.text import TransferTicketReasons as Reasons
 from webhook.utils.tools import (DictAsObject, any_digisac_request,
-                                 get_contact_number, get_current_period,
-                                 group_das_to_send)
+                                 async_digisac_request,
+                                 get_async_digisac_client, get_contact_number,
+                                 get_current_period, group_das_to_send)
 
 logger = Logger(__name__)
 ## -----
@@ -85,12 +95,12 @@ def process_input(
             transfer_ticket.apply_async(
                 args=[contact_id], kwargs={"motivo": Reasons.ASK_FOR_ATTENDANT.value}
             )
-            send_message(contact_id, text=Answers.ASK_FOR_ATTENDANT.value)
-            ticket_message = close_ticket.apply_async(args=[contact_id], countdown=30)
+            # O ticket fecha na fila do contato, depois da mensagem entregue
+            send_message(contact_id, text=Answers.ASK_FOR_ATTENDANT.value, close=True)
             # switch_client_needs_help.apply_async(args=[contact_id, False])
             switch_client_needs_help(contact_id, False)
 
-            return f"Troca de canal enviada e {ticket_message}"
+            return "Troca de canal enviada e fechamento do ticket agendado"
 
         elif is_match(sentence, NEGATIVE_RESPONSES, exact_match):
             send_message(contact_id, text=Answers.DONT_NEED_ATTENDANT.value)
@@ -101,8 +111,9 @@ def process_input(
             return "Atendimento inesperado encerrado com sucesso! Cliente não quis atendente"
 
         else:
-            send_message(contact_id, text=Answers.RETRY_ASK_FOR_ATTENDANT.value)
-            ticket_message = close_ticket.apply_async(args=[contact_id], countdown=60)
+            send_message(
+                contact_id, text=Answers.RETRY_ASK_FOR_ATTENDANT.value, close=True
+            )
 
             return (
                 "Dúvida. resposta indefinida: Perguntando novamente se quer atendente"
@@ -181,9 +192,11 @@ def get_control_object(contact_id):
     # contact_number = get_contact_number(contact_id, only_number=True)
     period = get_current_period(dtObject=True)
 
-    control = get_message_control(digisac_id=contact_id, period=period)
-
-    return control
+    # Levanta DependencyNotReady se o ticket.created que cria o controle ainda
+    # não foi processado: as tasks com base=DependencyTask tentam de novo
+    return require(
+        MessageControl, "MessageControl", digisac_id=contact_id, period=period
+    )
 
 
 def get_message_json(contact_id, message, file_b64, subject="Sem Assunto"):
@@ -206,12 +219,213 @@ def get_message_json(contact_id, message, file_b64, subject="Sem Assunto"):
     return body
 
 
-def send_message(contact_id, text="", file=None):
+def send_message(contact_id, text="", file=None, close=False):
+    # Entra na fila do contato (ver send_sequence). Com SEND_QUEUE_PARTITIONS=0
+    # envia na hora, como antes. close fecha o ticket depois da entrega
+    if not settings.SEND_QUEUE_PARTITIONS:
+        response = deliver_message_now(contact_id, text=text, file=file)
+        if close:
+            close_ticket(contact_id)
+        return response
+
+    return send_sequence(contact_id, [{"text": text, "file": file}], close=close)
+
+
+def deliver_message_now(contact_id, text="", file=None):
     body = get_message_json(contact_id, text, file)
 
     return any_digisac_request("/messages", body=body, method="post")
 
 
+async def async_send_message(contact_id, text="", file=None, client=None):
+    body = get_message_json(contact_id, text, file)
+
+    return await async_digisac_request(
+        "/messages", body=body, method="post", client=client
+    )
+
+
+def send_messages(
+    sequences: dict, concurrency=None, grouping_ids=None, pendencies=None
+) -> dict:
+    # sequences: {contact_id: [{"text": ..., "file": ...}, ...]}
+    # Contatos diferentes em paralelo, mensagens do mesmo contato em ordem.
+    # grouping_ids: {contact_id: [DASFileGrouping.id]} marcados como enviados
+    # quando a sequência do contato inteira for entregue
+    # pendencies: contatos que recebem o texto de pendências, marcados no
+    # controle também só depois da entrega
+    grouping_ids = grouping_ids or {}
+    pendencies = set(pendencies or [])
+
+    if settings.SEND_QUEUE_PARTITIONS:
+        for contact_id, messages in sequences.items():
+            send_sequence(
+                contact_id,
+                messages,
+                grouping_ids.get(contact_id),
+                pendencies=contact_id in pendencies,
+            )
+
+        return {
+            contact_id: {
+                "sent": 0,
+                "total": len(messages),
+                "error": None,
+                "queued": True,
+            }
+            for contact_id, messages in sequences.items()
+        }
+
+    async def run():
+        async with get_async_digisac_client() as client:
+
+            async def send(contact_id, message):
+                return await async_send_message(contact_id, client=client, **message)
+
+            return await fan_out(sequences, send, concurrency=concurrency)
+
+    results = asyncio.run(run())
+    delivered = [
+        contact_id for contact_id, result in results.items() if not result["error"]
+    ]
+    mark_groupings_sent(
+        [
+            grouping_id
+            for contact_id in delivered
+            for grouping_id in grouping_ids.get(contact_id, [])
+        ]
+    )
+    mark_control_pendencies(
+        [contact_id for contact_id in delivered if contact_id in pendencies]
+    )
+    return results
+
+
+def mark_groupings_sent(grouping_ids):
+    if grouping_ids:
+        DASFileGrouping.objects.filter(id__in=grouping_ids).update(was_sent=True)
+
+
+def mark_control_pendencies(contact_ids):
+    # Mesmo efeito do update_ticket_control_pendencies, num único UPDATE. Contato
+    # sem controle no período é ignorado em vez de quebrar o envio
+    if contact_ids:
+        MessageControl.objects.filter(
+            digisac_id__in=contact_ids, period=get_current_period(dtObject=True)
+        ).update(pendencies=True)
+
+
+##-- Fila de envio por contato
+def get_send_queue(contact_id) -> str:
+    # Os contatos são distribuídos em SEND_QUEUE_PARTITIONS filas fixas (sends.N),
+    # cada uma consumida por um worker com concurrency 1 (celery.conf). As
+    # mensagens de um contato saem na ordem em que entraram e contatos de filas
+    # diferentes saem em paralelo.
+    partition = zlib.crc32(str(contact_id).encode()) % settings.SEND_QUEUE_PARTITIONS
+    return f"sends.{partition}"
+
+
+def enqueue_close_ticket(contact_id):
+    # Na fila do contato o fechamento só roda depois das mensagens que já
+    # estavam na fila, sem depender de um countdown maior que o envio
+    if not settings.SEND_QUEUE_PARTITIONS:
+        return close_ticket.apply_async(args=[contact_id])
+
+    return close_ticket.apply_async(args=[contact_id], queue=get_send_queue(contact_id))
+
+
+def send_sequence(
+    contact_id, messages, grouping_ids=None, pendencies=False, close=False
+):
+    # Uma task com a sequência inteira (saudação, pdfs, disclaimer)
+    args = [contact_id, messages]
+    kwargs = {
+        "enqueued_at": time.time(),
+        "grouping_ids": grouping_ids,
+        "pendencies": pendencies,
+        "close": close,
+    }
+
+    if not settings.SEND_QUEUE_PARTITIONS:
+        return deliver_messages(*args, **kwargs)
+
+    return deliver_messages.apply_async(
+        args=args, kwargs=kwargs, queue=get_send_queue(contact_id)
+    )
+
+
+@shared_task(name="deliver_messages")
+def deliver_messages(
+    contact_id,
+    messages,
+    enqueued_at=None,
+    grouping_ids=None,
+    pendencies=False,
+    close=False,
+):
+    # Sem acks_late: se o worker cair no meio, reenviar a sequência duplicaria
+    # mensagens que o cliente já recebeu. Se uma mensagem falhar o resto da
+    # sequência não é enviado (nem o ticket fechado).
+    enqueued_at = enqueued_at or time.time()
+    record_send_stage("queue_wait", time.time() - enqueued_at)
+
+    for message in messages:
+        started = time.perf_counter()
+        deliver_message_now(contact_id, **message)
+        record_send_stage("send", time.perf_counter() - started)
+
+    mark_groupings_sent(grouping_ids)
+    if pendencies:
+        mark_control_pendencies([contact_id])
+    if close:
+        close_ticket(contact_id)
+    record_send_stage("total", time.time() - enqueued_at)
+
+    return f"{len(messages)} mensagens entregues para {contact_id}"
+
+
+def send_stage_key(stage, field, period: datetime):
+    return f"sends:{stage}:{field}:{period:%Y%m%d%H}"
+
+
+def record_send_stage(stage, seconds):
+    # Contagem e tempo total por hora no cache compartilhado, para a média
+    # aparecer no /webhook/metrics mesmo medida nos workers
+    now = datetime.now()
+    metrics.incr(f"sends.{stage}.count")
+    metrics.incr_shared(send_stage_key(stage, "count", now))
+    metrics.incr_shared(send_stage_key(stage, "total_ms", now), int(seconds * 1000))
+
+
+def send_stages_report(hours=3):
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    periods = [now - timedelta(hours=hour) for hour in range(hours)]
+    keys = [
+        send_stage_key(stage, field, period)
+        for stage in SEND_STAGES
+        for field in ("count", "total_ms")
+        for period in periods
+    ]
+    found = cache.get_many(keys)
+
+    report = {}
+    for stage in SEND_STAGES:
+        report[stage] = {}
+        for period in periods:
+            count = found.get(send_stage_key(stage, "count", period), 0)
+            total = found.get(send_stage_key(stage, "total_ms", period), 0)
+            if count:
+                report[stage][f"{period:%Y-%m-%d %H:00}"] = {
+                    "count": count,
+                    "avg_ms": round(total / count, 1),
+                }
+    return report
+
+
+SEND_STAGES = ("queue_wait", "send", "total")
+metrics.register_provider("send_stages", send_stages_report)
+
+
 # def send_files(contact_id, pendencie, file):
 #     try:
 #         send_message(contact_id, text=pendencie, file=file)
@@ -227,16 +441,13 @@ def switch_client_needs_help(contact_id, boolean):
 
     control.client_needs_help = boolean
 
-    return control.save()
+    return control.save(update_fields=["client_needs_help"])
 
 
-@shared_task(name="check_response")
+@shared_task(name="check_response", base=DependencyTask)
 def check_client_response(contact_id):
     control = get_control_object(contact_id=contact_id)
 
-    if not control:
-        raise ObjectNotFound("MessageControl not found")
-
     # Se a última mensagem é do sistema, então retorna diretamente
     if control.is_from_me_last_message():
         return f"Aguardando resposta do cliente"
@@ -248,7 +459,7 @@ def check_client_response(contact_id):
     # Caso o status seja 0 (Aguardando Resposta)
     if control.status == 0:
         control.retries += 1
-        control.save()
+        control.save(update_fields=["retries"])
 
     # Caso o status seja 1 (Fechado)
     elif control.status == 1:
@@ -261,7 +472,7 @@ def check_client_response(contact_id):
         ):
             control.client_needs_help = True
 
-        control.save()
+        control.save(update_fields=["client_needs_help"])
 
     return process_input(
         message_text,
@@ -286,15 +497,15 @@ def close_ticket(contact_id):
     return f"Erro na requisição - {response.text}"
 
 
-@shared_task(name="confirm-message")
-def confirm_message(contact_id, closeTicket=True, timeout=30):
+@shared_task(name="confirm-message", base=DependencyTask)
+def confirm_message(contact_id, closeTicket=True):
     control = get_control_object(contact_id=contact_id)
     # Fechar Control:
     control.status = 1
-    control.save()
+    control.save(update_fields=["status"])
     # Fechar Ticket
     if closeTicket:
-        close_ticket.apply_async(args=[contact_id], countdown=timeout)
+        enqueue_close_ticket(contact_id)
 
     return (
         "Mensagem confirmada"
@@ -303,7 +514,7 @@ def confirm_message(contact_id, closeTicket=True, timeout=30):
     )
 
 
-@shared_task(name="transfer-ticket")
+@shared_task(name="transfer-ticket", base=DependencyTask)
 def transfer_ticket(contact_id, motivo=None):
     contact = get_digisac_contact_by_id(contact_id=contact_id)
     contact = DictAsObject(contact)
@@ -318,12 +529,12 @@ def transfer_ticket(contact_id, motivo=None):
     return "Solicitação de atendimento enviada para o grupo WOZ - RELATÓRIOS"
 
 
-# @shared_task(name="update_control_pendencies")
+@shared_task(name="update_control_pendencies", base=DependencyTask)
 def update_ticket_control_pendencies(contact_id, has_pendencies):
     control = get_control_object(contact_id=contact_id)
 
     control.pendencies = has_pendencies
-    control.save()
+    control.save(update_fields=["pendencies"])
 
     return f"Pendencias atualizadas contact_id: {contact_id}"
 
@@ -367,53 +578,107 @@ def process_init_app():
     ...
 
 
-@shared_task(name="process_grouping_das")
-def process_grouping_das(grouping_id, contact, files_to_send):
-    grouping = get_das_grouping(id=grouping_id)
-    # Variável auxiliar para verificar se o disclaimer deve ser enviado
+def build_grouping_messages(grouping, contact, files_to_send) -> tuple:
+    # Sequência de envio do agrupamento: saudação, um pdf por empresa e no fim
+    # o disclaimer ou o texto de pendências. Retorna (mensagens, tem pendências):
+    # o controle só é marcado com pendências depois da entrega
     # O disclaimer será enviado se nenhuma das empresas do grupamento
     # tiver pendencias. Caso contrário, será enviado o texto de pendencias
-    send_disclaimer = True
     pendencies_for_company = []
 
-    # Inicio do processo de envio
-    send_message(contact, text=SAUDACAO_TEXT)
-    # Envia cada pdf para o contato
-    for name, pdf in files_to_send:
-        send_message(contact, file=pdf, text=name)
-
     # TODO Verifica se o cnpj do contato tem pendencias e já envia o texto.
     for company_pdf in grouping.pdfs.all():
         company_pendencies = get_contact_pendencies(company_pdf.cnpj)
         if company_pendencies:
-            # Atualiza o controle das pendencias
-            update_ticket_control_pendencies(contact, True)
-            # Seta false 2x porque não pensei em como otimizar ainda
-            send_disclaimer = False
-            #
             pendencies_for_company.append(
                 rf"*{company_pdf.company_name}*: {', '.join(company_pendencies)}"
             )
-            #
 
-    if send_disclaimer:
-        # Envia a mensagem de disclaimer
-        send_message(contact, text=DISCLAIMER_TEXT)
+    if pendencies_for_company:
+        # Mensagem final com as pendencias de cada empresa
+        final_text = BaseText.get_pendencies_text("\n".join(pendencies_for_company))
     else:
-        # Mensagem final que será enviada
-        pendencies_message = BaseText.get_pendencies_text(
-            "\n".join(pendencies_for_company)
-        )
-        # Envia as pendencias para cada empresa
-        send_message(contact, text=pendencies_message)
+        final_text = DISCLAIMER_TEXT
+
+    messages = (
+        [{"text": SAUDACAO_TEXT}]
+        + [{"text": name, "file": pdf} for name, pdf in files_to_send]
+        + [{"text": final_text}]
+    )
+    return messages, bool(pendencies_for_company)
+
 
-    # Atualiza que o grupamento já foi enviado esse mês
-    grouping.was_sent = True
-    grouping.save()
+def get_grouping_files(grouping):
+    return [
+        (pdf_file_grouping.company_name, pdf_file_grouping.file)
+        for pdf_file_grouping in grouping.pdfs.all()
+    ]
+
+
+@shared_task(name="process_grouping_das", base=DependencyTask)
+def process_grouping_das(grouping_id, contact, files_to_send):
+    grouping = get_das_grouping(id=grouping_id)
+    messages, has_pendencies = build_grouping_messages(grouping, contact, files_to_send)
+
+    # O grupamento é marcado como enviado quando a sequência inteira sair
+    result = send_messages(
+        {contact: messages},
+        grouping_ids={contact: [grouping.id]},
+        pendencies=[contact] if has_pendencies else [],
+    )
+    if result[contact]["error"]:
+        raise result[contact]["error"]
 
     return f"Enviado para {contact}"
 
 
+@shared_task(name="process_grouping_das_batch")
+def process_grouping_das_batch(grouping_ids):
+    # Envia vários agrupamentos ao mesmo tempo (DIGISAC_SEND_CONCURRENCY contatos
+    # em paralelo). Os pdfs são lidos do banco em vez de irem na mensagem do broker.
+    groupings = DASFileGrouping.objects.filter(
+        id__in=grouping_ids, was_sent=False
+    ).prefetch_related("pdfs")
+
+    # Busca de uma vez as pendências de todos os cnpjs do lote
+    warm_contact_pendencies(
+        {pdf.cnpj for grouping in groupings for pdf in grouping.pdfs.all()}
+    )
+
+    sequences = {}
+    groupings_by_contact = {}
+    pendencies = set()
+    skipped = []
+    for grouping in groupings:
+        contact = grouping.contact_id
+        # Um agrupamento com problema fica para o próximo envio sem derrubar o lote
+        try:
+            messages, has_pendencies = build_grouping_messages(
+                grouping, contact, get_grouping_files(grouping)
+            )
+        except Exception as e:
+            logger.error(f"Falha ao montar o agrupamento {grouping.id}: {e}")
+            skipped.append(grouping.id)
+            continue
+
+        # Mais de um agrupamento pendente do mesmo contato vai na mesma sequência
+        sequences.setdefault(contact, []).extend(messages)
+        groupings_by_contact.setdefault(contact, []).append(grouping.id)
+        if has_pendencies:
+            pendencies.add(contact)
+
+    # Os grupamentos são marcados como enviados quando a sequência do contato sair
+    results = send_messages(
+        sequences, grouping_ids=groupings_by_contact, pendencies=pendencies
+    )
+
+    failed = [contact for contact, result in results.items() if result["error"]]
+    return (
+        f"Enviado ou enfileirado para {len(results) - len(failed)} contatos, "
+        f"falhou para {failed}, agrupamentos não montados: {skipped}"
+    )
+
+
 # TODO PENDENCIES IN WOZ
 ##-- Addtional views
 @api_view(["GET"])
@@ -423,17 +688,28 @@ def init_app(request):
         file = request.data.get("pdf")
         #
         cnpj = request.query_params.get("cnpj")
-        company_contact = DictAsObject(get_company_contact_by_cnpj(cnpj=cnpj))
+        # As pendências só dependem do cnpj: já começa enquanto busca o contato
+        pendencies = gather.submit("pendencies", get_contact_pendencies, cnpj)
+        company_contact = DictAsObject(
+            gather.timed("company_contact", get_company_contact_by_cnpj, cnpj=cnpj)
+        )
         digisac_contact = DictAsObject(company_contact.digisac_contact)
-        company_name = DictAsObject(
-            get_company_name_by_id(company_contact.company)
-        ).fantasy_name
-        # AGORA Pego quantas empresas o contato tem atrelado a ele
-        companies_by_contact = get_all_companies_by_digisac_contact(
-            digisac_contact.digisac_id
+        # AGORA Pego o nome da empresa e quantas empresas o contato tem atrelado
+        # a ele, ao mesmo tempo
+        context = gather.gather_upstream_context(
+            {
+                "company_name": lambda: get_company_name_by_id(
+                    company_contact.company
+                ),
+                "companies_by_contact": lambda: get_all_companies_by_digisac_contact(
+                    digisac_contact.digisac_id
+                ),
+                "pendencies": pendencies,
+            }
         )
-        # TODO
-        company_pendencies = get_contact_pendencies(cnpj)
+        company_name = DictAsObject(context["company_name"]).fantasy_name
+        companies_by_contact = context["companies_by_contact"]
+        company_pendencies = context["pendencies"]
 
         if not company_contact:
             raise ObjectNotFound("Company Contact não existe")
@@ -450,9 +726,8 @@ def init_app(request):
 
             return Response({"success": "Contato responsável por mais de uma empresa"})
 
-        ###Ínicio do envio das mensagens que deverá ser assíncrono
-        send_message(digisac_contact.digisac_id, text=SAUDACAO_TEXT)
-        send_message(digisac_contact.digisac_id, file=file)
+        ###Ínicio do envio das mensagens: entra na fila do contato e sai em ordem
+        messages = [{"text": SAUDACAO_TEXT}, {"file": file}]
 
         # CASO TENHA PENDENCIAS ELE ENVIA A MENSAGEM DE PENDENCIAS
         if company_pendencies:
@@ -460,17 +735,21 @@ def init_app(request):
                 ", ".join(company_pendencies)
             )
 
-            send_message(digisac_contact.digisac_id, text=pendencies_message)
-            # Informa ao controle das mensagens que tem pendencias
-            update_ticket_control_pendencies(digisac_contact.digisac_id, True)
-            # update_ticket_control_pendencies.apply_async(
-            #     args=[digisac_contact.digisac_id, True]
-            # )
+            send_sequence(
+                digisac_contact.digisac_id, messages + [{"text": pendencies_message}]
+            )
+            # Informa ao controle das mensagens que tem pendencias. O controle só
+            # existe depois do ticket.created da saudação, a task espera por ele
+            update_ticket_control_pendencies.apply_async(
+                args=[digisac_contact.digisac_id, True]
+            )
             return Response({"success": "message_sent with pendencies"})
         ###
 
         # CASO NÃO TENHA PENDENCIAS ELE ENVIA A DISCLAIMER
-        send_message(digisac_contact.digisac_id, text=DISCLAIMER_TEXT)
+        send_sequence(
+            digisac_contact.digisac_id, messages + [{"text": DISCLAIMER_TEXT}]
+        )
         return Response({"success": "message_sent"})
 
     except (UserBadRequest, ContactNotFound) as e:
@@ -487,15 +766,13 @@ def send_groupinf_of_das(request):
     grouping_list = DASFileGrouping.objects.filter(was_sent=False)
 
     if grouping_list:
-        for grouping in grouping_list:
-            files_to_send = [
-                (pdf_file_grouping.company_name, pdf_file_grouping.file)
-                for pdf_file_grouping in grouping.pdfs.all()
-            ]
-            contact = grouping.contact_id
-            # Enviando os arquivos para o contato
-            process_grouping_das.apply_async(args=[grouping.id, contact, files_to_send])
-            # process_grouping_das(grouping.id, contact, files_to_send)
+        grouping_ids = list(grouping_list.values_list("id", flat=True))
+        batch_size = settings.DAS_CAMPAIGN_BATCH_SIZE
+        # Cada task envia um lote de contatos em paralelo
+        for start in range(0, len(grouping_ids), batch_size):
+            process_grouping_das_batch.apply_async(
+                args=[grouping_ids[start : start + batch_size]]
+            )
 
         return Response(
             {
@@ -521,10 +798,8 @@ def send_message_to_client(request):
 
         if not text:
             raise UserBadRequest("Cadê o texto da mensagem moral?")
-        # Envia
-        send_message(digisac_contact.digisac_id, text=text)
-        # Em seguida fecha o ticket
-        close_ticket.apply_async(args=[digisac_contact.digisac_id], countdown=25)
+        # Envia e em seguida fecha o ticket, na fila do contato
+        send_message(digisac_contact.digisac_id, text=text, close=True)
         #
         return Response(
             {
@@ -539,101 +814,138 @@ def send_message_to_client(request):
 
 @api_view(["GET"])
 def check_visualized(request):
-    from control.models import MessageControl
-
     # Obter todos os MessageControls com status 0
-    message_control_list = MessageControl.objects.filter(status=0)
-
-    # Verifica se já tem 3 checagens e esta, deve chamar a lista de quem não confirmou
-    if any(mc.check_count == 3 for mc in message_control_list):
-        companies_not_confirmed = []
-
-        for mc in message_control_list:
-            # contact = get_digisac_contact_by_id(contact_id=mc.contact_id)
-            # Pega a lista com dicionários das empresas
-            company_contacts = get_all_companies_by_digisac_contact(
-                digisac_id=mc.digisac_id
-            )
-            # converte cada empresa em "objeto" pra poder acessar os atributos
-            company_contacts = [
-                DictAsObject(company_obj) for company_obj in company_contacts
-            ]
-            # Pega os nomes e cnpj das empresas
-            # usando os obj dentro do array anterior
-            companies = []
-            for company_contact_data in company_contacts:
-                company = DictAsObject(company_contact_data.company)
-                contact = DictAsObject(company_contact_data.contact)
-                # Então adiciono ao array contendo os dados do contato
-                # nome e cnpj
-                companies.append(f"{company.fantasy_name}-{company.cnpj_cpf}")
-
-            confirm_message.apply_async(
-                kwargs={
-                    "contact_id": mc.digisac_id,
-                    "closeTicket": True,
-                    "timeout": 30,
-                }
-            )
+    waiting = MessageControl.objects.filter(status=0)
 
-            mc.status = 1
-            mc.save()
+    control_ids = list(waiting.order_by("id").values_list("id", flat=True))
 
-            # Apenas adicione as empresas à lista geral
-            companies_not_confirmed += companies
-
-        # Início da mensagem
-        report_message = "MEI's SEM CONFIRMAÇÃO DE RECEBIMENTO DAS:\n\n"  # Dois espaços em branco após a frase inicial
-        # Junta cada sublista em uma string, adicionando os separadores
-        report_message += ",\n".join(companies_not_confirmed)
+    # Verifica se já tem 3 checagens e esta, deve chamar a lista de quem não confirmou.
+    # Basta um controle com 3 checagens para todos os que aguardam irem para a lista
+    final_check = waiting.filter(check_count__gte=3).exists()
+    status = annotate_visualized(waiting).aggregate(
+        visualized=Count("id", filter=Q(visualized=True)),
+        not_visualized=Count("id", filter=Q(visualized=False)),
+    )
 
-        send_message(WOZ_GROUP_ID, text=report_message)
+    # Cada task processa um pedaço dos controles, em paralelo nos workers
+    chunks = get_chunks(control_ids)
+    for index, chunk in enumerate(chunks, start=1):
+        if final_check:
+            report_not_confirmed.apply_async(args=[chunk, f"{index}/{len(chunks)}"])
+        else:
+            check_visualized_chunk.apply_async(args=[chunk])
 
+    if final_check:
         return Response(
             {
-                "status": f"{len(companies_not_confirmed)} empresas sem confirmação de recebimento enviadas para o grupo WOZ RELATÓRIOS",
-                "report": companies_not_confirmed,
+                "status": f"{len(control_ids)} contatos sem confirmação de recebimento serão enviados para o grupo WOZ RELATÓRIOS",
+                "chunks": len(chunks),
             }
         )
 
-    # Listas para conter os objetos filtrados
-    message_controls_visualized = []
-    message_controls_not_visualized = []
-
-    # Dividir os objetos nas duas listas
-    for mc in message_control_list:
-        # Aumenta o contador de checagem
-        mc.check_count += 1
+    return Response(
+        {
+            "message": f"{len(control_ids)} sem confirmação de recebimento",
+            "status": status,
+            "chunks": len(chunks),
+        }
+    )
 
-        # Se a mensagem enviada foi visualizada, fecha o ticket
-        # e encerra o atendimento do contato
-        if mc.last_message_visualized():
-            message_controls_visualized.append(mc)
-        else:
-            message_controls_not_visualized.append(mc)
-
-    # Agora, message_controls_visualized contém os objetos onde last_message_visualized é True
-    # e message_controls_not_visualized contém os objetos onde last_message_visualized é False
-    for mc in message_controls_visualized:
-        confirm_message.apply_async(
-            kwargs={
-                "contact_id": mc.digisac_id,
-                "closeTicket": True,
-                "timeout": 30,
-            }
-        )
-    for mc in message_controls_not_visualized:
-        send_message(
-            mc.digisac_id,
-            text="Olá, preciso que visualize ou confirme a mensagem para encerrar este envio.",
-        )
 
-    return Response(
+def get_chunks(control_ids) -> list:
+    chunk_size = settings.CHECK_VISUALIZED_CHUNK_SIZE
+    return [
+        control_ids[start : start + chunk_size]
+        for start in range(0, len(control_ids), chunk_size)
+    ]
+
+
+@shared_task(name="check_visualized_chunk")
+def check_visualized_chunk(control_ids):
+    # Só os que continuam aguardando: o pedaço pode ter ficado na fila
+    controls = MessageControl.objects.filter(id__in=control_ids, status=0)
+
+    # Lidos antes do contador, um único SELECT para o pedaço
+    ids = []
+    contacts = {True: [], False: []}
+    for control_id, digisac_id, visualized in annotate_visualized(
+        controls
+    ).values_list("id", "digisac_id", "visualized"):
+        ids.append(control_id)
+        contacts[visualized].append(digisac_id)
+
+    # Aumenta o contador de checagem
+    checked = MessageControl.objects.filter(id__in=ids)
+    checked.update(check_count=F("check_count") + 1)
+
+    # Se a mensagem enviada foi visualizada, fecha o ticket
+    # e encerra o atendimento do contato
+    close_controls(checked.filter(digisac_id__in=contacts[True]))
+    send_messages(
         {
-            "message": f"{len(message_control_list)} sem confirmação de recebimento",
-            "status": {
-                "visualized": len(message_controls_visualized),
-                "not_visualized": len(message_controls_not_visualized),
-            },
+            digisac_id: [
+                {
+                    "text": "Olá, preciso que visualize ou confirme a mensagem para encerrar este envio."
+                }
+            ]
+            for digisac_id in contacts[False]
         }
     )
+
+    return (
+        f"{len(contacts[True])} visualizadas, "
+        f"{len(contacts[False])} não visualizadas"
+    )
+
+
+@shared_task(name="report_not_confirmed")
+def report_not_confirmed(control_ids, part="1/1"):
+    controls = MessageControl.objects.filter(id__in=control_ids, status=0)
+    digisac_ids = list(controls.values_list("digisac_id", flat=True))
+    # Empresas de todos os contatos do pedaço ao mesmo tempo
+    futures = {
+        digisac_id: gather.submit(
+            "companies_by_contact",
+            get_all_companies_by_digisac_contact,
+            digisac_id=digisac_id,
+        )
+        for digisac_id in digisac_ids
+    }
+    # Pega os nomes e cnpj das empresas. Um contato que falhar (ex.:
+    # ContactNotFound) não derruba o relatório do pedaço inteiro
+    companies_not_confirmed = []
+    failed = []
+    for digisac_id, future in futures.items():
+        try:
+            companies = future.result()
+        except Exception as e:
+            logger.error(f"Empresas do contato {digisac_id} não encontradas: {e}")
+            failed.append(digisac_id)
+            continue
+        companies_not_confirmed += [
+            f"{company['company']['fantasy_name']}-{company['company']['cnpj_cpf']}"
+            for company in companies
+        ]
+
+    close_controls(controls)
+
+    # Início da mensagem
+    report_message = f"MEI's SEM CONFIRMAÇÃO DE RECEBIMENTO DAS ({part}):\n\n"
+    # Junta cada sublista em uma string, adicionando os separadores
+    report_message += ",\n".join(companies_not_confirmed)
+    if failed:
+        report_message += (
+            f"\n\nContatos sem empresas encontradas: {', '.join(failed)}"
+        )
+
+    send_message(WOZ_GROUP_ID, text=report_message)
+
+    return f"{len(companies_not_confirmed)} empresas sem confirmação de recebimento"
+
+
+def close_controls(controls):
+    # O mesmo que confirm_message, com um único UPDATE para todos os controles
+    digisac_ids = list(controls.values_list("digisac_id", flat=True))
+    controls.update(status=1)
+    for digisac_id in digisac_ids:
+        enqueue_close_ticket(digisac_id)
@@ -0,0 +1,163 @@
+import uuid
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from control.models import DASFileGrouping, MessageControl
+from messages_api.models import Message, PendingMessage, Ticket
+
+
+def get_hot_queries(sample):
+    # As consultas dos caminhos quentes, com valores que existem na base
+    return {
+        "MessageControl por contato e período": MessageControl.objects.filter(
+            digisac_id=sample["contact_id"], period=sample["period"]
+        ),
+        "MessageControl aguardando resposta": MessageControl.objects.filter(status=0),
+        "Message por ticket e status": Message.objects.filter(
+            ticket_id=sample["ticket_id"], status=3
+        ),
+        "Message por id": Message.objects.filter(message_id=sample["message_id"]),
+        "Ticket por contato": Ticket.objects.filter(contact_id=sample["contact_id"]),
+        "DASFileGrouping por contato e período": DASFileGrouping.objects.filter(
+            contact_id=sample["contact_id"], period=sample["period"]
+        ),
+        "DASFileGrouping não enviados": DASFileGrouping.objects.filter(was_sent=False),
+        "PendingMessage por ticket": PendingMessage.objects.filter(
+            ticket_id=sample["ticket_id"]
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Roda EXPLAIN nas consultas quentes e falha se alguma fizer Seq Scan. "
+        "Com --seed popula uma base de tamanho realista dentro de uma transação "
+        "desfeita no final"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Quantidade de contatos para popular antes do EXPLAIN (0 usa a base atual)",
+        )
+        parser.add_argument("--periods", type=int, default=12)
+        parser.add_argument(
+            "--no-seqscan",
+            action="store_true",
+            help=(
+                "Desliga o Seq Scan no planejador (SET LOCAL enable_seqscan = off): "
+                "só falha se a consulta não tiver índice utilizável. Para bases "
+                "pequenas, onde o Seq Scan pode ser mesmo o mais barato"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Os planos só são verificados no PostgreSQL")
+
+        with transaction.atomic():
+            if options["seed"]:
+                self.seed(options["seed"], options["periods"])
+            if options["no_seqscan"]:
+                with connection.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+            failures = self.check_plans()
+            # Nada do que foi populado fica na base
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError(f"Seq Scan em: {', '.join(failures)}")
+        self.stdout.write(self.style.SUCCESS("Nenhuma consulta quente com Seq Scan"))
+
+    def check_plans(self):
+        sample = self.get_sample()
+        failures = []
+
+        for name, queryset in get_hot_queries(sample).items():
+            plan = queryset.explain()
+            seq_scan = "Seq Scan" in plan
+            if seq_scan:
+                failures.append(name)
+
+            status = self.style.ERROR("SEQ SCAN") if seq_scan else "ok"
+            self.stdout.write(f"{status:>8} {name}")
+            self.stdout.write("         " + plan.replace("\n", "\n         "))
+
+        return failures
+
+    def get_sample(self):
+        control = MessageControl.objects.order_by("?").first()
+        message = Message.objects.order_by("?").first()
+        return {
+            "contact_id": control.digisac_id if control else "",
+            "period": control.period if control else date.today(),
+            "ticket_id": message.ticket_id if message else "",
+            "message_id": message.message_id if message else "",
+        }
+
+    def seed(self, contacts, periods):
+        # Cada contato tem um ticket, um controle e um agrupamento por período,
+        # com algumas mensagens por ticket. Só os períodos recentes estão
+        # aguardando resposta ou sem envio, como em produção
+        today = date.today().replace(day=1)
+        tickets, controls, groupings, messages = [], [], [], []
+
+        for index in range(contacts):
+            contact_id = str(uuid.uuid4())
+            for month in range(periods):
+                period = (today - timedelta(days=31 * month)).replace(day=1)
+                ticket = Ticket(
+                    ticket_id=str(uuid.uuid4()),
+                    period=period,
+                    contact_id=contact_id,
+                    is_open=month == 0,
+                )
+                tickets.append(ticket)
+                controls.append(
+                    MessageControl(
+                        ticket=ticket,
+                        contact_number=f"5588{index:09d}",
+                        digisac_id=contact_id,
+                        period=period,
+                        status=0 if month == 0 else 1,
+                    )
+                )
+                groupings.append(
+                    DASFileGrouping(
+                        contact_id=contact_id, period=period, was_sent=month != 0
+                    )
+                )
+                messages += [
+                    Message(
+                        message_id=str(uuid.uuid4()),
+                        contact_id=contact_id,
+                        contact_number=f"5588{index:09d}",
+                        period=period,
+                        status=3 if number % 2 else 1,
+                        ticket=ticket,
+                        message_type="chat",
+                        is_from_me=number % 2 == 0,
+                        text="ok",
+                    )
+                    for number in range(4)
+                ]
+
+        for model, objects in (
+            (Ticket, tickets),
+            (MessageControl, controls),
+            (DASFileGrouping, groupings),
+            (Message, messages),
+        ):
+            model.objects.bulk_create(objects, batch_size=5000)
+
+        with connection.cursor() as cursor:
+            for model in (Ticket, MessageControl, DASFileGrouping, Message):
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+        self.stdout.write(
+            f"Base populada: {len(tickets)} tickets, {len(messages)} mensagens"
+        )
@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook.utils import companies_mirror
+
+
+class Command(BaseCommand):
+    help = "Sincroniza a cópia local dos contatos e empresas da companies api"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Traz tudo e apaga o que não existe mais (padrão: incremental)",
+        )
+        parser.add_argument(
+            "--loop",
+            type=int,
+            default=0,
+            help="Intervalo em segundos para rodar continuamente (0 roda uma vez)",
+        )
+
+    def handle(self, *args, **options):
+        # Sem a URL o modo contínuo só repetiria o mesmo erro
+        if not settings.COMPANIES_SYNC_URL:
+            raise CommandError("COMPANIES_SYNC_URL não configurada")
+
+        while True:
+            full = options["full"] or companies_mirror.needs_full_sync()
+            try:
+                run = companies_mirror.sync(full=full)
+                self.stdout.write(
+                    f"Sincronização {'completa' if run.full else 'incremental'}: "
+                    f"{run.updated} atualizadas, {run.deleted} apagadas"
+                )
+            except Exception as e:
+                if not options["loop"]:
+                    raise
+                # No modo contínuo tenta de novo no próximo intervalo
+                self.stderr.write(f"Falha na sincronização: {e}")
+
+            if not options["loop"]:
+                break
+            options["full"] = False
+            time.sleep(options["loop"])
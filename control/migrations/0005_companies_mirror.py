@@ -0,0 +1,78 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("control", "0004_rename_pdf_pdffile_file"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompaniesSync",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("full", models.BooleanField(default=False)),
+                ("started_at", models.DateTimeField()),
+                ("finished_at", models.DateTimeField(null=True)),
+                ("updated", models.IntegerField(default=0)),
+                ("deleted", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="ContactMirror",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("digisac_id", models.CharField(max_length=255, unique=True)),
+                ("data", models.JSONField()),
+                ("synced_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="CompanyMirror",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("company_id", models.CharField(max_length=255, unique=True)),
+                ("cnpj", models.CharField(db_index=True, max_length=32)),
+                ("data", models.JSONField()),
+                ("synced_at", models.DateTimeField(auto_now=True)),
+                (
+                    "contact",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="companies",
+                        to="control.contactmirror",
+                        to_field="digisac_id",
+                    ),
+                ),
+            ],
+        ),
+    ]
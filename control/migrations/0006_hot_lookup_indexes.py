@@ -0,0 +1,66 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:43
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def check_duplicates(apps, schema_editor):
+    # As constraints únicas falham se já houver duplicados. Não apaga nada
+    # sozinho: lista o que precisa ser resolvido antes de rodar de novo
+    duplicates = []
+    for model_name, fields in (
+        ("DASFileGrouping", ("contact_id", "period")),
+        ("MessageControl", ("digisac_id", "period")),
+    ):
+        model = apps.get_model("control", model_name)
+        found = (
+            model.objects.values(*fields)
+            .annotate(total=Count("id"))
+            .filter(total__gt=1)
+        )
+        duplicates += [f"{model_name} {dict(row)}" for row in found[:20]]
+
+    if duplicates:
+        raise RuntimeError(
+            "Registros duplicados impedem as constraints únicas:\n"
+            + "\n".join(duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("control", "0005_companies_mirror"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="dasfilegrouping",
+            index=models.Index(
+                condition=models.Q(("was_sent", False)),
+                fields=["period"],
+                name="grouping_unsent_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="messagecontrol",
+            index=models.Index(
+                condition=models.Q(("status", 0)),
+                fields=["period"],
+                name="control_waiting_idx",
+            ),
+        ),
+        migrations.RunPython(check_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="dasfilegrouping",
+            constraint=models.UniqueConstraint(
+                fields=("contact_id", "period"), name="grouping_contact_period_uniq"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="messagecontrol",
+            constraint=models.UniqueConstraint(
+                fields=("digisac_id", "period"), name="control_contact_period_uniq"
+            ),
+        ),
+    ]
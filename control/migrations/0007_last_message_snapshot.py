@@ -0,0 +1,38 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("control", "0006_hot_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagecontrol",
+            name="last_message_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="messagecontrol",
+            name="last_message_id",
+            field=models.CharField(db_index=True, max_length=500, null=True),
+        ),
+        migrations.AddField(
+            model_name="messagecontrol",
+            name="last_message_is_from_me",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name="messagecontrol",
+            name="last_message_status",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="messagecontrol",
+            name="last_message_text",
+            field=models.CharField(max_length=500, null=True),
+        ),
+    ]
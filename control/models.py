@@ -1,10 +1,134 @@
+from datetime import datetime as dt
+
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest
 
 from messages_api.models import Message, Ticket
 
 # Create your models here.
 
+SNAPSHOT_FIELDS = (
+    "last_message_id",
+    "last_message_status",
+    "last_message_is_from_me",
+    "last_message_text",
+    "last_message_at",
+)
+
+
+def has_message(last_message_id) -> bool:
+    return bool(last_message_id) and last_message_id != "FIRST_MESSAGE"
+
+
+def get_message_values(message_id) -> tuple:
+    # Subqueries na Message (status, is_from_me, text): o UPDATE lê a mensagem
+    # no mesmo comando em que grava o controle. Sem mensagem conta como enviada
+    # por nós e ainda não visualizada, como as consultas antigas
+    message = Message.objects.filter(message_id=message_id)
+    return (
+        Coalesce(models.Subquery(message.values("status")[:1]), 0),
+        Coalesce(models.Subquery(message.values("is_from_me")[:1]), True),
+        models.Subquery(message.values("text")[:1]),
+    )
+
+
+def get_last_message_snapshot(last_message_id) -> dict:
+    # Expressões para o UPDATE dos controles que passam a ter last_message_id
+    # como última mensagem
+    if not has_message(last_message_id):
+        return {
+            "last_message_id": last_message_id,
+            "last_message_status": 0,
+            "last_message_is_from_me": True,
+            "last_message_text": None,
+            "last_message_at": dt.now(),
+        }
+
+    status, is_from_me, text = get_message_values(last_message_id)
+    return {
+        "last_message_id": last_message_id,
+        # Mesma mensagem: o ack já copiado para o controle não volta
+        "last_message_status": models.Case(
+            models.When(
+                last_message_id=last_message_id,
+                then=Greatest("last_message_status", status),
+            ),
+            default=status,
+            output_field=models.IntegerField(),
+        ),
+        "last_message_is_from_me": is_from_me,
+        "last_message_text": text,
+        "last_message_at": dt.now(),
+    }
+
+
+def update_last_message(controls, last_message_id) -> int:
+    # Trava a mensagem antes do UPDATE. Um ack simultâneo (handle_message_updated)
+    # ou já gravou e o UPDATE lê o status novo, ou espera o UPDATE terminar e
+    # encontra o controle já apontando para a mensagem
+    with transaction.atomic():
+        if has_message(last_message_id):
+            list(
+                Message.objects.select_for_update(no_key=True)
+                .filter(message_id=last_message_id)
+                .values_list("pk", flat=True)
+            )
+        return controls.update(**get_last_message_snapshot(last_message_id))
+
+
+def refresh_message_snapshots(message_ids) -> int:
+    # Mensagens gravadas depois do lastMessageId que aponta para elas (ex.:
+    # ticket.updated antes do message.created): os controles que já têm o id
+    # recebem os dados da mensagem
+    if not message_ids:
+        return 0
+
+    status, is_from_me, text = get_message_values(models.OuterRef("last_message_id"))
+    return MessageControl.objects.filter(last_message_id__in=message_ids).update(
+        last_message_status=Greatest("last_message_status", status),
+        last_message_is_from_me=is_from_me,
+        last_message_text=text,
+        last_message_at=dt.now(),
+    )
+
+
+def annotate_visualized(queryset):
+    # visualized=True quando a última mensagem do ticket atual tem ack 3, numa
+    # única consulta. Controles anteriores à cópia (last_message_at vazio)
+    # olham a mensagem direto numa subquery, como refresh_last_message faria
+    current_message = Message.objects.filter(
+        message_id=models.OuterRef("current_last_message_id"), status=3
+    )
+    return queryset.annotate(
+        current_last_message_id=Coalesce(
+            "ticketlink__last_ticket__last_message_id", "ticket__last_message_id"
+        ),
+        visualized=models.Case(
+            models.When(
+                last_message_at__isnull=False, last_message_status=3, then=True
+            ),
+            models.When(
+                models.Q(last_message_at__isnull=True) & models.Exists(current_message),
+                then=True,
+            ),
+            default=False,
+            output_field=models.BooleanField(),
+        ),
+    )
+
+
+def refresh_last_message_snapshot(ticket_id, last_message_id):
+    # Atualiza, num único UPDATE, os controles cujo ticket atual é ticket_id
+    # (o last_ticket do TicketLink ou, sem ele, o ticket do controle)
+    return update_last_message(
+        MessageControl.objects.filter(
+            models.Q(ticketlink__last_ticket_id=ticket_id)
+            | models.Q(ticket_id=ticket_id, ticketlink__last_ticket__isnull=True)
+        ),
+        last_message_id,
+    )
+
 
 class MessageControl(models.Model):
     ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name="ticket")
@@ -18,6 +142,12 @@ class MessageControl(models.Model):
     client_needs_help = models.BooleanField(default=False)
     retries = models.IntegerField(default=1)
     check_count = models.IntegerField(default=0)
+    # Cópia da última mensagem do ticket atual (ver get_last_message_snapshot)
+    last_message_id = models.CharField(max_length=500, null=True, db_index=True)
+    last_message_status = models.IntegerField(default=0)
+    last_message_is_from_me = models.BooleanField(default=True)
+    last_message_text = models.CharField(max_length=500, null=True)
+    last_message_at = models.DateTimeField(null=True)
 
     def get_all_ticket_ids(self):
         lista = []
@@ -25,68 +155,41 @@ class MessageControl(models.Model):
         lista.extend(self.get_ticket_link().additional_tickets)
         return lista
 
-    def last_message_visualized(self):
+    ##-- Última mensagem: cópia na própria linha, mantida por
+    ##-- refresh_last_message_snapshot e pelo ack em handle_message_updated
+    def get_current_ticket(self):
         ticket_link = self.get_ticket_link()
-        if (
-            ticket_link
-            and ticket_link.last_ticket
-            and ticket_link.last_ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(
-                message_id=ticket_link.last_ticket.last_message_id
-            )
-            return True if last_message.status == 3 else False
-        elif (
-            self.ticket.last_message_id
-            and self.ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(message_id=self.ticket.last_message_id)
-            return True if last_message.status == 3 else False
-        else:
-            return False
+        if ticket_link and ticket_link.last_ticket:
+            return ticket_link.last_ticket
+        return self.ticket
+
+    def refresh_last_message(self, only_missing=False):
+        controls = MessageControl.objects.filter(pk=self.pk)
+        if only_missing:
+            # Não sobrescreve a cópia gravada por outro processo nesse meio tempo
+            controls = controls.filter(last_message_at__isnull=True)
+        update_last_message(controls, self.get_current_ticket().last_message_id)
+        self.refresh_from_db(fields=SNAPSHOT_FIELDS)
+
+    def ensure_last_message(self):
+        # Controles anteriores à cópia são preenchidos na primeira leitura
+        if self.last_message_at is None:
+            self.refresh_last_message(only_missing=True)
+
+    def last_message_visualized(self):
+        self.ensure_last_message()
+        return self.last_message_status == 3
 
     def is_from_me_last_message(self):
-        ticket_link = self.get_ticket_link()
-        if (
-            ticket_link
-            and ticket_link.last_ticket
-            and ticket_link.last_ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(
-                message_id=ticket_link.last_ticket.last_message_id
-            )
-            return last_message.is_from_me
-        elif (
-            self.ticket.last_message_id
-            and self.ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(message_id=self.ticket.last_message_id)
-            return last_message.is_from_me
-        else:
-            return True
+        self.ensure_last_message()
+        return self.last_message_is_from_me
 
     def get_last_message_text(self):
-        ticket_link = self.get_ticket_link()
-        if (
-            ticket_link
-            and ticket_link.last_ticket
-            and ticket_link.last_ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(
-                message_id=ticket_link.last_ticket.last_message_id
-            )
-            return last_message.text
-        elif (
-            self.ticket.last_message_id
-            and self.ticket.last_message_id != "FIRST_MESSAGE"
-        ):
-            last_message = Message.objects.get(message_id=self.ticket.last_message_id)
-            return last_message.text
-        else:
-            return None
+        self.ensure_last_message()
+        return self.last_message_text
 
     def get_protocol_number(self):
-        from webhook.utils.tools import any_digisac_request
+        from webhook.utils.digisac_cache import fetch_ticket
 
         ticket_link = self.get_ticket_link()
 
@@ -95,12 +198,10 @@ class MessageControl(models.Model):
         else:
             ticket_id = self.ticket.ticket_id
 
-        response = any_digisac_request(
-            f"/tickets/{ticket_id}", method="get", json=False
-        )
+        ticket = fetch_ticket(ticket_id)
 
-        if response.status_code == 200:
-            return response.json()["protocol"]
+        if ticket:
+            return ticket["protocol"]
         else:
             return None
 
@@ -118,6 +219,22 @@ class MessageControl(models.Model):
     def __str__(self) -> str:
         return f"{self.contact_number} - {self.period}"
 
+    class Meta:
+        constraints = [
+            # Um controle por contato e período (get_message_control)
+            models.UniqueConstraint(
+                fields=["digisac_id", "period"], name="control_contact_period_uniq"
+            )
+        ]
+        indexes = [
+            # check_visualized: só os que aguardam resposta
+            models.Index(
+                fields=["period"],
+                name="control_waiting_idx",
+                condition=models.Q(status=0),
+            )
+        ]
+
 
 class TicketLink(models.Model):
     message_control = models.OneToOneField(MessageControl, on_delete=models.CASCADE)
@@ -133,6 +250,8 @@ class TicketLink(models.Model):
             self.additional_tickets.add(new_ticket)
             self.last_ticket = new_ticket
             self.save()
+            # O ticket atual do controle mudou
+            self.message_control.refresh_last_message()
 
 
 class DASFileGrouping(models.Model):
@@ -150,6 +269,22 @@ class DASFileGrouping(models.Model):
             self.companies.append(cnpj)
             self.save()
 
+    class Meta:
+        constraints = [
+            # group_das_to_send faz get_or_create por contato e período
+            models.UniqueConstraint(
+                fields=["contact_id", "period"], name="grouping_contact_period_uniq"
+            )
+        ]
+        indexes = [
+            # send_groupinf_of_das: só os que ainda não foram enviados
+            models.Index(
+                fields=["period"],
+                name="grouping_unsent_idx",
+                condition=models.Q(was_sent=False),
+            )
+        ]
+
 
 class PdfFile(models.Model):
     cnpj = models.CharField(max_length=255, primary_key=False)
@@ -165,3 +300,43 @@ class PdfFile(models.Model):
     class Meta:
         verbose_name_plural = "PDFs"
         unique_together = ("cnpj", "grouping")
+
+
+##-- Cópia local da companies api (webhook/utils/companies_mirror.py)
+class ContactMirror(models.Model):
+    digisac_id = models.CharField(max_length=255, unique=True)
+    data = models.JSONField()
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"Contato {self.digisac_id}"
+
+
+class CompanyMirror(models.Model):
+    company_id = models.CharField(max_length=255, unique=True)
+    cnpj = models.CharField(max_length=32, db_index=True)
+    contact = models.ForeignKey(
+        ContactMirror,
+        to_field="digisac_id",
+        related_name="companies",
+        on_delete=models.CASCADE,
+        db_constraint=False,
+    )
+    data = models.JSONField()
+    synced_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"Empresa {self.cnpj}"
+
+
+class CompaniesSync(models.Model):
+    # Uma linha por sincronização, a última completa define o ponto de partida
+    # da próxima sincronização incremental
+    full = models.BooleanField(default=False)
+    started_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True)
+    updated = models.IntegerField(default=0)
+    deleted = models.IntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f"Sincronização de {self.started_at}"
@@ -0,0 +1,353 @@
+import uuid
+from datetime import datetime
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from control import functions
+from control.models import (
+    DASFileGrouping,
+    MessageControl,
+    PdfFile,
+    refresh_last_message_snapshot,
+)
+from messages_api.models import Message, PendingMessage, Ticket
+from webhook.exceptions import ContactNotFound
+from webhook.functions import model_obj
+from webhook.utils.tools import get_current_period
+
+
+def make_control(contact_id, **fields):
+    period = get_current_period(dtObject=True)
+    ticket = Ticket.objects.create(
+        ticket_id=str(uuid.uuid4()), period=period, contact_id=contact_id
+    )
+    return MessageControl.objects.create(
+        ticket=ticket,
+        contact_number="5588999999999",
+        digisac_id=contact_id,
+        period=period,
+        **fields,
+    )
+
+
+@override_settings(SEND_QUEUE_PARTITIONS=0)
+@mock.patch.object(functions, "warm_contact_pendencies")
+class DASBatchTests(TestCase):
+    def make_grouping(self, contact_id, cnpj):
+        grouping = DASFileGrouping.objects.create(
+            contact_id=contact_id, period=get_current_period(dtObject=True)
+        )
+        PdfFile.objects.create(cnpj=cnpj, file="pdf", grouping=grouping)
+        return grouping
+
+    def run_batch(self, groupings, pendencies, sent):
+        async def send(contact_id, text="", file=None, client=None):
+            sent.append(contact_id)
+
+        with mock.patch.object(
+            functions, "get_contact_pendencies", side_effect=pendencies
+        ), mock.patch.object(functions, "async_send_message", send):
+            return functions.process_grouping_das_batch.run(
+                [grouping.id for grouping in groupings]
+            )
+
+    def test_pendencies_without_control_do_not_abort_batch(self, warm):
+        # O contato com pendências não tem MessageControl no período
+        groupings = [
+            self.make_grouping("contact-1", "1"),
+            self.make_grouping("contact-2", "2"),
+        ]
+        sent = []
+
+        self.run_batch(groupings, lambda cnpj: ["Janeiro/2024"], sent)
+
+        self.assertEqual(sorted(set(sent)), ["contact-1", "contact-2"])
+        self.assertFalse(DASFileGrouping.objects.filter(was_sent=False).exists())
+
+    def test_broken_grouping_is_skipped_and_pendencies_set_after_send(self, warm):
+        control = make_control("contact-1")
+        groupings = [
+            self.make_grouping("contact-1", "1"),
+            self.make_grouping("contact-2", "2"),
+        ]
+
+        def pendencies(cnpj):
+            if cnpj == "2":
+                raise ValueError("routine runner fora")
+            return ["Janeiro/2024"]
+
+        self.run_batch(groupings, pendencies, [])
+
+        control.refresh_from_db()
+        self.assertTrue(control.pendencies)
+        self.assertEqual(
+            list(DASFileGrouping.objects.filter(was_sent=False)), [groupings[1]]
+        )
+
+
+@override_settings(SEND_QUEUE_PARTITIONS=4)
+class CloseTicketOrderTests(TestCase):
+    def test_close_runs_after_the_last_send(self):
+        calls = []
+        with mock.patch.object(
+            functions,
+            "deliver_message_now",
+            side_effect=lambda contact_id, **message: calls.append(message["text"]),
+        ), mock.patch.object(
+            functions,
+            "close_ticket",
+            side_effect=lambda contact_id: calls.append("close"),
+        ):
+            functions.deliver_messages.run(
+                "contact-1", [{"text": "a"}, {"text": "b"}], close=True
+            )
+
+        self.assertEqual(calls, ["a", "b", "close"])
+
+    @mock.patch.object(functions.transfer_ticket, "apply_async")
+    def test_attendant_request_closes_after_the_message(self, transfer):
+        make_control("contact-1", status=1, client_needs_help=True)
+        with mock.patch.object(functions.deliver_messages, "apply_async") as send:
+            functions.process_input(
+                "sim",
+                "contact-1",
+                retries=0,
+                pendencies=False,
+                exact_match=False,
+                chat_confirmed=True,
+                client_needs_help=True,
+            )
+
+        self.assertTrue(send.call_args.kwargs["kwargs"]["close"])
+        self.assertEqual(
+            send.call_args.kwargs["queue"], functions.get_send_queue("contact-1")
+        )
+
+    @override_settings(SEND_QUEUE_PARTITIONS=0)
+    def test_message_to_client_closes_after_sending(self):
+        calls = []
+        contact = {
+            "digisac_contact": {"digisac_id": "contact-1", "contact_number": "1"}
+        }
+        with mock.patch.object(
+            functions, "get_company_contact_by_cnpj", return_value=contact
+        ), mock.patch.object(
+            functions,
+            "deliver_message_now",
+            side_effect=lambda contact_id, **message: calls.append(message["text"]),
+        ), mock.patch.object(
+            functions,
+            "close_ticket",
+            side_effect=lambda contact_id: calls.append("close"),
+        ):
+            response = functions.send_message_to_client(
+                APIRequestFactory().get("/", {"cnpj": "1", "text": "oi"})
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(calls, ["oi", "close"])
+
+    def test_close_is_queued_on_the_contact_queue(self):
+        make_control("contact-1")
+        with mock.patch.object(functions.close_ticket, "apply_async") as close:
+            functions.confirm_message.run("contact-1")
+
+        self.assertEqual(
+            close.call_args.kwargs,
+            {"args": ["contact-1"], "queue": functions.get_send_queue("contact-1")},
+        )
+
+
+class MissingControlTests(TestCase):
+    def assert_parked(self, task, *args):
+        with mock.patch.object(task, "apply_async") as retry:
+            result = task(*args)
+
+        self.assertIn("Aguardando", result)
+        self.assertEqual(retry.call_args.kwargs["args"], args)
+
+    def test_tasks_wait_for_the_control(self):
+        self.assert_parked(functions.check_client_response, "contact-1")
+        self.assert_parked(functions.confirm_message, "contact-1")
+        self.assert_parked(
+            functions.update_ticket_control_pendencies, "contact-1", True
+        )
+
+    def test_pendencies_are_set_when_the_control_exists(self):
+        control = make_control("contact-1")
+
+        functions.update_ticket_control_pendencies("contact-1", True)
+
+        control.refresh_from_db()
+        self.assertTrue(control.pendencies)
+
+
+@skipUnless(connection.vendor == "postgresql", "EXPLAIN só no PostgreSQL")
+class QueryPlanTests(TestCase):
+    def test_hot_queries_have_a_usable_index(self):
+        # Numa base pequena o Seq Scan pode ser o plano mais barato. Com ele
+        # desligado o planejador só faz Seq Scan se não houver índice que sirva,
+        # e o comando falha com CommandError
+        call_command(
+            "check_query_plans", seed=20, periods=3, no_seqscan=True, stdout=StringIO()
+        )
+
+
+class LastMessageSnapshotTests(TestCase):
+    def setUp(self):
+        self.control = make_control("contact-1")
+        self.ticket = self.control.ticket
+
+    def message_data(self, message_id, **fields):
+        return {
+            "message_id": message_id,
+            "contact_id": "contact-1",
+            "contact_number": "5588999999999",
+            "period": self.ticket.period,
+            "message_type": "chat",
+            "is_from_me": False,
+            "text": "recebi",
+            **fields,
+        }
+
+    def snapshot(self):
+        self.control.refresh_from_db()
+        return (
+            self.control.last_message_id,
+            self.control.last_message_status,
+            self.control.last_message_is_from_me,
+            self.control.last_message_text,
+        )
+
+    def test_message_created_after_ticket_updated(self):
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+        self.assertEqual(self.snapshot(), ("m1", 0, True, None))
+
+        model_obj.create_new_message(
+            ticket=self.ticket.ticket_id, status=3, **self.message_data("m1")
+        )
+
+        self.assertEqual(self.snapshot(), ("m1", 3, False, "recebi"))
+
+    def test_parked_message_drained_after_ticket_updated(self):
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+        data = self.message_data("m1")
+        data["period"] = str(data["period"])
+        PendingMessage.objects.create(
+            message_id="m1", ticket_id=self.ticket.ticket_id, status=2, payload=data
+        )
+
+        model_obj.drain_pending_messages(self.ticket)
+
+        self.assertEqual(self.snapshot(), ("m1", 2, False, "recebi"))
+
+    def test_refresh_keeps_a_higher_ack_of_the_same_message(self):
+        Message.objects.create(ticket=self.ticket, status=1, **self.message_data("m1"))
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+        MessageControl.objects.filter(pk=self.control.pk).update(last_message_status=3)
+
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+
+        self.assertEqual(self.snapshot()[1], 3)
+
+    def test_new_last_message_replaces_the_status(self):
+        Message.objects.create(ticket=self.ticket, status=3, **self.message_data("m1"))
+        Message.objects.create(ticket=self.ticket, status=1, **self.message_data("m2"))
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m2")
+
+        self.assertEqual(self.snapshot()[:2], ("m2", 1))
+
+    def test_backfill_does_not_overwrite_a_newer_snapshot(self):
+        stale = MessageControl.objects.get(pk=self.control.pk)
+        Message.objects.create(ticket=self.ticket, status=3, **self.message_data("m1"))
+        refresh_last_message_snapshot(self.ticket.ticket_id, "m1")
+
+        # Lido antes da cópia: a leitura não volta para o lastMessageId do ticket
+        self.assertTrue(stale.last_message_visualized())
+        self.assertEqual(self.snapshot()[:2], ("m1", 3))
+
+
+@mock.patch.object(functions.close_ticket, "apply_async")
+class CheckVisualizedTests(TestCase):
+    def make_controls(self, count, prefix="contact", **fields):
+        return [make_control(f"{prefix}-{index}", **fields) for index in range(count)]
+
+    def run_check(self):
+        with mock.patch.object(
+            functions.report_not_confirmed, "apply_async"
+        ) as report, mock.patch.object(
+            functions.check_visualized_chunk, "apply_async"
+        ) as check:
+            functions.check_visualized(APIRequestFactory().get("/"))
+        return report, check
+
+    def test_one_control_with_three_checks_reports_all_waiting(self, close):
+        # Mesma regra de antes dos pedaços: basta um controle com 3 checagens
+        controls = self.make_controls(2, check_count=1)
+        controls += self.make_controls(1, prefix="final", check_count=3)
+
+        report, check = self.run_check()
+
+        self.assertEqual(
+            report.call_args.kwargs["args"],
+            [[control.id for control in controls], "1/1"],
+        )
+        check.assert_not_called()
+
+    def test_controls_below_three_checks_are_checked(self, close):
+        controls = self.make_controls(2, check_count=2)
+
+        report, check = self.run_check()
+
+        report.assert_not_called()
+        self.assertEqual(
+            check.call_args.kwargs["args"], [[control.id for control in controls]]
+        )
+
+    def test_chunk_queries_do_not_grow_with_the_chunk(self, close):
+        for size in (2, 20):
+            # Metade visualizada, metade não
+            controls = self.make_controls(
+                size, prefix=f"size{size}", check_count=2
+            ) + self.make_controls(
+                size,
+                prefix=f"seen{size}",
+                last_message_status=3,
+                last_message_at=datetime.now(),
+            )
+            with mock.patch.object(functions, "send_messages") as send:
+                # select, update do contador, select dos visualizados e update
+                # do status
+                with self.assertNumQueries(4):
+                    functions.check_visualized_chunk.run(
+                        [control.id for control in controls]
+                    )
+
+            self.assertEqual(len(send.call_args.args[0]), size)
+            self.assertEqual(close.call_count, size)
+            close.reset_mock()
+
+    def test_report_skips_contacts_that_fail(self, close):
+        controls = self.make_controls(2, check_count=3)
+
+        def companies(digisac_id):
+            if digisac_id == "contact-1":
+                raise ContactNotFound("contato não existe")
+            return [{"company": {"fantasy_name": "Empresa", "cnpj_cpf": "1"}}]
+
+        with mock.patch.object(
+            functions, "get_all_companies_by_digisac_contact", side_effect=companies
+        ), mock.patch.object(functions, "send_message") as send:
+            functions.report_not_confirmed.run([control.id for control in controls])
+
+        report = send.call_args.kwargs["text"]
+        self.assertIn("Empresa-1", report)
+        self.assertIn("contact-1", report)
+        self.assertFalse(MessageControl.objects.filter(status=0).exists())
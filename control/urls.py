@@ -10,6 +10,7 @@ from control.views import (
     update_control_message,
     send_report_to_group,
     create_pendencies_viewset,
+    invalidate_directory_cache,
 )
 
 urlpatterns = [
@@ -24,4 +25,9 @@ urlpatterns = [
     path(
         "/message/visualized-check", check_visualized, name="check_message_visualized"
     ),
+    path(
+        "/directory/invalidate",
+        invalidate_directory_cache,
+        name="invalidate_directory_cache",
+    ),
 ]
@@ -13,6 +13,7 @@ from control.functions import send_message
 from control.models import MessageControl
 from control.serializer import ControlMessageSerializer
 from messages_api.models import Ticket
+from webhook.utils import directory, pendencies_cache
 from webhook.utils.get_objects import get_digisac_contact_by_id
 from webhook.utils.logger import Logger
 
@@ -188,3 +189,30 @@ def create_pendencies_viewset(request: HttpRequest):
         text = str(e)
         logger.debug(f"{text}")
         return Response({f"error {e}": "Something Wrong", "message": text}, status=409)
+
+
+@api_view(["POST"])
+def invalidate_directory_cache(request: HttpRequest):
+    # Chamado pela companies api quando um contato ou empresa muda e pelo
+    # routine runner quando as pendências de um cnpj mudam
+    digisac_id = request.data.get("digisac_id")
+    company_id = request.data.get("company_id")
+    cnpj = request.data.get("cnpj")
+
+    if not digisac_id and not company_id and not cnpj:
+        return Response(
+            {"error": "You must provide digisac_id, company_id or cnpj on body."},
+            status=400,
+        )
+
+    if digisac_id:
+        directory.invalidate_contact(digisac_id)
+    if company_id:
+        directory.invalidate_company(company_id)
+    if cnpj:
+        # Pendências do período atual do cnpj
+        pendencies_cache.invalidate(cnpj)
+
+    return Response(
+        {"digisac_id": digisac_id, "company_id": company_id, "cnpj": cnpj}, status=200
+    )
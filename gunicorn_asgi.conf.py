@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+# Mesmo bind do gunicorn.conf.py, mas servindo o webhook.asgi com workers uvicorn.
+# Uso: gunicorn webhook.asgi:application --config gunicorn_asgi.conf.py
+# O Digisac deve apontar para /webhook/async para usar o caminho assíncrono.
+bind = "0.0.0.0:" + f"{os.environ.get('PORT', os.environ.get('API_PORT', 8080))}"
+workers = multiprocessing.cpu_count()
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 120
+keepalive = 180
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from messages_api.models import Message, Ticket
+from messages_api.models import EventJournal, Message, PendingMessage, Ticket
 
 
 class MessageAdmin(admin.ModelAdmin):
@@ -16,3 +16,5 @@ class MessageAdmin(admin.ModelAdmin):
 # Register your models here.
 admin.site.register(Message, MessageAdmin)
 admin.site.register(Ticket)
+admin.site.register(EventJournal)
+admin.site.register(PendingMessage)
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from webhook.utils import metrics
+from webhook.utils.cache import MISSING, TTLCache, shared_cache_available
+from webhook.utils.tools import get_message_ack
+
+# Campos de estado que diferenciam uma reentrega de uma mudança real
+STATE_FIELDS = {
+    "message.created": lambda data: [],
+    "message.updated": lambda data: [get_message_ack(data)],
+    "ticket.created": lambda data: [],
+    "ticket.updated": lambda data: [data.get("isOpen"), data.get("lastMessageId")],
+}
+
+local_cache = TTLCache(maxsize=settings.DEDUP_MAX_ENTRIES, ttl=settings.DEDUP_TTL)
+
+
+def dedup_key(event, data):
+    state = STATE_FIELDS.get(event, lambda data: [])(data)
+    return ":".join(["dedup", str(event), str(data.get("id"))] + [str(s) for s in state])
+
+
+def is_duplicate(event, data) -> bool:
+    # Marca o evento como visto e diz se ele já tinha passado por aqui dentro do TTL
+    key = dedup_key(event, data)
+
+    if local_cache.get(key) is not MISSING:
+        metrics.incr("dedup.hit")
+        return True
+
+    local_cache.set(key, True)
+
+    # cache.add só grava se a chave não existir: se falhar, outro processo já viu
+    if settings.DEDUP_SHARED and shared_cache_available():
+        if not cache.add(key, True, timeout=settings.DEDUP_TTL):
+            metrics.incr("dedup.hit")
+            return True
+
+    metrics.incr("dedup.miss")
+    return False
+
+
+def forget(event, data):
+    # Usado quando o processamento falha, para que a reentrega não seja descartada
+    key = dedup_key(event, data)
+    local_cache.delete(key)
+
+    if settings.DEDUP_SHARED and shared_cache_available():
+        cache.delete(key)
+
+
+metrics.register_provider("dedup", local_cache.stats)
@@ -0,0 +1,218 @@
+import enum
+from datetime import datetime as dt
+from datetime import timedelta
+from functools import reduce
+
+from celery import current_app, shared_task
+from django.conf import settings
+from django.core.cache import cache
+
+from webhook.utils import metrics
+from webhook.utils.cache import shared_cache_available
+from webhook.utils.logger import Logger
+from webhook.utils.threads import to_thread
+from webhook.utils.tools import get_message_ack
+
+logger = Logger(__name__)
+
+
+class DispatchPolicy(enum.Enum):
+    inline = "inline"
+    background = "background"
+    coalesce = "coalesce"
+
+
+def get_policy(event) -> DispatchPolicy:
+    policy = settings.EVENT_DISPATCH_POLICIES.get(event, DispatchPolicy.inline.value)
+    return DispatchPolicy(policy)
+
+
+def resolve_policy(event, in_worker=False) -> DispatchPolicy:
+    policy = get_policy(event)
+
+    if policy == DispatchPolicy.coalesce and not shared_cache_available():
+        policy = DispatchPolicy.background
+
+    if policy == DispatchPolicy.background and in_worker:
+        policy = DispatchPolicy.inline
+
+    return policy
+
+
+def coalesce_key(event, entity_id):
+    return f"coalesce:{event}:{entity_id}"
+
+
+def get_window(event):
+    return settings.EVENT_COALESCE_WINDOWS.get(event, settings.EVENT_COALESCE_WINDOW)
+
+
+##-- Como juntar o estado pendente com o evento que chegou. Sem merger, o mais recente vence
+def keep_highest_ack(pending, incoming):
+    # Os acks podem chegar fora de ordem, vale sempre o maior
+    pending_ack = get_message_ack(pending["data"])
+    incoming_ack = get_message_ack(incoming["data"])
+
+    if pending_ack is not None and (incoming_ack is None or pending_ack > incoming_ack):
+        return pending
+    return incoming
+
+
+COALESCE_MERGERS = {
+    "message.updated": keep_highest_ack,
+}
+
+
+##-- Dispatch dos handlers de evento
+def dispatch(event, handler, args, data, in_worker=False):
+    # Cada evento sai por exatamente um caminho. Dentro do worker (ex.: vindo do
+    # journal) o "background" roda direto, o evento já está fora da requisição.
+    policy = resolve_policy(event, in_worker)
+
+    if policy == DispatchPolicy.inline:
+        path = "inline"
+        handler(*args, data=data)
+    elif policy == DispatchPolicy.background:
+        path = "background"
+        handler.apply_async(args=args, kwargs={"data": data})
+    else:
+        path = coalesce(event, handler, args, data)
+
+    metrics.incr(f"dispatch.{path}")
+    metrics.incr(f"dispatch.{event}.{path}")
+    return path
+
+
+async def adispatch(event, handler, args, data, in_worker=False):
+    # Mesmas regras do dispatch. Os handlers e o publish do celery são
+    # bloqueantes, então rodam em thread sem segurar o event loop
+    policy = resolve_policy(event, in_worker)
+
+    if policy == DispatchPolicy.inline:
+        path = "inline"
+        await to_thread(handler)(*args, data=data)
+    elif policy == DispatchPolicy.background:
+        path = "background"
+        await to_thread(handler.apply_async)(args=args, kwargs={"data": data})
+    else:
+        path = await to_thread(coalesce)(event, handler, args, data)
+
+    metrics.incr(f"dispatch.{path}")
+    metrics.incr(f"dispatch.{event}.{path}")
+    return path
+
+
+# Estados guardados por entidade entre dois flushes
+MAX_COALESCED_STATES = 100
+
+
+def get_timeout(event):
+    return int(get_window(event) * 10) + 60
+
+
+def next_sequence(key, timeout) -> int:
+    # incr é atômico no cache compartilhado: cada evento ganha o seu número
+    sequence_key = f"{key}:seq"
+    cache.add(sequence_key, 0, timeout=timeout)
+    try:
+        sequence = cache.incr(sequence_key)
+    except ValueError:
+        # A chave expirou entre o add e o incr
+        cache.add(sequence_key, 1, timeout=timeout)
+        sequence = 1
+    cache.touch(sequence_key, timeout)
+    return sequence
+
+
+def coalesce(event, handler, args, data):
+    # Guarda o estado de cada evento e agenda um único flush por janela. Cada
+    # evento tem a sua chave ({key}:{n}), então dois eventos ao mesmo tempo
+    # não se sobrescrevem: quem junta os estados (COALESCE_MERGERS) é o flush
+    window = get_window(event)
+    key = coalesce_key(event, args[0])
+    timeout = get_timeout(event)
+
+    sequence = next_sequence(key, timeout)
+    cache.set(f"{key}:{sequence}", {"args": args, "data": data}, timeout)
+
+    # O estado é gravado antes do add: se o flush já apagou o agendamento,
+    # este evento agenda outro; se não, o flush lê o estado que está aqui
+    if cache.add(f"{key}:scheduled", True, timeout=timeout):
+        flush_coalesced.apply_async(
+            args=[handler.name, key, args],
+            kwargs={"data": data, "event": event},
+            countdown=window,
+            queue=getattr(handler, "queue", None),
+        )
+        return "coalesce_scheduled"
+
+    count_saved_write(event)
+    return "coalesced"
+
+
+def collect_pending(event, key):
+    # Junta, na ordem de chegada, os estados guardados desde o último flush
+    last = cache.get(f"{key}:seq") or 0
+    state_keys = [
+        f"{key}:{sequence}"
+        for sequence in range(max(1, last - MAX_COALESCED_STATES + 1), last + 1)
+    ]
+    found = cache.get_many(state_keys)
+    states = [found[state_key] for state_key in state_keys if state_key in found]
+    cache.delete_many(list(found))
+
+    merge = COALESCE_MERGERS.get(event) or (lambda pending, incoming: incoming)
+    return reduce(merge, states) if states else None
+
+
+##-- Escritas economizadas pelo coalesce, por hora (no cache compartilhado)
+SAVED_WRITES_RETENTION = 60 * 60 * 48
+
+
+def saved_writes_key(event, period: dt):
+    return f"coalesce:saved:{event}:{period:%Y%m%d%H}"
+
+
+def count_saved_write(event):
+    metrics.incr(f"coalesce.{event}.saved_writes")
+
+    metrics.incr_shared(
+        saved_writes_key(event, dt.now()), timeout=SAVED_WRITES_RETENTION
+    )
+
+
+def saved_writes_report(hours=24):
+    now = dt.now().replace(minute=0, second=0, microsecond=0)
+    events = [
+        event
+        for event, policy in settings.EVENT_DISPATCH_POLICIES.items()
+        if policy == DispatchPolicy.coalesce.value
+    ]
+    keys = {}
+    for event in events:
+        for hour in range(hours):
+            period = now - timedelta(hours=hour)
+            keys[saved_writes_key(event, period)] = (event, f"{period:%Y-%m-%d %H:00}")
+
+    found = cache.get_many(list(keys)) if shared_cache_available() else {}
+
+    report = {event: {} for event in events}
+    for key, count in found.items():
+        event, period = keys[key]
+        report[event][period] = count
+    return report
+
+
+@shared_task(name="flush_coalesced")
+def flush_coalesced(handler_name, key, args, data=..., event=None):
+    # Libera o agendamento antes de ler os estados: o que chegar daqui em diante
+    # agenda um novo flush
+    cache.delete(f"{key}:scheduled")
+    event = event or key.split(":")[1]
+    pending = collect_pending(event, key) or {"args": args, "data": data}
+
+    handler = current_app.tasks[handler_name]
+    return handler(*pending["args"], data=pending["data"])
+
+
+metrics.register_provider("coalesce_saved_writes", saved_writes_report)
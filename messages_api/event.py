@@ -1,20 +1,31 @@
 import os
+from datetime import datetime as dt
+from datetime import timedelta
 
 from celery import shared_task
+from celery.signals import task_failure
+from django.conf import settings
+from django.db import transaction
 from django.db.utils import IntegrityError
 
 from control.functions import check_client_response
+from control.models import MessageControl, refresh_last_message_snapshot
+from messages_api import dedup
+from messages_api.dispatch import adispatch, dispatch, flush_coalesced
+from messages_api.models import Message, PendingMessage
 from messages_api.views import get_valid_ticket
 from webhook.exceptions import DigisacBugException
 from webhook.functions.model_obj import (create_new_message,
                                          create_new_message_control,
-                                         create_new_ticket)
-from webhook.utils.get_objects import (get_message, get_message_control,
-                                       get_ticket)
+                                         create_new_ticket,
+                                         drain_pending_messages)
+from webhook.utils import digisac_cache, metrics
+from webhook.utils.dependencies import DependencyTask
+from webhook.utils.get_objects import get_ticket
 from webhook.utils.logger import Logger
-from webhook.utils.tools import (IGNORED_ID_LISTS, DictAsObject,
-                                 any_digisac_request, get_contact_number,
-                                 get_current_period, get_event_status,
+from webhook.utils.threads import to_thread
+from webhook.utils.tools import (IGNORED_ID_LISTS, get_contact_number,
+                                 get_current_period, get_message_ack,
                                  message_exists_in_digisac,
                                  message_is_already_saved,
                                  update_ticket_last_message)
@@ -34,23 +45,63 @@ CYCLE_API_URL = (
 
 ##-- Handler to events
 # @shared_task(name="handler_task")
-def manage(data):
-    # Handlers de evento normalmente serão síncronos. Porém em casos específicos
-    # alguns serão mandados para background.
-    # Ex: quando um novo ticket é criado, ou uma mensagem é enviada
-    event_handlers = {
-        "message.created": (handle_message_created, ["id", "isFromMe"]),
-        "message.updated": (handle_message_updated, ["id"]),
-        "ticket.created": (handle_ticket_created, ["id", "contactId", "lastMessageId"]),
-        "ticket.updated": (handle_ticket_updated, ["id"]),
-    }
-    # Aqui eu consigo filtrar os eventos que serão mandados para background
-    event_will_apply_async = [
-        handle_message_created,
-        handle_ticket_created,
-        handle_message_updated,
-        handle_ticket_updated,
-    ]
+def manage(data, in_worker=False, check_duplicate=True):
+    # Cada evento é executado uma única vez, pelo caminho definido em
+    # settings.EVENT_DISPATCH_POLICIES (inline, background ou coalesce).
+    # check_duplicate=False é para as novas tentativas do journal: a primeira
+    # já marcou o evento como visto e pode ter morrido antes de terminar
+    event, data, event_handler_func, result = prepare_event(data)
+    if result:
+        return result
+
+    # Reentregas da digisac (mesmo id e mesmo estado) param aqui, antes de qualquer I/O
+    if (
+        settings.DEDUP_ENABLED
+        and check_duplicate
+        and dedup.is_duplicate(event, data)
+    ):
+        return f"Event: {event} duplicated, ignored"
+    # O payload traz o estado novo da mensagem/ticket
+    digisac_cache.observe(event, data)
+
+    args = get_handler_args(event, data)
+    try:
+        path = dispatch(event, event_handler_func, args, data, in_worker=in_worker)
+    except Exception:
+        if settings.DEDUP_ENABLED:
+            dedup.forget(event, data)
+        raise
+
+    return f"Event: {event} handled to the function {event_handler_func.__name__} ({path})"
+
+
+async def amanage(data, in_worker=False):
+    # Mesmo fluxo do manage para o caminho ASGI
+    event, data, event_handler_func, result = prepare_event(data)
+    if result:
+        return result
+
+    if settings.DEDUP_ENABLED and await to_thread(dedup.is_duplicate)(event, data):
+        return f"Event: {event} duplicated, ignored"
+    digisac_cache.observe(event, data)
+
+    args = get_handler_args(event, data)
+    try:
+        path = await adispatch(
+            event, event_handler_func, args, data, in_worker=in_worker
+        )
+    except Exception:
+        if settings.DEDUP_ENABLED:
+            await to_thread(dedup.forget)(event, data)
+        raise
+
+    return f"Event: {event} handled to the function {event_handler_func.__name__} ({path})"
+
+
+def prepare_event(data):
+    # Separa o evento do payload e acha o handler. O último item é a resposta
+    # quando o evento deve ser ignorado
+    event_handlers = get_event_handlers()
     #
     event = data.get("event")
     data = data.get("data")
@@ -59,25 +110,63 @@ def manage(data):
     #
     try:
         if (event == "message.created") and data.get("type") == "ticket":
-            return f"Event: {event} has ticket type, avoiding to prevent message.created error"
+            return event, data, None, f"Event: {event} has ticket type, avoiding to prevent message.created error"
     except AttributeError:
-        return f"Event: {event} has some bug"
+        return event, data, None, f"Event: {event} has some bug"
     #
-    if event_handler_func:
-        args = [data.get(param) for param in params]
+    if not event_handler_func:
+        return event, data, None, f"Event: {event} has no handler"
+
+    return event, data, event_handler_func, None
+
+
+def get_handler_args(event, data):
+    event_handler_func, params = get_event_handlers()[event]
+    return [data.get(param) for param in params]
+
+
+def validate(data):
+    # Retorna o motivo da recusa ou None se o evento é válido
+    if not isinstance(data, dict):
+        return "Evento precisa ser um objeto JSON"
+    if data.get("event") not in get_event_handlers():
+        return f"Evento desconhecido: {data.get('event')}"
+    if not isinstance(data.get("data"), dict) or not data["data"].get("id"):
+        return "Campo data.id é obrigatório"
 
-        if any(
-            [
-                event_async == event_handler_func
-                for event_async in event_will_apply_async
-            ]
-        ):
-            event_handler_func.apply_async(args=args, kwargs={"data": data})
+    return None
 
-        # Setando qualquer outro evento normalmente como sincrono
-        event_handler_func(*args, data=data)
 
-    return f"Event: {event} handled to the function {event_handler_func.__name__}"
+def get_event_handlers():
+    return {
+        "message.created": (handle_message_created, ["id", "isFromMe"]),
+        "message.updated": (handle_message_updated, ["id"]),
+        "ticket.created": (handle_ticket_created, ["id", "contactId", "lastMessageId"]),
+        "ticket.updated": (handle_ticket_updated, ["id"]),
+    }
+
+
+@task_failure.connect
+def forget_failed_event(sender=None, args=None, kwargs=None, **extra):
+    # O manage marca o evento como visto antes de ele ir para a fila. Se o
+    # handler falhar no worker (background ou flush do coalesce), a reentrega
+    # da digisac não pode ser descartada como duplicada
+    if not settings.DEDUP_ENABLED or not kwargs or not isinstance(
+        kwargs.get("data"), dict
+    ):
+        return
+
+    if getattr(sender, "name", None) == flush_coalesced.name:
+        event = kwargs.get("event")
+    else:
+        events = {
+            handler.name: event
+            for event, (handler, _) in get_event_handlers().items()
+        }
+        event = events.get(getattr(sender, "name", None))
+
+    if event:
+        dedup.forget(event, kwargs["data"])
 
 
 ##-- Tasks to handle events
@@ -109,10 +198,9 @@ def handle_message_created(message_id, isFromMe: bool, data=...):
     #
     if not data.get("ticketId"):
         # return f"Ticket with ticket_id {data.get('ticketId')} not found."
-        message_digisac = any_digisac_request(f"/messages/{message_id}", method="get")
-        message_digisac = DictAsObject(message_digisac)
+        message_digisac = digisac_cache.fetch_message(message_id) or {}
         obs += "ticket pego da API digisac"
-        message_data["ticket"] = message_digisac.ticketId
+        message_data["ticket"] = message_digisac.get("ticketId")
     #
     if any(message_data.get("contact_id") == string for string in IGNORED_ID_LISTS):
         return "Ticket ignorado: Grupo de relatórios fiscais"
@@ -133,6 +221,8 @@ def handle_message_created(message_id, isFromMe: bool, data=...):
                 # Depois checa a mensagem recebida no last_message_id do ticket atual
                 check_client_response.apply_async(args=[contact_id])
                 # 
+            else:
+                return f"Mensagem aguardando o ticket {message_data['ticket']}"
     except IntegrityError as e:
         return f"Mensagem criada anteriormente. id:{message_id}"
     except DigisacBugException as e:
@@ -152,38 +242,39 @@ def handle_message_updated(message_id, data=...):
     if not message_id:
         return "Message vazio. diabo é isso?"
 
-    message_exists = message_exists_in_digisac(message_id=message_id)
-    message_saved = message_is_already_saved(message_id)
+    status = get_message_ack(data)
+    if status is None:
+        return f"Evento sem ack para a mensagem com id: {message_id}"
+
+    # Um único UPDATE condicional: só grava se o ack recebido for maior que o salvo.
+    # Os controles que têm esta mensagem como última recebem o mesmo ack
+    with transaction.atomic():
+        updated = Message.objects.filter(
+            message_id=message_id, status__lt=status
+        ).update(status=status)
+        if updated:
+            MessageControl.objects.filter(
+                last_message_id=message_id, last_message_status__lt=status
+            ).update(last_message_status=status)
+    if updated:
+        return "Mensagem atualizada com sucesso"
+
+    # A mensagem ainda pode estar esperando o ticket (PendingMessage)
+    if PendingMessage.objects.filter(message_id=message_id, status__lt=status).update(
+        status=status
+    ):
+        return "Mensagem aguardando o ticket atualizada com sucesso"
+
+    if message_is_already_saved(message_id):
+        return f"Status passado por parâmetro:{status} menor que o atualmente salva na mensagem com id: {message_id}"
 
     # manda pra criação se a mensagem ainda não existir
-    if message_exists and not message_saved:
-        # REMOVE ASYNC DO EVENT HANDLER
+    if message_exists_in_digisac(message_id=message_id):
         args = [message_id, data.get("isFromMe")]
         handle_message_created.apply_async(args=args, kwargs={"data": data})
-        # handle_message_created(*args, data=data)
         return "Mensagem existe e não foi salva antes"
 
-    try:
-        data = data.get("data")
-        message = get_message(message_id=message_id)
-        actual_status = get_event_status("message", message_id=message_id)
-        # O que está acontecendo aqui?? não entendi o isinstance de tupla
-        status = data["ack"][0] if isinstance(data["ack"], tuple) else data.get("ack")
-        if message:
-            if actual_status < status:
-                message.status = status
-                message.save()
-            else:
-                return f"Status passado por parâmetro:{status} menor que o atualmente salva na mensagem com id: {message_id}"
-        else:
-            return f"Message with id {message_id} not found."
-
-    except Exception as e:
-        raise Exception(
-            f"erro: {str(e)} - actual_status:{type(actual_status)} e status = {type(status)}"
-        )
-
-    return "Mensagem atualizada com sucesso"
+    return f"Message with id {message_id} not found."
 
 
 @shared_task(name="create_ticket")
@@ -205,44 +296,115 @@ def handle_ticket_created(ticket_id, contact_id, last_message_id, data=...):
     ticket, ticket_created = create_new_ticket(**ticket_data)
     contact = get_contact_number(contact_id=contact_id)
 
-    message_control = get_message_control(
+    # get_or_create: com dois ticket.created do mesmo contato ao mesmo tempo só
+    # um cria o controle, o outro entra como ticket adicional
+    message_control, control_created = create_new_message_control(
+        ticket=ticket,
+        contact_number=contact,
         digisac_id=contact_id,
         period=get_current_period(dtObject=True),
     )
 
-    if not message_control:
-        message_control = create_new_message_control(
-            ticket=ticket,
-            contact_number=contact,
-            digisac_id=contact_id,
-            period=get_current_period(dtObject=True),
-        )
+    if control_created:
+        result = "ticket e message_control criados com sucesso"
+    elif message_control.ticket_id == ticket.pk:
+        # O mesmo ticket.created entregue de novo
+        result = "ticket já registrado no message_control"
+    else:
+        ticket_link = message_control.get_or_create_ticketlink()
+        ticket_link.append_new_ticket(ticket)
+        result = "ticket adicionado com sucesso"
 
-        return "ticket e message_control criados com sucesso"
+    # Mensagens do cliente que chegaram antes deste ticket
+    drained = drain_pending_messages(ticket)
+    if drained:
+        update_ticket_last_message(ticket_id)
+        check_client_response.apply_async(args=[contact_id])
+        result += f", {len(drained)} mensagens pendentes gravadas"
 
-    ticket_link = message_control.get_or_create_ticketlink()
-    ticket_link.append_new_ticket(ticket)
+    expire_pending_messages()
 
-    return "ticket adicionado com sucesso"
+    return result
 
     # except Exception as e:
     # raise ObjectNotCreated(f"\nFailed to create ticket with id: {ticket_id}\n{e}")
 
 
-@shared_task(name="update_ticket", queue="updates")
+def expire_pending_messages():
+    # Mensagens cujo ticket.created nunca chegou. Antes de descartar, o ticket é
+    # buscado uma vez na digisac: se existe, o handle_ticket_created cria o
+    # ticket e grava as mensagens. O resto é apagado, com log e contagem
+    now = dt.now()
+    expired = now - timedelta(seconds=settings.PENDING_MESSAGE_TTL)
+    ticket_ids = set(
+        PendingMessage.objects.filter(
+            created_at__lt=expired, resolve_attempted_at__isnull=True
+        ).values_list("ticket_id", flat=True)
+    )
+
+    for ticket_id in ticket_ids:
+        # Marca antes de buscar: só um worker tenta cada ticket
+        if not PendingMessage.objects.filter(
+            ticket_id=ticket_id, resolve_attempted_at__isnull=True
+        ).update(resolve_attempted_at=now):
+            continue
+
+        try:
+            digisac_ticket = digisac_cache.fetch_ticket(ticket_id, fresh=True)
+        except Exception as e:
+            logger.error(f"Falha ao buscar o ticket {ticket_id} na digisac: {e}")
+            digisac_ticket = None
+
+        if digisac_ticket and digisac_ticket.get("contactId"):
+            metrics.incr("pending_messages.resolved")
+            handle_ticket_created.apply_async(
+                args=[
+                    ticket_id,
+                    digisac_ticket["contactId"],
+                    digisac_ticket.get("lastMessageId"),
+                ]
+            )
+        else:
+            discard_pending_messages(
+                PendingMessage.objects.filter(ticket_id=ticket_id),
+                f"ticket {ticket_id} não encontrado na digisac",
+            )
+
+    # A criação do ticket foi agendada e mesmo assim não gravou as mensagens
+    discard_pending_messages(
+        PendingMessage.objects.filter(resolve_attempted_at__lt=expired),
+        "ticket não criado depois da busca na digisac",
+    )
+
+
+def discard_pending_messages(pending, reason):
+    discarded, _ = pending.delete()
+    if discarded:
+        metrics.incr("pending_messages.expired", discarded)
+        logger.warning(f"{discarded} mensagens aguardando ticket descartadas: {reason}")
+    return discarded
+
+
+@shared_task(name="update_ticket", queue="updates", base=DependencyTask)
 def handle_ticket_updated(ticket_id, data=...):
-    actual_status = get_event_status("ticket", ticket_id=ticket_id)
     last_message_id = data.get("lastMessageId")
     is_open = data.get("isOpen")
 
-    if actual_status and not is_open:
-        ticket = get_valid_ticket(ticket_id=ticket_id)
+    if is_open:
+        return f"Ticket com id: {ticket_id} continua aberto"
+
+    # Se o ticket.created ainda não chegou a task é reagendada
+    # (DependencyNotReady) em vez de perder o fechamento
+    ticket = get_valid_ticket(ticket_id=ticket_id)
 
+    if ticket and ticket.is_open:
         try:
             if ticket:
                 ticket.is_open = is_open
                 ticket.last_message_id = last_message_id
-                ticket.save()
+                with transaction.atomic():
+                    ticket.save()
+                    refresh_last_message_snapshot(ticket_id, last_message_id)
 
         except Exception as e:
             raise ValueError(str(e))
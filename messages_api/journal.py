@@ -0,0 +1,237 @@
+from collections import defaultdict
+from datetime import datetime as dt
+from datetime import timedelta
+
+from celery import current_app, shared_task
+from django.conf import settings
+from django.db.models import Case, F, Q, Value, When
+
+from messages_api.models import EventJournal
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+from webhook.utils.threads import to_thread
+
+logger = Logger(__name__)
+
+
+##-- Journal de eventos do webhook
+def append(data) -> EventJournal:
+    return EventJournal.objects.create(
+        event=str(data.get("event")), payload=data, enqueued_at=dt.now()
+    )
+
+
+def append_many(items) -> list:
+    # Um único INSERT para o lote inteiro
+    now = dt.now()
+    return EventJournal.objects.bulk_create(
+        [
+            EventJournal(event=str(data.get("event")), payload=data, enqueued_at=now)
+            for data in items
+        ]
+    )
+
+
+def enqueue(entry: EventJournal):
+    # Sem retry na publicação: se o broker estiver fora o evento já está salvo
+    # e o drain publica de novo depois. O webhook não pode ficar esperando.
+    try:
+        process_journal_entry.apply_async(args=[entry.id], retry=False)
+        return True
+    except Exception as e:
+        logger.error(f"Falha ao publicar evento {entry.id} do journal: {e}")
+        EventJournal.objects.filter(id=entry.id).update(enqueued_at=None)
+        return False
+
+
+def enqueue_many(entries):
+    # Agrupa por tipo de evento e publica uma task por grupo, todas pela mesma
+    # conexão com o broker
+    groups = defaultdict(list)
+    for entry in entries:
+        groups[entry.event].append(entry.id)
+
+    try:
+        with current_app.producer_or_acquire() as producer:
+            for event, entry_ids in groups.items():
+                process_journal_batch.apply_async(
+                    args=[entry_ids], producer=producer, retry=False
+                )
+        return True
+    except Exception as e:
+        logger.error(f"Falha ao publicar lote de {len(entries)} eventos: {e}")
+        EventJournal.objects.filter(id__in=[entry.id for entry in entries]).update(
+            enqueued_at=None
+        )
+        return False
+
+
+def ingest(data) -> EventJournal:
+    entry = append(data)
+    enqueue(entry)
+    return entry
+
+
+async def aingest(data) -> EventJournal:
+    # Versão para o caminho ASGI. O ORM assíncrono do django 4.2 e a publicação
+    # do kombu são bloqueantes por baixo, então os dois rodam no pool de threads
+    return await to_thread(ingest)(data)
+
+
+def ingest_many(items) -> list:
+    entries = append_many(items)
+    if entries:
+        enqueue_many(entries)
+    return entries
+
+
+def get_claim_limit():
+    return dt.now() - timedelta(seconds=settings.JOURNAL_CLAIM_TIMEOUT)
+
+
+def not_claimed():
+    # Nenhum worker com o evento, ou o worker que pegou morreu no meio
+    return Q(claimed_at__isnull=True) | Q(claimed_at__lte=get_claim_limit())
+
+
+def get_pending(older_than=None):
+    # Eventos publicados há mais de older_than segundos (ou cuja publicação
+    # falhou) que ninguém terminou nem está processando
+    older_than = settings.JOURNAL_REPLAY_AFTER if older_than is None else older_than
+    limit_date = dt.now() - timedelta(seconds=older_than)
+
+    return EventJournal.objects.filter(
+        Q(enqueued_at__lte=limit_date)
+        | Q(enqueued_at__isnull=True, received_at__lte=limit_date),
+        not_claimed(),
+        processed_at__isnull=True,
+        dead_at__isnull=True,
+        attempts__lt=settings.JOURNAL_MAX_ATTEMPTS,
+    )
+
+
+def pending_entries(older_than=None, limit=500):
+    return get_pending(older_than=older_than).order_by("received_at")[:limit]
+
+
+def dead_letter_exhausted() -> int:
+    # Eventos que esgotaram as tentativas sem ninguém processando (o worker
+    # morreu em todas) vão para o dead letter em vez de voltar para a fila
+    count = EventJournal.objects.filter(
+        not_claimed(),
+        processed_at__isnull=True,
+        dead_at__isnull=True,
+        attempts__gte=settings.JOURNAL_MAX_ATTEMPTS,
+    ).update(dead_at=dt.now())
+
+    if count:
+        metrics.incr("journal.dead_letter", count)
+        logger.error(f"{count} eventos do journal foram para o dead letter")
+    return count
+
+
+def drain(older_than=None, limit=500):
+    # Republica o que o broker nunca entregou (publicação falhou ou a task se
+    # perdeu antes de terminar)
+    dead_letter_exhausted()
+
+    entry_ids = list(
+        pending_entries(older_than=older_than, limit=limit).values_list("id", flat=True)
+    )
+    if not entry_ids:
+        return 0
+
+    # UPDATE condicional: só fica com os eventos que continuam pendentes. Um
+    # worker pode ter pego ou terminado algum entre a consulta e aqui, e outro
+    # drain rodando ao mesmo tempo não republica os mesmos
+    now = dt.now()
+    get_pending(older_than=older_than).filter(id__in=entry_ids).update(enqueued_at=now)
+    entries = list(EventJournal.objects.filter(id__in=entry_ids, enqueued_at=now))
+    if not entries:
+        return 0
+
+    return len(entries) if enqueue_many(entries) else 0
+
+
+def claim(entry: EventJournal) -> bool:
+    # Só um worker processa o evento por vez, mesmo que ele tenha sido
+    # republicado pelo drain enquanto a primeira task ainda estava na fila
+    return bool(
+        EventJournal.objects.filter(
+            not_claimed(),
+            id=entry.id,
+            processed_at__isnull=True,
+            dead_at__isnull=True,
+        ).update(claimed_at=dt.now(), attempts=F("attempts") + 1)
+    )
+
+
+def release(entry: EventJournal, error: Exception):
+    # Libera o evento para o drain. Na última tentativa vai para o dead letter
+    now = dt.now()
+    EventJournal.objects.filter(id=entry.id).update(
+        claimed_at=None,
+        last_error=repr(error)[:2000],
+        dead_at=Case(
+            When(attempts__gte=settings.JOURNAL_MAX_ATTEMPTS, then=Value(now)),
+            default=None,
+        ),
+    )
+    if entry.attempts + 1 >= settings.JOURNAL_MAX_ATTEMPTS:
+        metrics.incr("journal.dead_letter")
+        logger.error(f"Evento {entry.id} do journal foi para o dead letter: {error}")
+
+
+def process_entry(entry: EventJournal):
+    from messages_api import event
+
+    if entry.processed_at:
+        return f"Evento {entry.id} já processado"
+
+    if not claim(entry):
+        return f"Evento {entry.id} já processado ou em processamento"
+
+    try:
+        # Numa nova tentativa o dedup descartaria o evento que a anterior
+        # marcou como visto antes de falhar ou morrer
+        result = event.manage(
+            entry.payload, in_worker=True, check_duplicate=entry.attempts == 0
+        )
+    except Exception as e:
+        release(entry, e)
+        raise
+
+    EventJournal.objects.filter(id=entry.id).update(processed_at=dt.now())
+    return result
+
+
+@shared_task(name="process_journal_entry", acks_late=True)
+def process_journal_entry(entry_id):
+    entry = EventJournal.objects.filter(id=entry_id).first()
+
+    if not entry:
+        return f"Evento {entry_id} não existe no journal"
+
+    return process_entry(entry)
+
+
+@shared_task(name="process_journal_batch", acks_late=True)
+def process_journal_batch(entry_ids):
+    # Um erro num evento não pode impedir o resto do lote. O que falhar continua
+    # sem processed_at e volta pelo drain.
+    entries = EventJournal.objects.filter(id__in=entry_ids).order_by("received_at")
+    processed = 0
+
+    for entry in entries:
+        try:
+            process_entry(entry)
+            processed += 1
+        except Exception as e:
+            logger.error(f"Falha ao processar evento {entry.id} do journal: {e}")
+
+    return f"{processed}/{len(entry_ids)} eventos processados"
+
+
+@shared_task(name="drain_journal")
+def drain_journal(older_than=None, limit=500):
+    return f"{drain(older_than=older_than, limit=limit)} eventos republicados"
@@ -0,0 +1,72 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.core.management.base import BaseCommand
+
+from webhook.utils.metrics import summarize_latencies
+
+
+def sample_event(index):
+    # Evento no formato que a digisac manda, com ids novos a cada requisição
+    event = "message.updated" if index % 2 else "message.created"
+    return {
+        "event": event,
+        "data": {
+            "id": str(uuid.uuid4()),
+            "isFromMe": True,
+            "contactId": str(uuid.uuid4()),
+            "ticketId": str(uuid.uuid4()),
+            "type": "chat",
+            "text": "benchmark",
+            "data": {"ack": 1},
+        },
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Mede a latência de recebimento do /webhook (p50/p99). Rode uma vez com "
+        "WEBHOOK_INGESTION_MODE=inline e outra com journal para comparar"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://localhost:8080/webhook")
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=10)
+        parser.add_argument("--timeout", type=float, default=120)
+
+    def handle(self, *args, **options):
+        url = options["url"]
+        total = options["requests"]
+        latencies = []
+        errors = 0
+
+        with httpx.Client(timeout=options["timeout"]) as client:
+
+            def post(index):
+                start = time.perf_counter()
+                try:
+                    response = client.post(url, json=sample_event(index))
+                    ok = response.status_code == 201
+                except httpx.HTTPError:
+                    ok = False
+                return (time.perf_counter() - start) * 1000, ok
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                for latency, ok in pool.map(post, range(total)):
+                    latencies.append(latency)
+                    errors += 0 if ok else 1
+            elapsed = time.perf_counter() - started
+
+        summary = summarize_latencies(latencies)
+        self.stdout.write(
+            f"{total} requisições em {elapsed:.2f}s ({total / elapsed:.1f} req/s), "
+            f"{errors} erros"
+        )
+        self.stdout.write(
+            f"p50={summary['p50']}ms p95={summary['p95']}ms "
+            f"p99={summary['p99']}ms max={summary['max']}ms"
+        )
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from messages_api import journal
+
+
+class Command(BaseCommand):
+    help = "Republica no celery os eventos do journal que nunca foram processados"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            default=None,
+            help="Segundos desde a publicação (padrão: JOURNAL_REPLAY_AFTER)",
+        )
+        parser.add_argument("--limit", type=int, default=500)
+        parser.add_argument(
+            "--loop",
+            type=int,
+            default=0,
+            help="Intervalo em segundos para rodar continuamente (0 roda uma vez)",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            replayed = journal.drain(
+                older_than=options["older_than"], limit=options["limit"]
+            )
+            self.stdout.write(f"{replayed} eventos republicados")
+
+            if not options["loop"]:
+                break
+            time.sleep(options["loop"])
@@ -0,0 +1,94 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+from webhook.utils.capture import read_capture
+from webhook.utils.metrics import summarize_latencies
+
+
+def parse_speed(value):
+    # "original" (1x), "max" (sem espera) ou um fator, ex.: "10" = 10x mais rápido
+    if value == "original":
+        return 1.0
+    if value == "max":
+        return None
+    try:
+        speed = float(value)
+    except ValueError:
+        raise CommandError("--speed deve ser original, max ou um número")
+    if speed <= 0:
+        raise CommandError("--speed deve ser maior que zero")
+    return speed
+
+
+class Command(BaseCommand):
+    help = (
+        "Reenvia para o /webhook os eventos gravados com WEBHOOK_CAPTURE_FILE, "
+        "na velocidade original, acelerada ou máxima"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="Arquivo JSONL da captura")
+        parser.add_argument("--url", default="http://localhost:8080/webhook")
+        parser.add_argument("--speed", default="original")
+        parser.add_argument("--concurrency", type=int, default=20)
+        parser.add_argument("--limit", type=int, default=0)
+        parser.add_argument("--timeout", type=float, default=120)
+
+    def handle(self, *args, **options):
+        speed = parse_speed(options["speed"])
+        records = list(read_capture(options["file"]))
+        if options["limit"]:
+            records = records[: options["limit"]]
+        if not records:
+            raise CommandError("Nenhum evento na captura")
+
+        latencies = []
+        errors = Counter()
+        first_ts = records[0]["ts"]
+
+        with httpx.Client(timeout=options["timeout"]) as client:
+
+            def post(payload):
+                start = time.perf_counter()
+                try:
+                    response = client.post(options["url"], json=payload)
+                    error = None if response.status_code < 400 else response.status_code
+                except httpx.HTTPError as e:
+                    error = type(e).__name__
+                return (time.perf_counter() - start) * 1000, error
+
+            started = time.perf_counter()
+            futures = []
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                for record in records:
+                    if speed:
+                        # Respeita o intervalo original entre os eventos (dividido pelo fator)
+                        due = (record["ts"] - first_ts) / speed
+                        wait = due - (time.perf_counter() - started)
+                        if wait > 0:
+                            time.sleep(wait)
+                    futures.append(pool.submit(post, record["payload"]))
+
+                for future in futures:
+                    latency, error = future.result()
+                    latencies.append(latency)
+                    if error:
+                        errors[str(error)] += 1
+            elapsed = time.perf_counter() - started
+
+        summary = summarize_latencies(latencies)
+        total = len(records)
+        self.stdout.write(
+            f"{total} eventos em {elapsed:.2f}s ({total / elapsed:.1f} eventos/s), "
+            f"{sum(errors.values())} erros"
+        )
+        self.stdout.write(
+            f"p50={summary['p50']}ms p95={summary['p95']}ms "
+            f"p99={summary['p99']}ms max={summary['max']}ms"
+        )
+        for error, count in errors.most_common():
+            self.stdout.write(f"  {error}: {count}")
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messages_api", "0003_eventjournal"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("message_id", models.CharField(max_length=255, unique=True)),
+                ("ticket_id", models.CharField(db_index=True, max_length=255)),
+                ("status", models.IntegerField(default=0)),
+                ("payload", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
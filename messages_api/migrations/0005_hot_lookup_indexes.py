@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messages_api", "0004_pendingmessage"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["ticket", "status"], name="message_ticket_status_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ticket",
+            index=models.Index(fields=["contact_id"], name="ticket_contact_idx"),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.1 on 2026-10-18 04:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messages_api", "0005_hot_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="eventjournal",
+            name="journal_pending_idx",
+        ),
+        migrations.AddField(
+            model_name="eventjournal",
+            name="claimed_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="eventjournal",
+            name="dead_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="eventjournal",
+            name="last_error",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddIndex(
+            model_name="eventjournal",
+            index=models.Index(
+                condition=models.Q(
+                    ("dead_at__isnull", True), ("processed_at__isnull", True)
+                ),
+                fields=["enqueued_at"],
+                name="journal_pending_idx",
+            ),
+        ),
+    ]
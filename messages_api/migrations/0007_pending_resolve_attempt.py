@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 05:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("messages_api", "0006_journal_claims"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="pendingmessage",
+            name="resolve_attempted_at",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -11,6 +11,9 @@ class Ticket(models.Model):
     def __str__(self):
         return f"{self.ticket_id} - {self.period} - {self.is_open}"
 
+    class Meta:
+        indexes = [models.Index(fields=["contact_id"], name="ticket_contact_idx")]
+
 
 class Message(models.Model):
     message_id = models.CharField(max_length=255, primary_key=True)
@@ -33,3 +36,50 @@ class Message(models.Model):
 
     class Meta:
         unique_together = (("contact_id", "message_id"),)
+        indexes = [
+            models.Index(fields=["ticket", "status"], name="message_ticket_status_idx")
+        ]
+
+
+class PendingMessage(models.Model):
+    # message.created que chegou antes do ticket.created. Fica aqui até o
+    # handle_ticket_created criar o ticket e gravar todas de uma vez
+    message_id = models.CharField(max_length=255, unique=True)
+    ticket_id = models.CharField(max_length=255, db_index=True)
+    status = models.IntegerField(default=0)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Passado o PENDING_MESSAGE_TTL o ticket é buscado uma vez na digisac
+    # (expire_pending_messages) antes de a mensagem ser descartada
+    resolve_attempted_at = models.DateTimeField(null=True)
+
+    def __str__(self) -> str:
+        return f"{self.message_id} aguardando o ticket {self.ticket_id}"
+
+
+class EventJournal(models.Model):
+    # Registro append-only de cada evento recebido no webhook. O evento é gravado
+    # antes de ir para o broker, assim nada se perde se o celery cair no meio do caminho
+    event = models.CharField(max_length=100)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    enqueued_at = models.DateTimeField(null=True)
+    # Preenchido pelo worker que está processando o evento (process_entry)
+    claimed_at = models.DateTimeField(null=True)
+    processed_at = models.DateTimeField(null=True)
+    attempts = models.IntegerField(default=0)
+    # Dead letter: o evento falhou JOURNAL_MAX_ATTEMPTS vezes e não é mais republicado
+    dead_at = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True, default="")
+
+    def __str__(self) -> str:
+        return f"{self.event} - {self.received_at} - {self.processed_at}"
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["enqueued_at"],
+                name="journal_pending_idx",
+                condition=models.Q(processed_at__isnull=True, dead_at__isnull=True),
+            )
+        ]
@@ -0,0 +1,440 @@
+import uuid
+from datetime import date
+from datetime import datetime as dt
+from datetime import timedelta
+from unittest import mock
+
+from celery import current_app
+from celery.signals import task_failure
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from control.models import MessageControl
+from messages_api import dedup, dispatch, event, journal
+from messages_api.event import handle_message_updated
+from messages_api.models import EventJournal, Message, PendingMessage, Ticket
+from webhook.utils import digisac_cache, metrics, tools
+
+EVENTS = ["message.created", "message.updated", "ticket.created", "ticket.updated"]
+
+
+def make_handler(name):
+    # Handler falso com a mesma interface de uma task do celery
+    handler = mock.MagicMock(name=name)
+    handler.name = name
+    handler.__name__ = name
+    handler.queue = None
+    return handler
+
+
+def make_payload(event_name, ack=1, entity_id=None):
+    return {
+        "event": event_name,
+        "data": {
+            "id": entity_id or str(uuid.uuid4()),
+            "isFromMe": True,
+            "contactId": str(uuid.uuid4()),
+            "ticketId": str(uuid.uuid4()),
+            "lastMessageId": str(uuid.uuid4()),
+            "isOpen": False,
+            "type": "chat",
+            "data": {"ack": ack},
+        },
+    }
+
+
+class HandlersMixin:
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.handlers = {name: make_handler(name) for name in EVENTS}
+        patcher = mock.patch.object(
+            event,
+            "get_event_handlers",
+            return_value={
+                "message.created": (self.handlers["message.created"], ["id"]),
+                "message.updated": (self.handlers["message.updated"], ["id"]),
+                "ticket.created": (self.handlers["ticket.created"], ["id"]),
+                "ticket.updated": (self.handlers["ticket.updated"], ["id"]),
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # O coalesce precisa de um cache compartilhado, o locmem serve no teste
+        patcher = mock.patch.object(
+            dispatch, "shared_cache_available", return_value=True
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_coalesced(self):
+        # Executa os flushes agendados como o worker faria
+        flush = dispatch.flush_coalesced.apply_async
+        for call in flush.call_args_list:
+            handler_name, key, args = call.kwargs["args"]
+            with mock.patch.dict(current_app.tasks, self.handlers):
+                dispatch.flush_coalesced.run(
+                    handler_name, key, args, data=call.kwargs["kwargs"]["data"]
+                )
+
+    def times_handled(self, event_name):
+        handler = self.handlers[event_name]
+        return handler.call_count + handler.apply_async.call_count
+
+
+@override_settings(DEDUP_ENABLED=False)
+@mock.patch.object(dispatch.flush_coalesced, "apply_async")
+class DispatchPolicyTests(HandlersMixin, TestCase):
+    def assert_handled_once(self, policy, in_worker=False):
+        with self.settings(EVENT_DISPATCH_POLICIES={e: policy for e in EVENTS}):
+            for event_name in EVENTS:
+                event.manage(make_payload(event_name), in_worker=in_worker)
+            self.run_coalesced()
+
+        for event_name in EVENTS:
+            self.assertEqual(self.times_handled(event_name), 1, event_name)
+
+    def test_inline(self, flush):
+        self.assert_handled_once("inline")
+        self.assertEqual(self.handlers["message.created"].call_count, 1)
+
+    def test_background(self, flush):
+        self.assert_handled_once("background")
+        self.assertEqual(self.handlers["message.created"].apply_async.call_count, 1)
+
+    def test_background_in_worker_runs_inline(self, flush):
+        self.assert_handled_once("background", in_worker=True)
+        self.assertEqual(self.handlers["message.created"].call_count, 1)
+
+    def test_coalesce(self, flush):
+        self.assert_handled_once("coalesce")
+        self.assertEqual(flush.call_count, len(EVENTS))
+
+    def test_coalesce_burst_is_handled_once(self, flush):
+        message_id = str(uuid.uuid4())
+        with self.settings(EVENT_DISPATCH_POLICIES={"message.updated": "coalesce"}):
+            for ack in (1, 2, 3):
+                event.manage(make_payload("message.updated", ack, message_id))
+            self.run_coalesced()
+
+        self.assertEqual(self.times_handled("message.updated"), 1)
+
+    def test_coalesce_flush_applies_highest_ack(self, flush):
+        message_id = str(uuid.uuid4())
+        with self.settings(EVENT_DISPATCH_POLICIES={"message.updated": "coalesce"}):
+            for ack in (1, 3, 2):
+                event.manage(make_payload("message.updated", ack, message_id))
+            self.run_coalesced()
+
+        data = self.handlers["message.updated"].call_args.kwargs["data"]
+        self.assertEqual(data["data"]["ack"], 3)
+
+    def test_event_during_flush_is_not_lost(self, flush):
+        message_id = str(uuid.uuid4())
+        with self.settings(EVENT_DISPATCH_POLICIES={"message.updated": "coalesce"}):
+            event.manage(make_payload("message.updated", 1, message_id))
+            self.run_coalesced()
+            flush.reset_mock()
+            # Chegou depois do flush: agenda outro com o estado novo
+            event.manage(make_payload("message.updated", 3, message_id))
+            self.run_coalesced()
+
+        acks = [
+            call.kwargs["data"]["data"]["ack"]
+            for call in self.handlers["message.updated"].call_args_list
+        ]
+        self.assertEqual(acks, [1, 3])
+
+
+@mock.patch.object(dispatch.flush_coalesced, "apply_async")
+class DuplicateDeliveryTests(HandlersMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        dedup.local_cache.clear()
+
+    @override_settings(DEDUP_ENABLED=True, EVENT_DISPATCH_POLICIES={})
+    def test_redelivery_is_handled_once(self, flush):
+        payload = make_payload("message.created")
+        event.manage(payload)
+        result = event.manage(payload)
+
+        self.assertIn("duplicated", result)
+        self.assertEqual(self.times_handled("message.created"), 1)
+
+    @override_settings(DEDUP_ENABLED=True, EVENT_DISPATCH_POLICIES={})
+    def test_new_state_is_not_a_duplicate(self, flush):
+        message_id = str(uuid.uuid4())
+        event.manage(make_payload("message.updated", 1, message_id))
+        event.manage(make_payload("message.updated", 2, message_id))
+
+        self.assertEqual(self.times_handled("message.updated"), 2)
+
+    @override_settings(DEDUP_ENABLED=True, EVENT_DISPATCH_POLICIES={})
+    def test_failed_handler_is_not_marked_as_seen(self, flush):
+        payload = make_payload("ticket.created")
+        self.handlers["ticket.created"].side_effect = [ValueError("boom"), None]
+
+        with self.assertRaises(ValueError):
+            event.manage(payload)
+        event.manage(payload)
+
+        self.assertEqual(self.handlers["ticket.created"].call_count, 2)
+
+    @override_settings(
+        DEDUP_ENABLED=True,
+        EVENT_DISPATCH_POLICIES={"message.created": "background"},
+    )
+    def test_failed_background_handler_is_not_marked_as_seen(self, flush):
+        payload = make_payload("message.created")
+        event.manage(payload)
+        # O worker rodou o handler e ele falhou
+        handler = self.handlers["message.created"]
+        task_failure.send(
+            sender=handler,
+            task_id="task",
+            exception=ValueError("boom"),
+            args=handler.apply_async.call_args.kwargs["args"],
+            kwargs=handler.apply_async.call_args.kwargs["kwargs"],
+        )
+
+        event.manage(payload)
+
+        self.assertEqual(handler.apply_async.call_count, 2)
+
+    @override_settings(
+        DEDUP_ENABLED=True,
+        EVENT_DISPATCH_POLICIES={"message.updated": "coalesce"},
+    )
+    def test_failed_coalesced_flush_is_not_marked_as_seen(self, flush):
+        payload = make_payload("message.updated")
+        event.manage(payload)
+        task_failure.send(
+            sender=dispatch.flush_coalesced,
+            task_id="task",
+            exception=ValueError("boom"),
+            args=flush.call_args.kwargs["args"],
+            kwargs=flush.call_args.kwargs["kwargs"],
+        )
+
+        self.assertNotIn("duplicated", event.manage(payload))
+
+
+@override_settings(DEDUP_ENABLED=False, EVENT_DISPATCH_POLICIES={})
+@mock.patch.object(journal.process_journal_batch, "apply_async")
+class JournalReplayTests(HandlersMixin, TestCase):
+    def make_entry(self, event_name="message.created", published_ago=600):
+        return EventJournal.objects.create(
+            event=event_name,
+            payload=make_payload(event_name),
+            enqueued_at=dt.now() - timedelta(seconds=published_ago),
+        )
+
+    def test_replayed_entry_is_handled_once(self, publish):
+        entry = self.make_entry()
+        journal.process_entry(entry)
+        # O drain republicou antes da primeira task terminar
+        journal.process_entry(entry)
+
+        self.assertEqual(self.times_handled("message.created"), 1)
+        self.assertEqual(journal.drain(), 0)
+
+    def test_drain_republishes_lost_entry(self, publish):
+        entry = self.make_entry()
+
+        self.assertEqual(journal.drain(), 1)
+        self.assertEqual(publish.call_args.kwargs["args"], [[entry.id]])
+        # Acabou de ser republicado: o próximo drain não publica de novo
+        self.assertEqual(journal.drain(), 0)
+
+        journal.process_journal_batch.run([entry.id])
+        entry.refresh_from_db()
+        self.assertIsNotNone(entry.processed_at)
+        self.assertEqual(self.times_handled("message.created"), 1)
+
+    def test_drain_skips_recent_and_claimed_entries(self, publish):
+        self.make_entry(published_ago=0)
+        claimed = self.make_entry()
+        EventJournal.objects.filter(id=claimed.id).update(claimed_at=dt.now())
+
+        self.assertEqual(journal.drain(), 0)
+        publish.assert_not_called()
+
+    @override_settings(DEDUP_ENABLED=True)
+    def test_replay_after_crash_is_not_a_duplicate(self, publish):
+        dedup.local_cache.clear()
+        entry = self.make_entry()
+        # O worker marcou o evento no dedup e morreu antes de terminar
+        dedup.is_duplicate("message.created", entry.payload["data"])
+        EventJournal.objects.filter(id=entry.id).update(attempts=1)
+
+        journal.process_journal_batch.run([entry.id])
+
+        entry.refresh_from_db()
+        self.assertIsNotNone(entry.processed_at)
+        self.assertEqual(self.times_handled("message.created"), 1)
+
+    @override_settings(DEDUP_ENABLED=True)
+    def test_redelivery_through_journal_is_dropped(self, publish):
+        dedup.local_cache.clear()
+        first = self.make_entry()
+        second = EventJournal.objects.create(
+            event=first.event, payload=first.payload, enqueued_at=dt.now()
+        )
+
+        journal.process_journal_batch.run([first.id, second.id])
+
+        self.assertEqual(self.times_handled("message.created"), 1)
+
+    @override_settings(JOURNAL_MAX_ATTEMPTS=2)
+    def test_poison_entry_goes_to_dead_letter(self, publish):
+        entry = self.make_entry()
+        self.handlers["message.created"].side_effect = ValueError("boom")
+
+        for _ in range(3):
+            journal.process_journal_batch.run([entry.id])
+
+        entry.refresh_from_db()
+        self.assertIsNotNone(entry.dead_at)
+        self.assertEqual(entry.attempts, 2)
+        self.assertIn("boom", entry.last_error)
+        self.assertEqual(journal.drain(), 0)
+
+
+class AckOrderTests(TestCase):
+    def setUp(self):
+        ticket = Ticket.objects.create(
+            ticket_id=str(uuid.uuid4()), period=date.today(), contact_id="contact"
+        )
+        self.message = Message.objects.create(
+            message_id=str(uuid.uuid4()),
+            contact_id="contact",
+            contact_number="5588999999999",
+            period=date.today(),
+            status=0,
+            ticket=ticket,
+            message_type="chat",
+            text="ok",
+        )
+
+    def ack(self, status):
+        handle_message_updated(self.message.message_id, data={"data": {"ack": status}})
+        self.message.refresh_from_db()
+        return self.message.status
+
+    def test_late_lower_ack_is_ignored(self):
+        self.assertEqual(self.ack(3), 3)
+        self.assertEqual(self.ack(1), 3)
+        self.assertEqual(self.ack(2), 3)
+
+    def test_acks_in_order(self):
+        self.assertEqual([self.ack(1), self.ack(2), self.ack(3)], [1, 2, 3])
+
+    def test_coalesce_keeps_highest_ack(self):
+        pending = {"args": ["id"], "data": {"data": {"ack": 3}}}
+        incoming = {"args": ["id"], "data": {"data": {"ack": 2}}}
+
+        self.assertIs(dispatch.keep_highest_ack(pending, incoming), pending)
+        self.assertIs(dispatch.keep_highest_ack(incoming, pending), pending)
+
+
+class TicketLastMessageTests(TestCase):
+    def test_reads_last_message_from_digisac_not_the_cache(self):
+        ticket = Ticket.objects.create(
+            ticket_id=str(uuid.uuid4()),
+            period=date.today(),
+            contact_id="contact",
+            last_message_id="old",
+        )
+        # Cache do processo com o estado de antes da resposta do cliente
+        digisac_cache.caches["tickets"].set(
+            ticket.ticket_id, {"id": ticket.ticket_id, "lastMessageId": "old"}
+        )
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            "id": ticket.ticket_id,
+            "lastMessageId": "new",
+            "isOpen": True,
+        }
+
+        with mock.patch.object(tools, "any_digisac_request", return_value=response):
+            tools.update_ticket_last_message(ticket.ticket_id)
+
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.last_message_id, "new")
+        cached = digisac_cache.caches["tickets"].get(ticket.ticket_id)
+        self.assertEqual(cached["lastMessageId"], "new")
+
+    def test_waits_for_the_ticket(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"id": "ticket", "lastMessageId": "new"}
+
+        with mock.patch.object(
+            tools, "any_digisac_request", return_value=response
+        ), mock.patch.object(tools.update_ticket_last_message, "apply_async") as retry:
+            result = tools.update_ticket_last_message("ticket")
+
+        self.assertIn("Aguardando", result)
+        self.assertEqual(retry.call_args.kwargs["args"], ("ticket",))
+
+
+@mock.patch.object(event.handle_ticket_created, "apply_async")
+class ExpirePendingMessagesTests(TestCase):
+    def park(self, ticket_id, hours_ago=48):
+        pending = PendingMessage.objects.create(
+            message_id=str(uuid.uuid4()), ticket_id=ticket_id, payload={}
+        )
+        PendingMessage.objects.filter(id=pending.id).update(
+            created_at=dt.now() - timedelta(hours=hours_ago)
+        )
+        return pending
+
+    def expire(self, tickets):
+        with mock.patch.object(
+            digisac_cache, "fetch_ticket", side_effect=lambda t, fresh: tickets.get(t)
+        ):
+            event.expire_pending_messages()
+
+    def test_ticket_found_in_digisac_is_created(self, create):
+        self.park("found")
+        self.park("recent", hours_ago=0)
+
+        self.expire({"found": {"id": "found", "contactId": "c", "lastMessageId": "m"}})
+
+        self.assertEqual(create.call_args.kwargs["args"], ["found", "c", "m"])
+        self.assertEqual(PendingMessage.objects.count(), 2)
+        # Só uma tentativa por ticket
+        self.expire({})
+        self.assertEqual(create.call_count, 1)
+
+    def test_unknown_ticket_is_discarded_and_counted(self, create):
+        self.park("missing")
+        self.park("missing")
+        before = metrics.get("pending_messages.expired")
+
+        self.expire({})
+
+        create.assert_not_called()
+        self.assertFalse(PendingMessage.objects.exists())
+        self.assertEqual(metrics.get("pending_messages.expired") - before, 2)
+
+
+@mock.patch.object(event, "get_contact_number", return_value="5588999999999")
+class TicketCreatedTests(TestCase):
+    def create(self, ticket_id, contact_id="contact"):
+        return event.handle_ticket_created(ticket_id, contact_id, None, data={})
+
+    def test_second_ticket_of_the_period_is_linked(self, number):
+        self.assertIn("criados", self.create("ticket-1"))
+        self.assertIn("adicionado", self.create("ticket-2"))
+
+        control = MessageControl.objects.get(digisac_id="contact")
+        self.assertEqual(control.ticket.ticket_id, "ticket-1")
+        link = control.get_ticket_link()
+        self.assertEqual(link.last_ticket.ticket_id, "ticket-2")
+
+    def test_redelivered_ticket_is_not_linked_to_itself(self, number):
+        self.create("ticket-1")
+        self.create("ticket-1")
+
+        control = MessageControl.objects.get(digisac_id="contact")
+        self.assertIsNone(control.get_ticket_link())
@@ -1,15 +1,13 @@
-import time
 from datetime import datetime as dt
 
 from django.db import IntegrityError
-from django.http import Http404
 from django.http.request import HttpRequest
-from django.shortcuts import get_object_or_404
 from rest_framework import viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from control.models import MessageControl
+from control.models import (MessageControl, refresh_last_message_snapshot,
+                            refresh_message_snapshots)
 from messages_api.exceptions import NotFoundException
 from messages_api.models import Message, Ticket
 from messages_api.serializer import (
@@ -17,6 +15,8 @@ from messages_api.serializer import (
     TicketSerializer,
     TicketStatusSerializer,
 )
+from webhook.exceptions import DependencyNotReady
+from webhook.utils import get_objects
 from webhook.utils.get_objects import get_digisac_contact_by_id
 from webhook.utils.logger import Logger
 from webhook.utils.tools import IGNORED_ID_LISTS, DictAsObject
@@ -123,6 +123,8 @@ class MessageViewSet(viewsets.ModelViewSet):
             logger.debug(f"{text}")
             return Response({f"error": "Something Wrong", "message": text}, status=409)
 
+        # O ticket já pode apontar para esta mensagem (ticket.updated antes)
+        refresh_message_snapshots([message.message_id])
         # obligation_control =
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=201)
@@ -178,13 +180,8 @@ def update_message(request: HttpRequest):
 def get_valid_ticket(ticket_id):
     if ticket_id == "4bf3c03a-2d33-439c-8b13-efb50531e9c1":
         return None
-    #
-    while True:
-        try:
-            ticket = get_object_or_404(Ticket, ticket_id=ticket_id)
-            return ticket
-        except Http404:
-            time.sleep(1)
+    # Sem espera: levanta DependencyNotReady se o ticket ainda não existe
+    return get_objects.get_valid_ticket(ticket_id)
 
 
 class TicketViewSet(viewsets.ModelViewSet):
@@ -297,11 +294,14 @@ class TicketViewSet(viewsets.ModelViewSet):
                 )
                 if serializer.is_valid():
                     serializer.save()
+                    refresh_last_message_snapshot(ticket_id, message.last_message_id)
                     return Response(
                         {"success": 200, "data": serializer.data}, status=200
                     )
 
                 return Response({"erro": serializer.errors}, status=400)
+        except DependencyNotReady as e:
+            return Response({"error": 404, "message": str(e)}, status=404)
         except Exception as e:
             text = f"Update ticket: {ticket_id} failed"
             logger.debug(text)
@@ -16,3 +16,26 @@ class ObjectNotFound(Exception):
 
 class UserBadRequest(Exception):
     pass
+
+
+class DigisacRequestError(ValueError):
+    # Resposta de erro da digisac. É ValueError porque era o que as chamadas
+    # levantavam antes e quem já trata ValueError continua funcionando
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(Exception):
+    # A dependência externa está com o circuit breaker aberto (falha rápida)
+    pass
+
+
+class DependencyNotReady(Exception):
+    # A linha de que o evento depende (ticket, agrupamento...) ainda não existe.
+    # As tasks com base=DependencyTask agendam uma nova tentativa em vez de esperar
+    def __init__(self, dependency, lookup=None):
+        super().__init__(f"{dependency} {lookup or ''} ainda não existe".strip())
+        self.dependency = dependency
+        self.lookup = lookup
@@ -0,0 +1,368 @@
+"""Servidor falso da digisac, companies api e routine runner para benchmark local.
+
+    python -m webhook.functions.fake_upstream --port 9000 --latency 80 \\
+        --error-rate 0.01 --throttle-rate 0.02 --webhook-url http://localhost:8080/webhook
+
+E aponte a aplicação para ele:
+
+    DIGISAC_API_URL=http://localhost:9000/digisac
+    COMPANIES_API_URL=http://localhost:9000/companies
+    ROUTINE_RUNNER_URL=http://localhost:9000/routine
+
+GET /_stats mostra as requisições recebidas e as falhas injetadas.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+# Respostas no formato que webhook/utils espera de cada API
+ROUTES = []
+
+
+def route(method, pattern):
+    def register(func):
+        ROUTES.append((method, re.compile(f"^{pattern}$"), func))
+        return func
+
+    return register
+
+
+class FakeUpstream:
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.tickets = {}
+        self.stats = Counter()
+
+    ##-- Injeção de latência e falhas
+    def delay(self):
+        latency = self.options.latency / 1000
+        jitter = self.options.jitter / 1000
+        time.sleep(max(0.0, random.uniform(latency - jitter, latency + jitter)))
+
+    def injected_failure(self):
+        roll = random.random()
+        if roll < self.options.throttle_rate:
+            return 429, {"error": "Too Many Requests"}
+        if roll < self.options.throttle_rate + self.options.error_rate:
+            return 500, {"error": "Internal Server Error"}
+        return None
+
+    ##-- Estado
+    def ticket_for(self, contact_id, ticket_id=None):
+        with self.lock:
+            for ticket in self.tickets.values():
+                if ticket["contactId"] == contact_id and ticket["isOpen"]:
+                    return ticket
+
+            ticket_id = ticket_id or str(uuid.uuid4())
+            ticket = {
+                "id": ticket_id,
+                "contactId": contact_id,
+                "isOpen": True,
+                "lastMessageId": None,
+                "protocol": str(random.randint(10**9, 10**10 - 1)),
+            }
+            self.tickets[ticket_id] = ticket
+            return ticket
+
+    def new_message(self, contact_id, text, is_from_me):
+        ticket = self.ticket_for(contact_id)
+        message = {
+            "id": str(uuid.uuid4()),
+            "contactId": contact_id,
+            "ticketId": ticket["id"],
+            "isFromMe": is_from_me,
+            "type": "chat",
+            "text": text,
+            "sent": True,
+            "data": {"ack": 0},
+        }
+        with self.lock:
+            self.messages[message["id"]] = message
+            ticket["lastMessageId"] = message["id"]
+        return message
+
+    ##-- Webhooks de volta para a aplicação
+    def fire(self, event, data, after=0.0):
+        if not self.options.webhook_url:
+            return
+
+        def post():
+            time.sleep(after)
+            body = json.dumps({"event": event, "data": data}).encode()
+            request = Request(
+                self.options.webhook_url,
+                data=body,
+                headers={"Content-Type": "application/json"},
+            )
+            try:
+                urlopen(request, timeout=30).read()
+                self.stats[f"webhook {event}"] += 1
+            except Exception:
+                self.stats[f"webhook {event} failed"] += 1
+
+        threading.Thread(target=post, daemon=True).start()
+
+    def fire_sent_message(self, message):
+        # O que a digisac manda depois de um envio: created e os acks 1, 2 e 3
+        self.fire("message.created", dict(message))
+        for ack in (1, 2, 3):
+            self.fire(
+                "message.updated",
+                {**message, "data": {"ack": ack}},
+                after=ack * self.options.ack_interval,
+            )
+
+    def inbound_loop(self):
+        # Mensagens de clientes chegando no ritmo de --inbound-rate por segundo
+        interval = 1 / self.options.inbound_rate
+        while True:
+            contact_id = f"contact-{random.randint(1, self.options.contacts)}"
+            new_ticket = not any(
+                t["contactId"] == contact_id and t["isOpen"]
+                for t in list(self.tickets.values())
+            )
+            message = self.new_message(contact_id, random.choice(["ok", "sim"]), False)
+            if new_ticket:
+                self.fire("ticket.created", dict(self.tickets[message["ticketId"]]))
+            self.fire("message.created", dict(message))
+            time.sleep(interval)
+
+
+##-- Digisac
+@route("POST", "/digisac/messages")
+def post_message(app, match, query, body):
+    message = app.new_message(body.get("contactId"), body.get("text"), True)
+    app.fire_sent_message(message)
+    return 200, message
+
+
+@route("GET", "/digisac/messages/(?P<id>[^/]+)")
+def get_message(app, match, query, body):
+    message = app.messages.get(match["id"])
+    if message is None and app.options.strict:
+        return 404, {"error": "Not Found"}
+    return 200, message or {
+        "id": match["id"],
+        "contactId": "contact-1",
+        "ticketId": app.ticket_for("contact-1")["id"],
+        "isFromMe": False,
+        "sent": True,
+        "data": {"ack": 3},
+    }
+
+
+@route("GET", "/digisac/tickets/(?P<id>[^/]+)")
+def get_ticket(app, match, query, body):
+    ticket = app.tickets.get(match["id"])
+    if ticket is None and app.options.strict:
+        return 404, {"error": "Not Found"}
+    return 200, ticket or app.ticket_for(f"contact-of-{match['id']}", match["id"])
+
+
+@route("POST", "/digisac/contacts/(?P<id>[^/]+)/ticket/close")
+def close_ticket(app, match, query, body):
+    ticket = app.ticket_for(match["id"])
+    ticket["isOpen"] = False
+    app.fire("ticket.updated", dict(ticket))
+    return 200, {"success": True}
+
+
+##-- Companies API
+def stable_hash(value) -> int:
+    # hash() muda a cada execução, os dados falsos devem ser sempre os mesmos
+    return zlib.crc32(str(value).encode())
+
+
+def fake_contact(digisac_id):
+    number = stable_hash(digisac_id) % 10**8
+    return {
+        "digisac_id": digisac_id,
+        "country_code": "55",
+        "ddd": "88",
+        "contact_number": f"9{number:08d}",
+        "responsible_name": f"Responsável {digisac_id}",
+    }
+
+
+def fake_company(company_id):
+    return {
+        "id": company_id,
+        "fantasy_name": f"Empresa {company_id}",
+        "cnpj_cpf": f"{stable_hash(company_id) % 10**14:014d}",
+    }
+
+
+@route("GET", "/companies/contacts/export")
+def export_companies(app, match, query, body):
+    # Paginado por offset/limit, no formato de /contacts/digisac/all/{id}
+    offset = int(query.get("offset", ["0"])[0])
+    limit = int(query.get("limit", ["500"])[0])
+    contacts = range(1, app.options.contacts + 1)
+    if query.get("updated_after"):
+        # Incremental: só uma fração dos contatos mudou
+        contacts = [i for i in contacts if i % 10 == 0]
+
+    entries = []
+    for i in contacts:
+        _, companies = get_companies_by_contact(
+            app, {"id": f"contact-{i}"}, query, body
+        )
+        entries.extend(companies)
+    return 200, entries[offset : offset + limit]
+
+
+@route("GET", "/companies/contacts/digisac/all/(?P<id>[^/]+)")
+def get_companies_by_contact(app, match, query, body):
+    total = 1 + stable_hash(match["id"]) % app.options.max_companies
+    return 200, [
+        {
+            "company": fake_company(f"{match['id']}-{i}"),
+            "contact": fake_contact(match["id"]),
+        }
+        for i in range(total)
+    ]
+
+
+@route("GET", "/companies/contacts/digisac/(?P<id>[^/]+)")
+def get_digisac_contact(app, match, query, body):
+    return 200, fake_contact(match["id"])
+
+
+@route("GET", "/companies/contacts/company-data/(?P<id>[^/]+)")
+def get_company_data(app, match, query, body):
+    return 200, {"contact": fake_contact(match["id"]), "company": fake_company(1)}
+
+
+@route("GET", "/companies/companies/id/(?P<id>[^/]+)")
+def get_company(app, match, query, body):
+    return 200, fake_company(match["id"])
+
+
+@route("GET", "/companies/contacts/(?P<cnpj>[^/]+)")
+def get_contact_by_cnpj(app, match, query, body):
+    contact_id = f"contact-{stable_hash(match['cnpj']) % app.options.contacts + 1}"
+    return 200, {
+        "company": match["cnpj"],
+        "digisac_contact": fake_contact(contact_id),
+    }
+
+
+##-- Routine runner
+@route("GET", "/routine/mei/competences")
+def get_competences(app, match, query, body):
+    if random.random() >= app.options.pendency_rate:
+        return 200, []
+    return 200, [{"period": "2023-01-01", "cnpj": query.get("cnpj", [""])[0]}]
+
+
+##-- Servidor
+def make_handler(app: FakeUpstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle_method(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            body = json.loads(raw) if raw else {}
+
+            if url.path == "/_stats":
+                return self.respond(200, dict(app.stats))
+
+            for route_method, pattern, func in ROUTES:
+                match = pattern.match(url.path)
+                if route_method == method and match:
+                    app.stats[f"{method} {pattern.pattern}"] += 1
+                    app.delay()
+                    failure = app.injected_failure()
+                    if failure:
+                        app.stats[f"injected {failure[0]}"] += 1
+                        return self.respond(*failure)
+                    return self.respond(*func(app, match, parse_qs(url.query), body))
+
+            app.stats["not found"] += 1
+            return self.respond(404, {"error": f"{method} {url.path} not found"})
+
+        def do_GET(self):
+            self.handle_method("GET")
+
+        def do_POST(self):
+            self.handle_method("POST")
+
+        def respond(self, status, data):
+            content = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            if status == 429:
+                self.send_header("Retry-After", str(app.options.retry_after))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            if app.options.verbose:
+                super().log_message(format, *args)
+
+    return Handler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=50, help="ms")
+    parser.add_argument("--jitter", type=float, default=20, help="ms")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--pendency-rate", type=float, default=0.3)
+    parser.add_argument("--contacts", type=int, default=500)
+    parser.add_argument("--max-companies", type=int, default=3)
+    parser.add_argument("--webhook-url", default="")
+    parser.add_argument("--ack-interval", type=float, default=1.0, help="s")
+    parser.add_argument(
+        "--inbound-rate", type=float, default=0.0, help="mensagens de clientes/s"
+    )
+    parser.add_argument(
+        "--strict", action="store_true", help="404 para ids que o servidor não criou"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def serve(options):
+    app = FakeUpstream(options)
+    server = ThreadingHTTPServer((options.host, options.port), make_handler(app))
+    server.daemon_threads = True
+
+    if options.inbound_rate and options.webhook_url:
+        threading.Thread(target=app.inbound_loop, daemon=True).start()
+
+    return app, server
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    app, server = serve(options)
+    print(f"Fake upstream em http://{options.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
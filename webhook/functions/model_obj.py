@@ -1,10 +1,12 @@
 from django.conf import settings
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 
-from control.models import Message, MessageControl, PdfFile, Ticket
+from control.models import (Message, MessageControl, PdfFile, Ticket,
+                            refresh_message_snapshots)
+from messages_api.models import PendingMessage
 from webhook.exceptions import DigisacBugException, ObjectNotFound
 from webhook.utils.get_objects import get_ticket
-from webhook.utils.tools import DictAsObject, get_digisac_ticket
+from webhook.utils.tools import DictAsObject
 
 
 def check_has_value(anything, error_message=""):
@@ -44,15 +46,9 @@ def create_new_message(**kwargs) -> Message:
     #
 
     if not ticket:
-        digisac_ticket = get_digisac_ticket(ticket_id)
-        # Cria o ticket se não existir
-        create_new_ticket(
-            ticket_id=digisac_ticket.ticket_id,
-            period=digisac_ticket.period,
-            contact_id=digisac_ticket.contact_id,
-            last_message_id=digisac_ticket.last_message_id,
-        )
-        # raise DigisacBugException("Ticket não encontrado ou não criado!")
+        # O ticket.created ainda não chegou: a mensagem espera na
+        # PendingMessage e é gravada quando o ticket for criado
+        return park_message(kwargs)
 
     message, created = Message.objects.get_or_create(
         message_id=message_id,
@@ -66,9 +62,74 @@ def create_new_message(**kwargs) -> Message:
         text=text,
         retries=0,
     )
+    if created:
+        # O ticket já pode apontar para esta mensagem (ticket.updated antes)
+        refresh_message_snapshots([message_id])
     return message
 
 
+##-- Mensagens que chegaram antes do ticket
+PENDING_MESSAGE_FIELDS = (
+    "contact_number",
+    "period",
+    "message_id",
+    "contact_id",
+    "message_type",
+    "is_from_me",
+    "text",
+)
+
+
+def park_message(message_data: dict):
+    # Retorna a mensagem só se o ticket apareceu enquanto ela era estacionada
+    payload = {field: message_data[field] for field in PENDING_MESSAGE_FIELDS}
+    payload["period"] = str(payload["period"])
+
+    PendingMessage.objects.get_or_create(
+        message_id=message_data["message_id"],
+        defaults={
+            "ticket_id": message_data["ticket"],
+            "status": message_data["status"] or 0,
+            "payload": payload,
+        },
+    )
+
+    # O ticket pode ter sido criado entre a consulta e o insert acima
+    ticket = get_ticket(ticket_id=message_data["ticket"])
+    if ticket:
+        drain_pending_messages(ticket)
+        return Message.objects.filter(message_id=message_data["message_id"]).first()
+
+    return None
+
+
+def drain_pending_messages(ticket: Ticket) -> list:
+    # Grava de uma vez as mensagens que esperavam por este ticket.
+    # Retorna as mensagens criadas
+    with transaction.atomic():
+        pending = list(
+            PendingMessage.objects.select_for_update(skip_locked=True).filter(
+                ticket_id=ticket.ticket_id
+            )
+        )
+        if not pending:
+            return []
+
+        messages = Message.objects.bulk_create(
+            [
+                Message(
+                    ticket=ticket, status=parked.status, retries=0, **parked.payload
+                )
+                for parked in pending
+            ],
+            ignore_conflicts=True,
+        )
+        PendingMessage.objects.filter(id__in=[parked.id for parked in pending]).delete()
+
+    refresh_message_snapshots([message.message_id for message in messages])
+    return messages
+
+
 def create_new_ticket(**kwargs) -> Ticket:
     data = DictAsObject(kwargs)
     ticket_id = data.id
@@ -94,11 +155,12 @@ def create_new_message_control(ticket: Ticket, **kwargs) -> MessageControl:
     digisac_id = data.digisac_id
     period = data.period
     #
+    # Busca só pela chave única (digisac_id, period): se dois ticket.created
+    # do mesmo contato chegarem juntos, o segundo pega o controle do primeiro
     message_control, created = MessageControl.objects.get_or_create(
-        ticket=ticket,
-        contact_number=contact_number,
         digisac_id=digisac_id,
         period=period,
+        defaults={"ticket": ticket, "contact_number": contact_number},
     )
     #
     return message_control, created
@@ -50,6 +50,175 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 IGNORED_ID_LISTS = ["4bf3c03a-2d33-439c-8b13-efb50531e9c1"]
 COMPANIES_API = os.environ.get("COMPANIES_API_URL", os.getenv("COMPANIES_API_URL"))
 
+# Ingestão do webhook: "journal" grava o evento no EventJournal, publica no celery
+# e responde na hora. "inline" processa o evento dentro da própria requisição.
+# Só ligar o journal com o programa journal-drain do celery.conf rodando: é ele
+# que republica os eventos que o broker perdeu
+WEBHOOK_INGESTION_MODE = os.environ.get("WEBHOOK_INGESTION_MODE", "inline")
+# Segundos sem processamento até o drain considerar que o broker perdeu o evento
+JOURNAL_REPLAY_AFTER = int(os.environ.get("JOURNAL_REPLAY_AFTER", 300))
+# Segundos que um worker pode ficar com o evento antes de outro poder pegá-lo
+# (o worker pode ter morrido no meio)
+JOURNAL_CLAIM_TIMEOUT = int(os.environ.get("JOURNAL_CLAIM_TIMEOUT", 900))
+# Tentativas até o evento ir para o dead letter (dead_at)
+JOURNAL_MAX_ATTEMPTS = int(os.environ.get("JOURNAL_MAX_ATTEMPTS", 5))
+# Arquivo JSONL onde o webhook grava os eventos recebidos (sanitizados) para
+# replay com "manage.py replay_webhooks". Vazio desliga a captura.
+WEBHOOK_CAPTURE_FILE = os.environ.get("WEBHOOK_CAPTURE_FILE", "")
+
+# Como cada evento da digisac é executado: "inline" (na hora), "background"
+# (task no celery) ou "coalesce" (task no celery que espera a janela e aplica só
+# o estado mais recente da entidade). O coalesce precisa de um cache compartilhado
+# (REDIS_URL), sem ele o evento vai para "background".
+EVENT_DISPATCH_POLICIES = {
+    "message.created": os.environ.get("DISPATCH_MESSAGE_CREATED", "background"),
+    "message.updated": os.environ.get("DISPATCH_MESSAGE_UPDATED", "coalesce"),
+    "ticket.created": os.environ.get("DISPATCH_TICKET_CREATED", "background"),
+    "ticket.updated": os.environ.get("DISPATCH_TICKET_UPDATED", "coalesce"),
+}
+EVENT_COALESCE_WINDOW = float(os.environ.get("EVENT_COALESCE_WINDOW", 3))
+# Janela por evento. Os acks 1, 2 e 3 de uma mensagem chegam em poucos segundos
+EVENT_COALESCE_WINDOWS = {
+    "message.updated": float(os.environ.get("MESSAGE_ACK_COALESCE_WINDOW", 5)),
+}
+
+# Descarte de eventos reentregues pela digisac (mesmo evento, id e estado)
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "True") == "True"
+DEDUP_TTL = int(os.environ.get("DEDUP_TTL", 600))
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", 20000))
+# Também consulta o cache compartilhado (REDIS_URL) para pegar reentregas que
+# caíram em outro processo
+DEDUP_SHARED = os.environ.get("DEDUP_SHARED", "True") == "True"
+
+# Clientes HTTP compartilhados por processo (webhook/utils/http.py)
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 20))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 10)
+)
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+# Também vale para escrita. O envio de PDF em base64 para a digisac é o mais lento
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", 10))
+# Precisa do pacote h2 (pip install httpx[http2])
+HTTP2_ENABLED = os.environ.get("HTTP2_ENABLED", "False") == "True"
+
+# Envios para a digisac em paralelo (contatos ao mesmo tempo) nas campanhas e
+# no check_visualized. As mensagens de um mesmo contato continuam em ordem.
+DIGISAC_SEND_CONCURRENCY = int(os.environ.get("DIGISAC_SEND_CONCURRENCY", 10))
+# Agrupamentos de DAS por task do celery
+DAS_CAMPAIGN_BATCH_SIZE = int(os.environ.get("DAS_CAMPAIGN_BATCH_SIZE", 50))
+# Controles por task do celery no check_visualized
+CHECK_VISUALIZED_CHUNK_SIZE = int(os.environ.get("CHECK_VISUALIZED_CHUNK_SIZE", 500))
+
+# Cache das consultas GET /messages/{id} e /tickets/{id} da digisac.
+# DIGISAC_CACHE_BYPASS=True sempre consulta a API (para depuração)
+DIGISAC_CACHE_BYPASS = os.environ.get("DIGISAC_CACHE_BYPASS", "False") == "True"
+DIGISAC_CACHE_MAX_ENTRIES = int(os.environ.get("DIGISAC_CACHE_MAX_ENTRIES", 5000))
+DIGISAC_MESSAGE_CACHE_TTL = int(os.environ.get("DIGISAC_MESSAGE_CACHE_TTL", 60))
+DIGISAC_TICKET_CACHE_TTL = int(os.environ.get("DIGISAC_TICKET_CACHE_TTL", 30))
+
+# Rate limit das chamadas para a digisac: (tokens por segundo, tamanho do bucket)
+# por endpoint. Com REDIS_URL o limite é compartilhado entre web e workers.
+DIGISAC_RATE_LIMIT_ENABLED = (
+    os.environ.get("DIGISAC_RATE_LIMIT_ENABLED", "True") == "True"
+)
+DIGISAC_RATE_LIMITS = {
+    "send": (
+        float(os.environ.get("DIGISAC_SEND_RATE", 5)),
+        int(os.environ.get("DIGISAC_SEND_BURST", 10)),
+    ),
+    "tickets": (
+        float(os.environ.get("DIGISAC_TICKETS_RATE", 5)),
+        int(os.environ.get("DIGISAC_TICKETS_BURST", 10)),
+    ),
+    "default": (
+        float(os.environ.get("DIGISAC_DEFAULT_RATE", 20)),
+        int(os.environ.get("DIGISAC_DEFAULT_BURST", 40)),
+    ),
+}
+# Novas tentativas em 429/5xx. Sem Retry-After espera BASE * 2^tentativa (até MAX)
+DIGISAC_MAX_RETRIES = int(os.environ.get("DIGISAC_MAX_RETRIES", 3))
+DIGISAC_BACKOFF_BASE = float(os.environ.get("DIGISAC_BACKOFF_BASE", 1))
+DIGISAC_BACKOFF_MAX = float(os.environ.get("DIGISAC_BACKOFF_MAX", 60))
+
+# Circuit breaker e retries das APIs externas (webhook/utils/resilience.py).
+# O breaker abre depois de N falhas seguidas e fica aberto RESET_TIMEOUT segundos
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get("BREAKER_RESET_TIMEOUT", 30))
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", 2))
+RETRY_BACKOFF_BASE = float(os.environ.get("RETRY_BACKOFF_BASE", 0.5))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", 5))
+# Retries permitidos por janela: RATIO das chamadas da janela (mínimo RETRY_BUDGET_MIN)
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_WINDOW = float(os.environ.get("RETRY_BUDGET_WINDOW", 10))
+RETRY_BUDGET_MIN = int(os.environ.get("RETRY_BUDGET_MIN", 3))
+
+# Fila de envio por contato: cada contato cai sempre na mesma fila sends.N,
+# consumida por um worker com concurrency 1 (ver celery.conf, numprocs deve ser
+# igual a este valor). 0 envia direto, sem fila. Cada partição envia uma
+# mensagem por vez: para sustentar DIGISAC_SEND_RATE com envios de ~1-2s
+# (pdfs) são precisas ao menos RATE x latência partições, o mesmo paralelismo
+# de DIGISAC_SEND_CONCURRENCY
+SEND_QUEUE_PARTITIONS = int(os.environ.get("SEND_QUEUE_PARTITIONS", 10))
+
+# GETs idênticos simultâneos compartilham uma requisição (utils/singleflight.py).
+# SINGLEFLIGHT_SHARED coordena também entre processos pelo cache (precisa de REDIS_URL)
+SINGLEFLIGHT_ENABLED = os.environ.get("SINGLEFLIGHT_ENABLED", "True") == "True"
+SINGLEFLIGHT_SHARED = os.environ.get("SINGLEFLIGHT_SHARED", "False") == "True"
+SINGLEFLIGHT_LOCK_TIMEOUT = int(os.environ.get("SINGLEFLIGHT_LOCK_TIMEOUT", 10))
+SINGLEFLIGHT_RESULT_TTL = int(os.environ.get("SINGLEFLIGHT_RESULT_TTL", 2))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.environ.get("SINGLEFLIGHT_POLL_INTERVAL", 0.05))
+
+# Cache de contatos e empresas da companies api (webhook/utils/directory.py).
+# Processo + redis (quando existe). O "não encontrado" fica por menos tempo
+DIRECTORY_CACHE_BYPASS = os.environ.get("DIRECTORY_CACHE_BYPASS", "False") == "True"
+DIRECTORY_CACHE_SHARED = os.environ.get("DIRECTORY_CACHE_SHARED", "True") == "True"
+DIRECTORY_CACHE_MAX_ENTRIES = int(os.environ.get("DIRECTORY_CACHE_MAX_ENTRIES", 5000))
+DIRECTORY_CACHE_TTL = int(os.environ.get("DIRECTORY_CACHE_TTL", 60 * 60))
+DIRECTORY_NEGATIVE_TTL = int(os.environ.get("DIRECTORY_NEGATIVE_TTL", 5 * 60))
+# Com o redis, quanto tempo uma entrada fica no processo (L1) antes de ler o L2
+# de novo. Limita o atraso de uma invalidação feita em outro processo
+DIRECTORY_CACHE_LOCAL_TTL = int(os.environ.get("DIRECTORY_CACHE_LOCAL_TTL", 5))
+
+# Threads para as consultas em paralelo às APIs externas (webhook/utils/gather.py)
+UPSTREAM_GATHER_WORKERS = int(os.environ.get("UPSTREAM_GATHER_WORKERS", 8))
+
+# Cache das pendências do routine runner por cnpj e período
+# (webhook/utils/pendencies_cache.py)
+PENDENCIES_CACHE_BYPASS = os.environ.get("PENDENCIES_CACHE_BYPASS", "False") == "True"
+PENDENCIES_CACHE_SHARED = os.environ.get("PENDENCIES_CACHE_SHARED", "True") == "True"
+PENDENCIES_CACHE_MAX_ENTRIES = int(
+    os.environ.get("PENDENCIES_CACHE_MAX_ENTRIES", 10000)
+)
+PENDENCIES_CACHE_TTL = int(os.environ.get("PENDENCIES_CACHE_TTL", 6 * 60 * 60))
+PENDENCIES_CACHE_LOCAL_TTL = int(os.environ.get("PENDENCIES_CACHE_LOCAL_TTL", 5))
+
+# Cópia local dos contatos e empresas da companies api
+# (webhook/utils/companies_mirror.py). Só é usada se uma sincronização
+# terminou nos últimos COMPANIES_MIRROR_MAX_STALENESS segundos
+COMPANIES_MIRROR_ENABLED = os.environ.get("COMPANIES_MIRROR_ENABLED", "True") == "True"
+COMPANIES_MIRROR_MAX_STALENESS = int(
+    os.environ.get("COMPANIES_MIRROR_MAX_STALENESS", 60 * 60)
+)
+# Endpoint de exportação paginada da companies api. Sem ele não há sincronização
+# (o programa sync-companies do celery.conf fica desligado até ser configurado)
+COMPANIES_SYNC_URL = os.environ.get("COMPANIES_SYNC_URL", "")
+COMPANIES_SYNC_PAGE_SIZE = int(os.environ.get("COMPANIES_SYNC_PAGE_SIZE", 500))
+COMPANIES_SYNC_OVERLAP = int(os.environ.get("COMPANIES_SYNC_OVERLAP", 5 * 60))
+COMPANIES_SYNC_FULL_INTERVAL = int(
+    os.environ.get("COMPANIES_SYNC_FULL_INTERVAL", 24 * 60 * 60)
+)
+
+# Eventos que chegam antes da linha de que dependem são reagendados com backoff
+# (webhook/utils/dependencies.py) até DEPENDENCY_WAIT_DEADLINE segundos
+DEPENDENCY_RETRY_BASE = float(os.environ.get("DEPENDENCY_RETRY_BASE", 2))
+DEPENDENCY_RETRY_MAX = float(os.environ.get("DEPENDENCY_RETRY_MAX", 60))
+DEPENDENCY_WAIT_DEADLINE = int(os.environ.get("DEPENDENCY_WAIT_DEADLINE", 15 * 60))
+
+# Tempo máximo que uma mensagem espera pelo ticket.created (PendingMessage)
+PENDING_MESSAGE_TTL = int(os.environ.get("PENDING_MESSAGE_TTL", 24 * 60 * 60))
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.1/howto/deployment/checklist/
 
@@ -132,6 +301,24 @@ DATABASES = {
     }
 }
 
+# Cache compartilhado entre web e workers do celery quando existe REDIS_URL.
+# Sem ele cada processo fica com o seu cache em memória.
+REDIS_URL = os.environ.get("REDIS_URL", os.getenv("REDIS_URL"))
+
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
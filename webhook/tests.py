@@ -0,0 +1,143 @@
+from unittest import mock
+
+import httpx
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+
+from webhook.exceptions import CircuitOpenError
+from webhook.utils import cache, gather, ratelimit, resilience, threads, tools
+
+
+def make_response(status_code, method="POST"):
+    return httpx.Response(
+        status_code, request=httpx.Request(method, "http://digisac/messages")
+    )
+
+
+@override_settings(DIGISAC_RATE_LIMIT_ENABLED=False, DIGISAC_MAX_RETRIES=3)
+@mock.patch.object(ratelimit, "pause")
+@mock.patch.object(ratelimit, "get_retry_delay", return_value=0)
+class DigisacRetryTests(SimpleTestCase):
+    def send(self, method, *statuses):
+        client = mock.Mock()
+        client.request.side_effect = [make_response(s, method) for s in statuses]
+        response = tools.send_digisac_request_now(client, method.lower(), "/messages")
+        return response, client.request.call_count
+
+    def test_post_is_not_repeated_on_5xx(self, delay, pause):
+        response, calls = self.send("POST", 502, 200)
+
+        self.assertEqual((response.status_code, calls), (502, 1))
+
+    def test_post_is_repeated_on_429(self, delay, pause):
+        response, calls = self.send("POST", 429, 200)
+
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+    def test_get_is_repeated_on_5xx(self, delay, pause):
+        response, calls = self.send("GET", 503, 200)
+
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+
+@override_settings(RETRY_MAX_ATTEMPTS=2)
+@mock.patch.object(resilience, "backoff", return_value=0)
+class ResilienceTests(SimpleTestCase):
+    def setUp(self):
+        resilience._breakers.clear()
+        resilience._budgets.clear()
+
+    def test_half_open_trial_is_released_on_any_exception(self, backoff):
+        breaker = resilience.get_breaker("test")
+        breaker.state = breaker.OPEN
+        breaker.opened_at = 0.0
+        func = mock.Mock(side_effect=httpx.DecodingError("corpo inválido"))
+
+        with self.assertRaises(httpx.DecodingError):
+            resilience.call("test", func)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # Passado o reset_timeout, outra chamada de teste é permitida
+        breaker.opened_at = 0.0
+        func.side_effect = None
+        func.return_value = make_response(200)
+        self.assertEqual(resilience.call("test", func).status_code, 200)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_open_breaker_rejects(self, backoff):
+        breaker = resilience.get_breaker("test")
+        breaker.state = breaker.OPEN
+        breaker.opened_at = 10**12
+
+        with self.assertRaises(CircuitOpenError):
+            resilience.call("test", mock.Mock())
+
+    def test_post_is_not_repeated_after_read_timeout(self, backoff):
+        func = mock.Mock(side_effect=httpx.ReadTimeout("timeout"))
+
+        with self.assertRaises(httpx.ReadTimeout):
+            resilience.call("test", func, idempotent=False)
+        self.assertEqual(func.call_count, 1)
+
+    def test_post_is_repeated_when_not_sent(self, backoff):
+        func = mock.Mock(
+            side_effect=[httpx.ConnectError("recusada"), make_response(200)]
+        )
+
+        self.assertEqual(
+            resilience.call("test", func, idempotent=False).status_code, 200
+        )
+        self.assertEqual(func.call_count, 2)
+
+    def test_get_is_repeated_after_read_timeout(self, backoff):
+        func = mock.Mock(side_effect=[httpx.ReadTimeout("timeout"), make_response(200)])
+
+        self.assertEqual(resilience.call("test", func).status_code, 200)
+        self.assertEqual(func.call_count, 2)
+
+
+@mock.patch.object(cache, "shared_cache_available", return_value=True)
+class TwoTierCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(cache.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Dois processos com o mesmo L2 (o cache default do teste)
+        self.web, self.worker = (
+            cache.TwoTierCache("test", ttl=3600, local_ttl=5) for _ in range(2)
+        )
+        self.web.delete("contact")
+
+    def test_invalidation_reaches_other_processes_after_local_ttl(self, shared):
+        self.web.set("contact", "old")
+        self.assertEqual(self.worker.get("contact"), "old")
+
+        self.web.delete("contact")
+        self.assertEqual(self.worker.get("contact"), "old")
+
+        self.now += 6
+        self.assertIs(self.worker.get("contact"), cache.MISSING)
+
+    def test_local_ttl_is_not_applied_without_shared_cache(self, shared):
+        shared.return_value = False
+        self.web.set("contact", "value")
+
+        self.now += 6
+        self.assertEqual(self.web.get("contact"), "value")
+
+
+class GatherTests(SimpleTestCase):
+    def test_pool_lookups_close_old_connections(self):
+        with mock.patch.object(threads, "close_old_connections") as close:
+            result = gather.gather_upstream_context({"lookup": lambda: "ok"})
+
+        self.assertEqual(result, {"lookup": "ok"})
+        self.assertEqual(close.call_count, 2)
+
+
+class SyncCompaniesTests(SimpleTestCase):
+    @override_settings(COMPANIES_SYNC_URL="")
+    def test_sync_requires_url(self):
+        with self.assertRaises(CommandError):
+            call_command("sync_companies", loop=300)
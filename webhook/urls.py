@@ -19,11 +19,15 @@ from django.contrib import admin
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from django.urls import include, path
 
-from webhook.views import webhook_receiver
+from webhook.views import (async_webhook_receiver, metrics_view,
+                           webhook_batch_receiver, webhook_receiver)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("webhook", webhook_receiver, name="webhook"),
+    path("webhook/async", async_webhook_receiver, name="webhook_async"),
+    path("webhook/batch", webhook_batch_receiver, name="webhook_batch"),
+    path("webhook/metrics", metrics_view, name="metrics"),
     path("webhook/control", include("control.urls")),
 ]
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+MISSING = object()
+
+
+def shared_cache_available() -> bool:
+    # True quando o cache default é visto por todos os processos (web e celery)
+    return settings.CACHES["default"]["BACKEND"] not in LOCAL_CACHE_BACKENDS
+
+
+class TTLCache:
+    # Cache em memória do processo, com limite de tamanho (LRU) e expiração por
+    # entrada. Seguro para threads/greenlets.
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class TwoTierCache:
+    # L1: TTLCache do processo. L2: cache default do django, só quando ele é
+    # compartilhado (REDIS_URL) e shared=True. Um hit no L2 reabastece o L1.
+    # Com o L2 ativo o L1 vale no máximo local_ttl segundos: o delete só limpa
+    # o L1 do processo que invalidou, os outros veem a mudança quando o L1
+    # deles expira e a leitura volta ao L2.
+    def __init__(self, prefix, maxsize=1024, ttl=60, shared=True, local_ttl=None):
+        from django.core.cache import cache
+
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.shared = shared
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._shared_cache = cache
+        self.shared_hits = 0
+
+    def use_shared(self) -> bool:
+        return self.shared and shared_cache_available()
+
+    def shared_key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get_local_ttl(self, ttl):
+        if self.local_ttl is not None and self.use_shared():
+            return min(ttl, self.local_ttl)
+        return ttl
+
+    def get(self, key, default=MISSING):
+        value = self.local.get(key)
+        if value is not MISSING:
+            return value
+
+        if self.use_shared():
+            value = self._shared_cache.get(self.shared_key(key), MISSING)
+            if value is not MISSING:
+                self.shared_hits += 1
+                self.local.set(key, value, ttl=self.get_local_ttl(self.ttl))
+                return value
+
+        return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, ttl=self.get_local_ttl(ttl))
+        if self.use_shared():
+            self._shared_cache.set(self.shared_key(key), value, timeout=ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.use_shared():
+            self._shared_cache.delete(self.shared_key(key))
+
+    def stats(self):
+        stats = self.local.stats()
+        # Um hit no L2 também conta como miss no L1
+        total = stats["hits"] + stats["misses"]
+        hits = stats["hits"] + self.shared_hits
+        stats["shared_hits"] = self.shared_hits
+        stats["hit_ratio"] = round(hits / total, 4) if total else 0.0
+        stats["shared"] = self.use_shared()
+        return stats
@@ -0,0 +1,65 @@
+import json
+import threading
+from datetime import datetime as dt
+
+from django.conf import settings
+
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Campos com dados pessoais ou arquivos. O id das entidades é mantido para que o
+# replay refaça o mesmo fluxo (mensagem -> ticket -> contato).
+SENSITIVE_KEYS = ("text", "body", "base64", "file", "name", "number", "phone")
+
+_lock = threading.Lock()
+
+
+def sanitize(value):
+    if isinstance(value, dict):
+        return {
+            key: mask(item) if key in SENSITIVE_KEYS else sanitize(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def mask(value):
+    if isinstance(value, str):
+        return "x" * len(value)
+    if isinstance(value, (dict, list)):
+        return None
+    return value
+
+
+def capture(data):
+    capture_many([data])
+
+
+def capture_many(items):
+    # Grava os eventos recebidos no arquivo de captura (JSONL), se estiver ligado
+    path = settings.WEBHOOK_CAPTURE_FILE
+    if not path or not items:
+        return
+
+    ts = dt.now().timestamp()
+    lines = "".join(
+        json.dumps({"ts": ts, "payload": sanitize(data)}, ensure_ascii=False) + "\n"
+        for data in items
+    )
+    # A captura nunca pode derrubar o recebimento do webhook
+    try:
+        with _lock:
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(lines)
+    except OSError as e:
+        logger.error(f"Falha ao gravar captura em {path}: {e}")
+
+
+def read_capture(path):
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,253 @@
+import re
+import time
+from datetime import datetime as dt
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+from control.models import CompaniesSync, CompanyMirror, ContactMirror
+from webhook.utils import http, metrics, resilience
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Cópia local dos contatos e empresas da companies api. A sincronização completa
+# traz tudo e apaga o que sumiu, a incremental só o que mudou desde a última.
+# Os get_* de webhook/utils/get_objects.py leem daqui e só vão na API quando o
+# registro não existe ou a cópia está desatualizada (sincronização parada).
+_ready = {"checked_at": 0.0, "value": False}
+
+
+##-- Leitura
+def is_ready() -> bool:
+    # A cópia só é usada se uma sincronização terminou há pouco tempo. Se o
+    # sincronizador parar, tudo volta a ir na API. Consulta o banco a cada 30s.
+    if not settings.COMPANIES_MIRROR_ENABLED:
+        return False
+
+    now = time.monotonic()
+    if now - _ready["checked_at"] > 30:
+        limit = dt.now() - timedelta(seconds=settings.COMPANIES_MIRROR_MAX_STALENESS)
+        _ready["value"] = CompaniesSync.objects.filter(finished_at__gte=limit).exists()
+        _ready["checked_at"] = now
+    return _ready["value"]
+
+
+def read(name, func):
+    # Executa a consulta na cópia e conta hits/misses. None é miss
+    if not is_ready():
+        return None
+
+    value = func()
+    metrics.incr(f"mirror.{name}.{'hits' if value is not None else 'misses'}")
+    return value
+
+
+def get_company_contact_by_cnpj(cnpj):
+    def query():
+        company = (
+            CompanyMirror.objects.select_related("contact")
+            .filter(cnpj=normalize_cnpj(cnpj))
+            .first()
+        )
+        if company is None:
+            return None
+        return {
+            "company": company.data.get("id"),
+            "digisac_contact": company.contact.data,
+        }
+
+    return read("company_contact", query)
+
+
+def get_company_by_id(company_id):
+    def query():
+        company = CompanyMirror.objects.filter(company_id=str(company_id)).first()
+        return company.data if company else None
+
+    return read("companies", query)
+
+
+def get_contact(digisac_id):
+    def query():
+        contact = ContactMirror.objects.filter(digisac_id=digisac_id).first()
+        return contact.data if contact else None
+
+    return read("contacts", query)
+
+
+def get_companies_by_contact(digisac_id):
+    # Mesmo formato de /contacts/digisac/all/{id}: [{"company": ..., "contact": ...}]
+    def query():
+        companies = list(
+            CompanyMirror.objects.select_related("contact").filter(
+                contact_id=digisac_id
+            )
+        )
+        if not companies:
+            return None
+        return [{"company": c.data, "contact": c.contact.data} for c in companies]
+
+    return read("contact_companies", query)
+
+
+##-- Escrita
+def normalize_cnpj(cnpj) -> str:
+    # Só os dígitos: a API e quem chama podem mandar com ou sem pontuação
+    return re.sub(r"\D", "", str(cnpj or ""))
+
+
+def get_cnpj(company) -> str:
+    return normalize_cnpj(company.get("cnpj_cpf") or company.get("cnpj"))
+
+
+def apply_entries(entries) -> tuple:
+    # entries: [{"company": {...}, "contact": {...}, "deleted": bool}]
+    # Retorna (atualizadas, apagadas)
+    contacts = {}
+    companies = {}
+    deleted = set()
+
+    for entry in entries:
+        company = entry["company"]
+        company_id = str(company["id"])
+        if entry.get("deleted"):
+            deleted.add(company_id)
+            continue
+
+        contact = entry["contact"]
+        contacts[contact["digisac_id"]] = ContactMirror(
+            digisac_id=contact["digisac_id"], data=contact
+        )
+        companies[company_id] = CompanyMirror(
+            company_id=company_id,
+            cnpj=get_cnpj(company),
+            contact_id=contact["digisac_id"],
+            data=company,
+        )
+
+    with transaction.atomic():
+        ContactMirror.objects.bulk_create(
+            contacts.values(),
+            update_conflicts=True,
+            unique_fields=["digisac_id"],
+            update_fields=["data", "synced_at"],
+        )
+        CompanyMirror.objects.bulk_create(
+            companies.values(),
+            update_conflicts=True,
+            unique_fields=["company_id"],
+            update_fields=["cnpj", "contact", "data", "synced_at"],
+        )
+        removed, _ = CompanyMirror.objects.filter(company_id__in=deleted).delete()
+
+    return len(companies), removed
+
+
+def save_companies_by_contact(entries):
+    # A resposta de /contacts/digisac/all/{id} vai direto pra cópia
+    if settings.COMPANIES_MIRROR_ENABLED and entries:
+        try:
+            apply_entries(entries)
+        except Exception as e:
+            logger.error(f"Falha ao salvar a resposta na cópia local: {e}")
+
+
+##-- Sincronização
+def fetch_page(updated_after, offset):
+    params = {"offset": offset, "limit": settings.COMPANIES_SYNC_PAGE_SIZE}
+    if updated_after:
+        params["updated_after"] = updated_after.isoformat()
+
+    client = http.get_client("companies_api", base_url=settings.COMPANIES_API)
+    response = resilience.call(
+        "companies_api", client.get, settings.COMPANIES_SYNC_URL, params=params
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def sync(full=False) -> CompaniesSync:
+    if not settings.COMPANIES_SYNC_URL:
+        raise ImproperlyConfigured("COMPANIES_SYNC_URL não configurada")
+
+    last = (
+        CompaniesSync.objects.filter(finished_at__isnull=False)
+        .order_by("-started_at")
+        .first()
+    )
+    # Sem sincronização anterior não dá para ser incremental
+    full = full or last is None
+    updated_after = None
+    if not full:
+        # Sobreposição para não perder alterações feitas durante a última
+        updated_after = last.started_at - timedelta(
+            seconds=settings.COMPANIES_SYNC_OVERLAP
+        )
+
+    run = CompaniesSync.objects.create(full=full, started_at=dt.now())
+    offset = 0
+    while True:
+        entries = fetch_page(updated_after, offset)
+        updated, deleted = apply_entries(entries)
+        run.updated += updated
+        run.deleted += deleted
+        offset += len(entries)
+        if len(entries) < settings.COMPANIES_SYNC_PAGE_SIZE:
+            break
+
+    if full:
+        # O que não veio na sincronização completa não existe mais na API
+        deleted, _ = CompanyMirror.objects.filter(synced_at__lt=run.started_at).delete()
+        run.deleted += deleted
+        ContactMirror.objects.filter(companies__isnull=True).delete()
+
+    run.finished_at = dt.now()
+    run.save()
+    logger.info(
+        f"Sincronização {'completa' if full else 'incremental'}: "
+        f"{run.updated} atualizadas, {run.deleted} apagadas"
+    )
+    return run
+
+
+def needs_full_sync() -> bool:
+    last_full = (
+        CompaniesSync.objects.filter(full=True, finished_at__isnull=False)
+        .order_by("-started_at")
+        .first()
+    )
+    if last_full is None:
+        return True
+    interval = timedelta(seconds=settings.COMPANIES_SYNC_FULL_INTERVAL)
+    return dt.now() - last_full.started_at > interval
+
+
+@shared_task(name="sync_companies_mirror")
+def sync_companies_mirror(full=False):
+    run = sync(full=full or needs_full_sync())
+    return f"{run.updated} atualizadas, {run.deleted} apagadas"
+
+
+def stats():
+    return {
+        "ready": is_ready(),
+        **{
+            name: {
+                "hits": metrics.get(f"mirror.{name}.hits"),
+                "misses": metrics.get(f"mirror.{name}.misses"),
+            }
+            for name in (
+                "company_contact",
+                "companies",
+                "contacts",
+                "contact_companies",
+            )
+        },
+    }
+
+
+metrics.register_provider("companies_mirror", stats)
@@ -0,0 +1,59 @@
+from celery import Task
+from django.conf import settings
+
+from webhook.exceptions import DependencyNotReady
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Eventos que chegam antes da linha de que dependem (ex.: ticket.updated antes
+# do ticket.created) não esperam dormindo dentro do worker: a task é agendada de
+# novo com backoff (countdown) e o worker fica livre. Depois de
+# DEPENDENCY_WAIT_DEADLINE segundos de espera o evento é descartado.
+
+
+def require(model, dependency=None, **lookup):
+    # Busca a linha ou levanta DependencyNotReady, sem esperar
+    obj = model.objects.filter(**lookup).first()
+    if obj is None:
+        raise DependencyNotReady(dependency or model.__name__, lookup)
+    return obj
+
+
+def get_countdown(attempt) -> float:
+    return min(
+        settings.DEPENDENCY_RETRY_MAX, settings.DEPENDENCY_RETRY_BASE * 2**attempt
+    )
+
+
+def get_waited(attempt) -> float:
+    # Quanto já foi esperado nas tentativas anteriores
+    return sum(get_countdown(previous) for previous in range(attempt))
+
+
+def park(task, error: DependencyNotReady, attempt, args, kwargs):
+    countdown = get_countdown(attempt)
+
+    if get_waited(attempt) + countdown > settings.DEPENDENCY_WAIT_DEADLINE:
+        metrics.incr(f"dependency.{task.name}.expired")
+        logger.error(f"{task.name} desistiu depois de {attempt} tentativas: {error}")
+        return f"Desistiu: {error}"
+
+    metrics.incr(f"dependency.{task.name}.parked")
+    task.apply_async(args=args, kwargs=kwargs, countdown=countdown, retries=attempt + 1)
+    return f"Aguardando: {error}. Nova tentativa em {countdown:.0f}s"
+
+
+class DependencyTask(Task):
+    # Base para tasks que dependem de linhas criadas por outros eventos. Vale
+    # também quando a task é chamada direto (dispatch inline, flush do coalesce)
+    def __call__(self, *args, **kwargs):
+        # Lido antes de chamar a task: fora do worker o __call__ do celery
+        # empilha um request novo
+        request = self.request
+        attempt = 0 if request.called_directly else request.retries
+        try:
+            return super().__call__(*args, **kwargs)
+        except DependencyNotReady as e:
+            return park(self, e, attempt, args, kwargs)
@@ -0,0 +1,88 @@
+from django.conf import settings
+
+from webhook.utils import metrics, tools
+from webhook.utils.cache import MISSING, TTLCache
+
+# Cache de leitura para GET /messages/{id} e /tickets/{id} da digisac. Cada
+# processo tem o seu, com TTL curto. Os webhooks message.updated e
+# ticket.updated trazem o estado novo e atualizam a entrada (ver observe).
+caches = {
+    "messages": TTLCache(
+        maxsize=settings.DIGISAC_CACHE_MAX_ENTRIES,
+        ttl=settings.DIGISAC_MESSAGE_CACHE_TTL,
+    ),
+    "tickets": TTLCache(
+        maxsize=settings.DIGISAC_CACHE_MAX_ENTRIES,
+        ttl=settings.DIGISAC_TICKET_CACHE_TTL,
+    ),
+}
+
+EVENT_RESOURCES = {
+    "message.updated": "messages",
+    "ticket.updated": "tickets",
+}
+
+
+##-- Leitura
+def fetch(resource, entity_id, fresh=False):
+    # Retorna o objeto da digisac (dict) ou None. Só respostas 200 vão pro cache.
+    # fresh=True sempre consulta a API (e atualiza o cache): o cache é do
+    # processo e não fica sabendo dos webhooks que caíram em outro
+    cache = caches[resource]
+    bypass = settings.DIGISAC_CACHE_BYPASS
+
+    if not bypass and not fresh:
+        value = cache.get(entity_id)
+        if value is not MISSING:
+            return value
+
+    response = tools.any_digisac_request(
+        f"/{resource}/{entity_id}", method="get", json=False
+    )
+    if response.status_code != 200:
+        return None
+
+    value = response.json()
+    if not bypass:
+        cache.set(entity_id, value)
+    return value
+
+
+def fetch_message(message_id, fresh=False):
+    return fetch("messages", message_id, fresh=fresh)
+
+
+def fetch_ticket(ticket_id, fresh=False):
+    return fetch("tickets", ticket_id, fresh=fresh)
+
+
+##-- Invalidação pelos webhooks
+def observe(event, data):
+    # Junta o payload do webhook na entrada que já está no cache. Entradas que
+    # não estão no cache ficam de fora: o payload pode não ter todos os campos.
+    resource = EVENT_RESOURCES.get(event)
+    if not resource or not isinstance(data, dict) or not data.get("id"):
+        return
+
+    cache = caches[resource]
+    cached = cache.get(data["id"])
+    if cached is MISSING:
+        return
+
+    if isinstance(cached, dict):
+        cache.set(data["id"], {**cached, **data})
+    else:
+        cache.delete(data["id"])
+
+
+def invalidate(resource, entity_id):
+    caches[resource].delete(entity_id)
+
+
+def stats():
+    data = {resource: cache.stats() for resource, cache in caches.items()}
+    data["bypass"] = settings.DIGISAC_CACHE_BYPASS
+    return data
+
+
+metrics.register_provider("digisac_cache", stats)
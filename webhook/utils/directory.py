@@ -0,0 +1,79 @@
+from django.conf import settings
+
+from webhook.exceptions import ContactNotFound, ObjectNotFound
+from webhook.utils import metrics
+from webhook.utils.cache import MISSING, TwoTierCache
+
+# Cache das consultas de contatos e empresas na companies api. Os dados mudam
+# pouco, então ficam no processo (L1) e no redis (L2, quando existe). Um
+# ContactNotFound/ObjectNotFound também é guardado, por menos tempo, para não
+# consultar de novo um contato que não existe a cada mensagem.
+caches = {
+    name: TwoTierCache(
+        f"directory:{name}",
+        maxsize=settings.DIRECTORY_CACHE_MAX_ENTRIES,
+        ttl=settings.DIRECTORY_CACHE_TTL,
+        shared=settings.DIRECTORY_CACHE_SHARED,
+        local_ttl=settings.DIRECTORY_CACHE_LOCAL_TTL,
+    )
+    for name in ("contacts", "companies", "contact_companies")
+}
+
+NOT_FOUND = "__not_found__"
+NOT_FOUND_ERRORS = {
+    "ContactNotFound": ContactNotFound,
+    "ObjectNotFound": ObjectNotFound,
+}
+
+
+##-- Leitura
+def lookup(name, key, loader):
+    # Lê do cache ou chama loader(). Erros de "não encontrado" também vão pro
+    # cache e são levantados de novo nas próximas leituras
+    cache = caches[name]
+    value = cache.get(key) if not settings.DIRECTORY_CACHE_BYPASS else MISSING
+
+    if value is MISSING:
+        metrics.incr(f"directory.{name}.misses")
+        try:
+            value = loader()
+        except (ContactNotFound, ObjectNotFound) as e:
+            cache.set(
+                key,
+                {NOT_FOUND: [type(e).__name__, str(e)]},
+                ttl=settings.DIRECTORY_NEGATIVE_TTL,
+            )
+            raise
+        cache.set(key, value)
+        return value
+
+    metrics.incr(f"directory.{name}.hits")
+    if isinstance(value, dict) and NOT_FOUND in value:
+        error, message = value[NOT_FOUND]
+        raise NOT_FOUND_ERRORS[error](message)
+    return value
+
+
+##-- Invalidação
+def invalidate_contact(digisac_id):
+    # O contato e a lista de empresas dele
+    caches["contacts"].delete(digisac_id)
+    caches["contact_companies"].delete(digisac_id)
+
+
+def invalidate_company(company_id):
+    caches["companies"].delete(str(company_id))
+
+
+def clear():
+    for cache in caches.values():
+        cache.local.clear()
+
+
+def stats():
+    data = {name: cache.stats() for name, cache in caches.items()}
+    data["bypass"] = settings.DIRECTORY_CACHE_BYPASS
+    return data
+
+
+metrics.register_provider("directory", stats)
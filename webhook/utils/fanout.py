@@ -0,0 +1,36 @@
+import asyncio
+
+from django.conf import settings
+
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+
+##-- Envio em paralelo com ordem por chave
+async def fan_out(sequences: dict, send, concurrency=None) -> dict:
+    # sequences: {chave: [item, ...]}, ex.: {contact_id: [saudação, pdf, disclaimer]}
+    # Chaves diferentes rodam em paralelo, no máximo "concurrency" ao mesmo tempo.
+    # Os itens de uma chave rodam em ordem e, se um falhar, o resto da sequência
+    # daquela chave não é enviado (não manda o disclaimer sem o PDF).
+    semaphore = asyncio.Semaphore(concurrency or settings.DIGISAC_SEND_CONCURRENCY)
+
+    async def run(key, items):
+        result = {"sent": 0, "total": len(items), "error": None}
+
+        async with semaphore:
+            for item in items:
+                try:
+                    await send(key, item)
+                    result["sent"] += 1
+                except Exception as e:
+                    logger.error(f"Falha no envio para {key}: {e}")
+                    result["error"] = e
+                    break
+
+        return key, result
+
+    results = await asyncio.gather(
+        *(run(key, items) for key, items in sequences.items())
+    )
+    return dict(results)
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from django.conf import settings
+
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+from webhook.utils.threads import with_db_connections
+
+logger = Logger(__name__)
+
+# Consultas independentes às APIs externas rodando ao mesmo tempo num pool de
+# threads do processo. O tempo total fica perto da consulta mais lenta em vez
+# da soma de todas.
+_lock = threading.Lock()
+_executor = {}
+_timings = defaultdict(lambda: deque(maxlen=1000))
+
+
+def get_executor() -> ThreadPoolExecutor:
+    with _lock:
+        if "pool" not in _executor:
+            _executor["pool"] = ThreadPoolExecutor(
+                max_workers=settings.UPSTREAM_GATHER_WORKERS,
+                thread_name_prefix="upstream",
+            )
+        return _executor["pool"]
+
+
+def reset_executor():
+    # As threads do pool não existem no processo filho depois do fork
+    global _lock
+    _lock = threading.Lock()
+    _executor.clear()
+
+
+os.register_at_fork(after_in_child=reset_executor)
+
+
+##-- Consultas
+def timed(name, func, *args, **kwargs):
+    # Executa uma consulta registrando quanto tempo ela levou
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        _timings[name].append(elapsed)
+        logger.debug(f"Consulta {name} levou {elapsed:.0f}ms")
+
+
+def submit(name, func, *args, **kwargs) -> Future:
+    # Começa uma consulta em segundo plano, o resultado vem em future.result().
+    # As consultas podem ler o banco (cópia local, controles), e as threads do
+    # pool não passam pelo fechamento de conexões do fim da requisição
+    return get_executor().submit(
+        with_db_connections(timed), name, func, *args, **kwargs
+    )
+
+
+def gather_upstream_context(lookups: dict) -> dict:
+    # lookups: {nome: função sem argumentos ou Future de submit()}
+    # Espera todas terminarem e devolve {nome: resultado}. Se alguma falhar
+    # levanta o erro da primeira na ordem de lookups.
+    started = time.perf_counter()
+    futures = {
+        name: lookup if isinstance(lookup, Future) else submit(name, lookup)
+        for name, lookup in lookups.items()
+    }
+    wait(futures.values())
+
+    elapsed = (time.perf_counter() - started) * 1000
+    logger.debug(f"Consultas {', '.join(futures)} em {elapsed:.0f}ms")
+    return {name: future.result() for name, future in futures.items()}
+
+
+def stats():
+    return {
+        name: metrics.summarize_latencies(list(timings))
+        for name, timings in list(_timings.items())
+    }
+
+
+metrics.register_provider("gather", stats)
@@ -1,28 +1,65 @@
 import os
-import time
 from datetime import datetime
 from typing import Union
 
 import dotenv
 import httpx
 from django.conf import settings
-from django.http import Http404
-from django.shortcuts import get_object_or_404
 
 from control.models import DASFileGrouping, MessageControl, TicketLink
 from messages_api.models import Message, Ticket
 from webhook.exceptions import ContactNotFound, ObjectNotFound
+from webhook.utils import (
+    companies_mirror,
+    directory,
+    http,
+    pendencies_cache,
+    resilience,
+    singleflight,
+)
+from webhook.utils.dependencies import require
 
 dotenv.load_dotenv()
 
-max_retries = 3
-att_tax = 0.1
 COMPANIES_API = settings.COMPANIES_API
 ROUTINE_RUNNER_URL = os.getenv("ROUTINE_RUNNER_URL")
+UPSTREAMS = {
+    "companies_api": COMPANIES_API,
+    "routine_runner": ROUTINE_RUNNER_URL,
+}
+
+
+def upstream_get(dependency, url, **kwargs):
+    # GET numa API externa com timeout, circuit breaker e retry com backoff
+    # (ver webhook/utils/resilience.py). GETs iguais ao mesmo tempo viram um só
+    if settings.SINGLEFLIGHT_ENABLED:
+        key = f"{dependency}:{url}:{sorted((kwargs.get('params') or {}).items())}"
+        return singleflight.do(key, upstream_get_now, dependency, url, **kwargs)
+
+    return upstream_get_now(dependency, url, **kwargs)
+
+
+def upstream_get_now(dependency, url, **kwargs):
+    client = get_upstream_client(dependency)
+    return resilience.call(dependency, client.get, url, **kwargs)
+
+
+def get_upstream_client(dependency) -> httpx.Client:
+    # Um cliente com pool de conexões por API (ver webhook/utils/http.py).
+    # As URLs das funções abaixo são relativas ao base_url da dependência.
+    return http.get_client(dependency, base_url=UPSTREAMS[dependency])
 
 
 def get_contact_pendencies(cnpj: str):
-    response = httpx.get(f"{ROUTINE_RUNNER_URL}/mei/competences", params={"cnpj": cnpj})
+    return pendencies_cache.lookup(cnpj, lambda: fetch_contact_pendencies(cnpj))
+
+
+def warm_contact_pendencies(cnpjs) -> int:
+    return pendencies_cache.warm_up(cnpjs, fetch_contact_pendencies)
+
+
+def fetch_contact_pendencies(cnpj: str):
+    response = upstream_get("routine_runner", "/mei/competences", params={"cnpj": cnpj})
 
     if response.status_code == 200:
         pendencies = response.json()
@@ -37,7 +74,11 @@ def get_contact_pendencies(cnpj: str):
 
 
 def get_company_contact_by_cnpj(cnpj: Union[str, int], **kwargs):
-    request = httpx.get(f"{COMPANIES_API}/contacts/{cnpj}")
+    mirrored = companies_mirror.get_company_contact_by_cnpj(cnpj)
+    if mirrored is not None:
+        return mirrored
+
+    request = upstream_get("companies_api", f"/contacts/{cnpj}")
 
     if request.status_code == 200:
         return request.json()
@@ -47,7 +88,7 @@ def get_company_contact_by_cnpj(cnpj: Union[str, int], **kwargs):
 
 
 def get_company_data_by_digisac_id(digisac_id):
-    response = httpx.get(f"{COMPANIES_API}/contacts/company-data/{digisac_id}")
+    response = upstream_get("companies_api", f"/contacts/company-data/{digisac_id}")
 
     if response.status_code == 200:
         return response.json()
@@ -56,7 +97,17 @@ def get_company_data_by_digisac_id(digisac_id):
 
 
 def get_company_name_by_id(company_id):
-    response = httpx.get(f"{COMPANIES_API}/companies/id/{company_id}")
+    return directory.lookup(
+        "companies", str(company_id), lambda: fetch_company_by_id(company_id)
+    )
+
+
+def fetch_company_by_id(company_id):
+    mirrored = companies_mirror.get_company_by_id(company_id)
+    if mirrored is not None:
+        return mirrored
+
+    response = upstream_get("companies_api", f"/companies/id/{company_id}")
 
     if response.status_code == 200:
         return response.json()
@@ -65,16 +116,40 @@ def get_company_name_by_id(company_id):
 
 
 def get_all_companies_by_digisac_contact(digisac_id):
-    response = httpx.get(f"{COMPANIES_API}/contacts/digisac/all/{digisac_id}")
+    return directory.lookup(
+        "contact_companies",
+        digisac_id,
+        lambda: fetch_all_companies_by_digisac_contact(digisac_id),
+    )
+
+
+def fetch_all_companies_by_digisac_contact(digisac_id):
+    mirrored = companies_mirror.get_companies_by_contact(digisac_id)
+    if mirrored is not None:
+        return mirrored
+
+    response = upstream_get("companies_api", f"/contacts/digisac/all/{digisac_id}")
 
     if response.status_code == 200:
-        return response.json()
+        companies = response.json()
+        companies_mirror.save_companies_by_contact(companies)
+        return companies
 
     raise ContactNotFound(f"This DigisacContact for {digisac_id} not exists")
 
 
 def get_digisac_contact_by_id(contact_id: str, **kwargs):
-    request = httpx.get(f"{COMPANIES_API}/contacts/digisac/{contact_id}")
+    return directory.lookup(
+        "contacts", contact_id, lambda: fetch_digisac_contact_by_id(contact_id)
+    )
+
+
+def fetch_digisac_contact_by_id(contact_id: str):
+    mirrored = companies_mirror.get_contact(contact_id)
+    if mirrored is not None:
+        return mirrored
+
+    request = upstream_get("companies_api", f"/contacts/digisac/{contact_id}")
 
     if request.status_code == 200:
         return request.json()
@@ -84,81 +159,33 @@ def get_digisac_contact_by_id(contact_id: str, **kwargs):
 
 
 def get_all_contact_by_digisac_id(digisac_id: str, **kwargs):
-    request = httpx.get(f"{COMPANIES_API}/contacts/digisac/all/{digisac_id}")
-
-    if request.status_code == 200:
-        return request.json()
-        # return DictAsObject(request.json())
-
-    raise ContactNotFound(f"Anyone contact for id:{digisac_id} not found")
+    # Mesma consulta de get_all_companies_by_digisac_contact
+    try:
+        return get_all_companies_by_digisac_contact(digisac_id)
+    except ContactNotFound:
+        raise ContactNotFound(f"Anyone contact for id:{digisac_id} not found")
 
 
 def get_message_control(**kwargs):
-    retries = 0
-    while retries < max_retries:
-        try:
-            control = get_object_or_404(MessageControl, **kwargs)
-            return control
-        except Http404:
-            time.sleep(att_tax)
-            retries += 1
-    return None
+    return MessageControl.objects.filter(**kwargs).first()
 
 
 def get_ticket_link(**kwargs):
-    retries = 0
-    while retries < max_retries:
-        try:
-            ticket_link = get_object_or_404(TicketLink, **kwargs)
-            return ticket_link
-        except Http404:
-            time.sleep(att_tax)
-            retries += 1
-    return None
+    return TicketLink.objects.filter(**kwargs).first()
 
 
 def get_message(**kwargs):
-    retries = 0
-    while retries < max_retries:
-        try:
-            message = get_object_or_404(Message, **kwargs)
-            return message
-        except Http404:
-            time.sleep(att_tax)
-            retries += 1
-
-    return None
-    # raise ObjectNotFound(f"Anyone message for {kwargs.get('message_id')} not found")
+    return Message.objects.filter(**kwargs).first()
 
 
 def get_valid_ticket(ticket_id):
-    retries = 0
-    while retries <= 50:
-        try:
-            ticket = get_object_or_404(Ticket, ticket_id=ticket_id)
-            return ticket
-        except Http404:
-            time.sleep(0.5)
-            retries += 1
-    return None
+    # Levanta DependencyNotReady se o ticket.created ainda não foi processado
+    return require(Ticket, "Ticket", ticket_id=ticket_id)
 
 
 def get_ticket(**kwargs):
-    retries = 0
-    while retries <= max_retries:
-        try:
-            ticket = get_object_or_404(Ticket, **kwargs)
-            return ticket
-        except Http404:
-            time.sleep(att_tax)
-            retries += 1
-    return None
+    return Ticket.objects.filter(**kwargs).first()
 
 
 def get_das_grouping(**kwargs):
-    while True:
-        try:
-            grouping = get_object_or_404(DASFileGrouping, **kwargs)
-            return grouping
-        except Http404:
-            time.sleep(att_tax)
+    return require(DASFileGrouping, "DASFileGrouping", **kwargs)
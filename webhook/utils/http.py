@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+import httpx
+from django.conf import settings
+
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Um cliente httpx por dependência externa, compartilhado pelo processo todo.
+# Mantém as conexões abertas (keep-alive) entre as chamadas em vez de refazer
+# DNS, TCP e TLS a cada requisição.
+_lock = threading.Lock()
+_clients = {}
+_instrumented = set()
+_endpoints = defaultdict(
+    lambda: defaultdict(
+        lambda: {"statuses": Counter(), "latencies": deque(maxlen=1000)}
+    )
+)
+
+
+##-- Clientes
+def get_client(name, base_url="", headers=None) -> httpx.Client:
+    # base_url e headers só são usados na criação do cliente
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        if name not in _clients:
+            _clients[name] = build_client(name, base_url=base_url, headers=headers)
+        return _clients[name]
+
+
+def build_client(name, base_url="", headers=None) -> httpx.Client:
+    return httpx.Client(
+        base_url=base_url or "",
+        headers=headers,
+        limits=get_limits(),
+        timeout=get_timeout(),
+        http2=http2_enabled(),
+        event_hooks=instrument(name),
+    )
+
+
+def build_async_client(name, base_url="", headers=None) -> httpx.AsyncClient:
+    # O AsyncClient fica preso ao event loop que o criou, então não entra no
+    # registro: cada execução (asyncio.run) cria o seu e fecha no final
+    return httpx.AsyncClient(
+        base_url=base_url or "",
+        headers=headers,
+        limits=get_limits(),
+        timeout=get_timeout(),
+        http2=http2_enabled(),
+        event_hooks=instrument(name, is_async=True),
+    )
+
+
+def get_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=settings.HTTP_CONNECT_TIMEOUT,
+        read=settings.HTTP_READ_TIMEOUT,
+        write=settings.HTTP_READ_TIMEOUT,
+        pool=settings.HTTP_POOL_TIMEOUT,
+    )
+
+
+def http2_enabled() -> bool:
+    if not settings.HTTP2_ENABLED:
+        return False
+
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.error("HTTP2_ENABLED ligado mas o pacote h2 não está instalado")
+        return False
+    return True
+
+
+def reset_clients():
+    # Depois do fork (workers do gunicorn e prefork do celery) o filho não pode
+    # reaproveitar os sockets do pai. Só descarta, quem fecha é o processo pai.
+    global _lock
+    _lock = threading.Lock()
+    _clients.clear()
+    _endpoints.clear()
+
+
+os.register_at_fork(after_in_child=reset_clients)
+
+
+def close_clients():
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+##-- Métricas de conexão, latência e status por endpoint
+def instrument(name, is_async=False) -> dict:
+    # event_hooks do cliente: conta conexões novas (reaproveitamento do pool) e
+    # registra latência e status de cada endpoint
+    _instrumented.add(name)
+
+    def trace(event_name, info):
+        # Evento do httpcore disparado só quando abre uma conexão nova
+        if event_name == "connection.connect_tcp.complete":
+            metrics.incr(f"http.{name}.connections")
+
+    async def atrace(event_name, info):
+        trace(event_name, info)
+
+    def on_request(request: httpx.Request):
+        metrics.incr(f"http.{name}.requests")
+        request.extensions["trace"] = trace
+        request.extensions["started"] = time.perf_counter()
+
+    async def aon_request(request: httpx.Request):
+        on_request(request)
+        request.extensions["trace"] = atrace
+
+    def on_response(response: httpx.Response):
+        record_response(name, response)
+
+    async def aon_response(response: httpx.Response):
+        record_response(name, response)
+
+    if is_async:
+        return {"request": [aon_request], "response": [aon_response]}
+    return {"request": [on_request], "response": [on_response]}
+
+
+def endpoint_label(request: httpx.Request) -> str:
+    # GET /contacts/digisac/123 -> GET /contacts/digisac/{id}
+    parts = [
+        "{id}" if any(char.isdigit() for char in part) else part
+        for part in request.url.path.split("/")
+    ]
+    return f"{request.method} {'/'.join(parts)}"
+
+
+def record_response(name, response: httpx.Response):
+    # O hook roda quando chegam os headers: a latência não inclui ler o corpo
+    started = response.request.extensions.get("started")
+    endpoint = endpoint_label(response.request)
+    with _lock:
+        stats = _endpoints[name][endpoint]
+        stats["statuses"][response.status_code] += 1
+        if started is not None:
+            stats["latencies"].append((time.perf_counter() - started) * 1000)
+
+
+def endpoint_stats(name) -> dict:
+    with _lock:
+        endpoints = {
+            endpoint: (dict(stats["statuses"]), list(stats["latencies"]))
+            for endpoint, stats in _endpoints[name].items()
+        }
+    return {
+        endpoint: {
+            "statuses": statuses,
+            "latency_ms": metrics.summarize_latencies(latencies),
+        }
+        for endpoint, (statuses, latencies) in endpoints.items()
+    }
+
+
+def connection_stats():
+    stats = {}
+    for name in sorted(_instrumented):
+        requests = metrics.get(f"http.{name}.requests")
+        connections = metrics.get(f"http.{name}.connections")
+        stats[name] = {
+            "requests": requests,
+            "connections": connections,
+            "reuse_rate": round(1 - connections / requests, 3) if requests else 0.0,
+            "endpoints": endpoint_stats(name),
+        }
+    return stats
+
+
+metrics.register_provider("http", connection_stats)
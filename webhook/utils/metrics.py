@@ -0,0 +1,80 @@
+import math
+import os
+import threading
+from collections import defaultdict
+
+# Contadores do processo atual (web ou worker do celery). Cada processo tem os
+# seus, o endpoint /webhook/metrics mostra os do processo web que atendeu.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_providers = {}
+
+
+##-- Contadores
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def reset_after_fork():
+    # O filho (worker do gunicorn/celery) não herda os números do pai
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def get(name):
+    return _counters.get(name, 0)
+
+
+def incr_shared(key, value=1, timeout=60 * 60 * 48):
+    # Contador no cache default (compartilhado entre web e workers com REDIS_URL)
+    from django.core.cache import cache
+
+    cache.add(key, 0, timeout=timeout)
+    try:
+        cache.incr(key, value)
+    except ValueError:
+        # A chave expirou entre o add e o incr
+        cache.add(key, value, timeout=timeout)
+
+
+def register_provider(name, func):
+    # Para estatísticas que já vivem em outro lugar (caches, breakers, etc.)
+    _providers[name] = func
+
+
+def snapshot(reset=False):
+    with _lock:
+        data = {"counters": dict(sorted(_counters.items()))}
+        if reset:
+            _counters.clear()
+
+    for name, func in _providers.items():
+        data[name] = func()
+
+    return data
+
+
+##-- Estatísticas de latência
+def percentile(values, p):
+    # Percentil pelo método nearest-rank. Espera os valores em qualquer ordem
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_latencies(latencies_ms):
+    return {
+        "count": len(latencies_ms),
+        "p50": round(percentile(latencies_ms, 50), 2),
+        "p95": round(percentile(latencies_ms, 95), 2),
+        "p99": round(percentile(latencies_ms, 99), 2),
+        "max": round(max(latencies_ms), 2) if latencies_ms else 0.0,
+    }
@@ -0,0 +1,90 @@
+from datetime import datetime as dt
+
+from django.conf import settings
+
+from webhook.utils import gather, metrics
+from webhook.utils.cache import MISSING, TwoTierCache
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Cache das pendências (competences do routine runner) por cnpj e período. As
+# pendências mudam poucas vezes no mês, então a entrada vale até o fim do TTL
+# ou até ser invalidada. Só listas vão pro cache, falhas (False) não.
+cache = TwoTierCache(
+    "pendencies",
+    maxsize=settings.PENDENCIES_CACHE_MAX_ENTRIES,
+    ttl=settings.PENDENCIES_CACHE_TTL,
+    shared=settings.PENDENCIES_CACHE_SHARED,
+    local_ttl=settings.PENDENCIES_CACHE_LOCAL_TTL,
+)
+
+
+def get_period() -> str:
+    return dt.today().strftime("%Y-%m")
+
+
+def cache_key(cnpj, period=None) -> str:
+    return f"{cnpj}:{period or get_period()}"
+
+
+##-- Leitura
+def lookup(cnpj, loader):
+    # Lê do cache ou chama loader() (a consulta ao routine runner)
+    if settings.PENDENCIES_CACHE_BYPASS:
+        return loader()
+
+    key = cache_key(cnpj)
+    value = cache.get(key)
+    if value is not MISSING:
+        metrics.incr("pendencies.hits")
+        return value
+
+    metrics.incr("pendencies.misses")
+    value = loader()
+    if value is not False:
+        cache.set(key, value)
+    return value
+
+
+def warm_up(cnpjs, loader) -> int:
+    # Busca ao mesmo tempo as pendências dos cnpjs que ainda não estão no
+    # cache, ex.: antes de uma campanha de DAS. Retorna quantos foram buscados.
+    if settings.PENDENCIES_CACHE_BYPASS:
+        return 0
+
+    missing = {cnpj for cnpj in cnpjs if cache.get(cache_key(cnpj)) is MISSING}
+    futures = {
+        cnpj: gather.submit("pendencies", lookup, cnpj, lambda c=cnpj: loader(c))
+        for cnpj in missing
+    }
+
+    for cnpj, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            # Quem precisar das pendências tenta de novo na hora do envio
+            logger.error(f"Falha ao buscar as pendências de {cnpj}: {e}")
+
+    return len(futures)
+
+
+##-- Invalidação
+def invalidate(cnpj, period=None):
+    cache.delete(cache_key(cnpj, period))
+
+
+def stats():
+    # hits/misses de lookup: o cache.get do warm_up não entra na conta
+    hits = metrics.get("pendencies.hits")
+    misses = metrics.get("pendencies.misses")
+    return {
+        **cache.stats(),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        "bypass": settings.PENDENCIES_CACHE_BYPASS,
+    }
+
+
+metrics.register_provider("pendencies", stats)
@@ -0,0 +1,199 @@
+import asyncio
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime as dt
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Token bucket por endpoint da digisac. Com REDIS_URL o bucket fica no redis e
+# vale para todos os processos (web e workers), sem ele cada processo tem o seu.
+# Cada chamada reserva um token e espera a vez, então ninguém é recusado: o
+# excesso vira fila.
+ENDPOINTS = [
+    (re.compile(r"^POST /messages$"), "send"),
+    (re.compile(r"^POST /contacts/[^/]+/ticket/"), "tickets"),
+]
+
+# KEYS[1] = bucket, KEYS[2] = pausa do endpoint (Retry-After)
+# ARGV[1] = tokens por segundo, ARGV[2] = tamanho do bucket
+# Retorna os segundos que o chamador deve esperar
+RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+local wait = 0
+if tokens < 0 then wait = -tokens / rate end
+local paused = redis.call('PTTL', KEYS[2])
+if paused > 0 then wait = wait + paused / 1000 end
+return tostring(wait)
+"""
+
+_lock = threading.Lock()
+_local_buckets = {}
+_local_pauses = {}
+_waits = defaultdict(lambda: deque(maxlen=1000))
+_redis = {}
+
+
+##-- Budgets
+def endpoint_name(method, url) -> str:
+    request_line = f"{str(method).upper()} {url.split('?')[0]}"
+    for pattern, name in ENDPOINTS:
+        if pattern.match(request_line):
+            return name
+    return "default"
+
+
+def get_budget(name):
+    limits = settings.DIGISAC_RATE_LIMITS
+    return limits.get(name, limits["default"])
+
+
+##-- Reserva de tokens
+def get_redis():
+    if "client" not in _redis:
+        import redis
+
+        client = redis.Redis.from_url(settings.REDIS_URL)
+        _redis["client"] = client
+        _redis["reserve"] = client.register_script(RESERVE_SCRIPT)
+    return _redis["reserve"]
+
+
+def reserve(name) -> float:
+    rate, burst = get_budget(name)
+
+    if settings.REDIS_URL:
+        try:
+            keys = [f"ratelimit:{name}", f"ratelimit:{name}:paused"]
+            return float(get_redis()(keys=keys, args=[rate, burst]))
+        except Exception as e:
+            # Sem redis o limite continua valendo, só que por processo
+            logger.error(f"Rate limit no redis indisponível, usando o local: {e}")
+
+    return reserve_local(name, rate, burst)
+
+
+def reserve_local(name, rate, burst) -> float:
+    with _lock:
+        now = time.monotonic()
+        tokens, ts = _local_buckets.get(name, (burst, now))
+        tokens = min(burst, tokens + (now - ts) * rate) - 1
+        _local_buckets[name] = (tokens, now)
+
+        wait = -tokens / rate if tokens < 0 else 0.0
+        paused_until = _local_pauses.get(name, 0)
+        if paused_until > now:
+            wait += paused_until - now
+        return wait
+
+
+def acquire(name):
+    if not settings.DIGISAC_RATE_LIMIT_ENABLED:
+        return 0.0
+
+    wait = reserve(name)
+    record_wait(name, wait)
+    if wait > 0:
+        time.sleep(wait)
+    return wait
+
+
+async def aacquire(name):
+    if not settings.DIGISAC_RATE_LIMIT_ENABLED:
+        return 0.0
+
+    wait = reserve(name)
+    record_wait(name, wait)
+    if wait > 0:
+        await asyncio.sleep(wait)
+    return wait
+
+
+def pause(name, seconds):
+    # Segura o endpoint inteiro (todos os processos) depois de um 429/5xx
+    if seconds <= 0:
+        return
+
+    if settings.REDIS_URL:
+        try:
+            get_redis()
+            _redis["client"].set(f"ratelimit:{name}:paused", 1, px=int(seconds * 1000))
+            return
+        except Exception as e:
+            logger.error(f"Falha ao pausar {name} no redis: {e}")
+
+    with _lock:
+        _local_pauses[name] = time.monotonic() + seconds
+
+
+##-- Respostas de throttling
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+def is_throttled(response, method="GET") -> bool:
+    # 429 é recusado antes de processar, então qualquer método pode repetir. Um
+    # 5xx num POST pode vir depois de a digisac ter aceito a mensagem (502/504
+    # do proxy), e repetir mandaria a mesma mensagem duas vezes para o cliente
+    if response.status_code == 429:
+        return True
+    return response.status_code >= 500 and method.upper() in IDEMPOTENT_METHODS
+
+
+def get_retry_delay(response, attempt) -> float:
+    # Usa o Retry-After (segundos ou data HTTP) quando vier, senão backoff exponencial
+    retry_after = response.headers.get("Retry-After")
+
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - dt.now(retry_at.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+
+    return min(settings.DIGISAC_BACKOFF_MAX, settings.DIGISAC_BACKOFF_BASE * 2**attempt)
+
+
+##-- Métricas
+def record_wait(name, wait):
+    metrics.incr(f"ratelimit.{name}.requests")
+    if wait > 0:
+        metrics.incr(f"ratelimit.{name}.waited")
+    _waits[name].append(wait * 1000)
+
+
+def record_throttled(name):
+    metrics.incr(f"ratelimit.{name}.throttled")
+
+
+def stats():
+    data = {}
+    for name, waits in list(_waits.items()):
+        data[name] = {
+            "budget": dict(zip(("rate", "burst"), get_budget(name))),
+            "throttled": metrics.get(f"ratelimit.{name}.throttled"),
+            "wait_ms": metrics.summarize_latencies(list(waits)),
+        }
+    return data
+
+
+metrics.register_provider("ratelimit", stats)
@@ -0,0 +1,274 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+from django.conf import settings
+
+from webhook.exceptions import CircuitOpenError
+from webhook.utils import metrics
+from webhook.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Camada comum para chamadas a APIs externas (digisac, companies api, routine
+# runner): circuit breaker por dependência, orçamento de retries e backoff
+# exponencial com jitter. Quando uma dependência está fora, as chamadas falham
+# na hora em vez de prender os workers do celery esperando socket.
+RETRYABLE_EXCEPTIONS = (httpx.TransportError,)
+# Falhas em que a requisição com certeza não saiu: as únicas que dá para repetir
+# num POST sem correr o risco de a digisac receber a mesma mensagem duas vezes
+# (ReadTimeout e RemoteProtocolError podem vir depois de ela ter processado)
+NOT_SENT_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+_lock = threading.Lock()
+_breakers = {}
+_budgets = {}
+
+
+##-- Circuit breaker
+class CircuitBreaker:
+    # closed: tudo passa. open: tudo falha na hora até reset_timeout.
+    # half_open: deixa uma chamada de teste passar, se der certo fecha de novo.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self.rejected = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_running = False
+
+            if self.state == self.HALF_OPEN:
+                if self._trial_running:
+                    self.rejected += 1
+                    return False
+                self._trial_running = True
+
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    logger.error(f"Circuit breaker de {self.name} aberto")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def retry_in(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "retry_in": round(self.retry_in(), 1),
+        }
+
+
+##-- Orçamento de retries
+class RetryBudget:
+    # Limita os retries a uma fração das chamadas da janela, para que uma
+    # dependência fora do ar não multiplique a carga por max_retries
+    def __init__(self, ratio=0.2, window=10, min_retries=3):
+        self.ratio = ratio
+        self.window = window
+        self.min_retries = min_retries
+        self.requests = deque()
+        self.retries = deque()
+        self.exhausted = 0
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        for events in (self.requests, self.retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        with self._lock:
+            self.requests.append(time.monotonic())
+
+    def can_retry(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = max(self.min_retries, self.ratio * len(self.requests))
+
+            if len(self.retries) >= allowed:
+                self.exhausted += 1
+                return False
+
+            self.retries.append(now)
+            return True
+
+    def stats(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {
+                "requests": len(self.requests),
+                "retries": len(self.retries),
+                "exhausted": self.exhausted,
+            }
+
+
+def get_breaker(name) -> CircuitBreaker:
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=settings.BREAKER_RESET_TIMEOUT,
+            )
+        return _breakers[name]
+
+
+def get_retry_budget(name) -> RetryBudget:
+    with _lock:
+        if name not in _budgets:
+            _budgets[name] = RetryBudget(
+                ratio=settings.RETRY_BUDGET_RATIO,
+                window=settings.RETRY_BUDGET_WINDOW,
+                min_retries=settings.RETRY_BUDGET_MIN,
+            )
+        return _budgets[name]
+
+
+def backoff(attempt) -> float:
+    # Full jitter: espera aleatória entre 0 e o teto exponencial
+    ceiling = min(settings.RETRY_BACKOFF_MAX, settings.RETRY_BACKOFF_BASE * 2**attempt)
+    return random.uniform(0, ceiling)
+
+
+##-- Execução
+def is_failure(result) -> bool:
+    return isinstance(result, httpx.Response) and result.status_code >= 500
+
+
+def should_retry(name, attempt, result, retry_statuses) -> bool:
+    if attempt >= settings.RETRY_MAX_ATTEMPTS:
+        return False
+    if isinstance(result, httpx.Response) and result.status_code not in retry_statuses:
+        return False
+    if not get_retry_budget(name).can_retry():
+        metrics.incr(f"resilience.{name}.budget_exhausted")
+        return False
+
+    metrics.incr(f"resilience.{name}.retries")
+    return True
+
+
+def check_breaker(name):
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        metrics.incr(f"resilience.{name}.rejected")
+        raise CircuitOpenError(
+            f"{name} indisponível, nova tentativa em {breaker.retry_in():.0f}s"
+        )
+    get_retry_budget(name).record_request()
+    return breaker
+
+
+def record_result(breaker, result):
+    if is_failure(result):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def is_retryable(error, idempotent) -> bool:
+    return isinstance(
+        error, RETRYABLE_EXCEPTIONS if idempotent else NOT_SENT_EXCEPTIONS
+    )
+
+
+def handle_error(name, breaker, attempt, error, retry_statuses, idempotent):
+    # Qualquer exceção (DecodingError, SoftTimeLimitExceeded...) conta como
+    # falha e libera a chamada de teste do half_open. Se não for repetida,
+    # sobe para quem chamou
+    breaker.record_failure()
+    if not is_retryable(error, idempotent) or not should_retry(
+        name, attempt, None, retry_statuses
+    ):
+        raise error
+    logger.error(f"Falha de rede em {name}, tentando de novo: {error}")
+
+
+def call(name, func, *args, retry_statuses=(502, 503, 504), idempotent=True, **kwargs):
+    # Executa func (uma chamada HTTP) protegida pelo breaker da dependência.
+    # Repete erros de rede e os status de retry_statuses com backoff. Com
+    # idempotent=False (POST) só repete se a requisição não chegou a sair.
+    attempt = 0
+    while True:
+        breaker = check_breaker(name)
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            handle_error(name, breaker, attempt, e, retry_statuses, idempotent)
+        else:
+            record_result(breaker, result)
+            if not should_retry(name, attempt, result, retry_statuses):
+                return result
+
+        time.sleep(backoff(attempt))
+        attempt += 1
+
+
+async def acall(
+    name, func, *args, retry_statuses=(502, 503, 504), idempotent=True, **kwargs
+):
+    attempt = 0
+    while True:
+        breaker = check_breaker(name)
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            handle_error(name, breaker, attempt, e, retry_statuses, idempotent)
+        else:
+            record_result(breaker, result)
+            if not should_retry(name, attempt, result, retry_statuses):
+                return result
+
+        await asyncio.sleep(backoff(attempt))
+        attempt += 1
+
+
+def stats():
+    return {
+        name: {**breaker.stats(), "retry_budget": get_retry_budget(name).stats()}
+        for name, breaker in list(_breakers.items())
+    }
+
+
+metrics.register_provider("breakers", stats)
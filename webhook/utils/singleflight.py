@@ -0,0 +1,126 @@
+import base64
+import threading
+import time
+
+import httpx
+from django.conf import settings
+from django.core.cache import cache
+
+from webhook.utils import metrics
+from webhook.utils.cache import shared_cache_available
+
+# GETs idênticos que chegam ao mesmo tempo compartilham uma única requisição.
+# No processo: quem chega primeiro faz a chamada e os outros esperam o resultado.
+# Entre processos (SINGLEFLIGHT_SHARED com REDIS_URL): um lock no cache elege quem
+# chama e a resposta fica no cache por alguns segundos para os outros processos.
+_lock = threading.Lock()
+_calls = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def do(key, func, *args, **kwargs) -> httpx.Response:
+    with _lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _calls[key] = _Call()
+
+    if not leader:
+        metrics.incr("singleflight.avoided_local")
+        call.done.wait()
+        if call.error:
+            raise call.error
+        return call.result
+
+    try:
+        call.result = run_shared(key, func, *args, **kwargs)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _calls.pop(key, None)
+        call.done.set()
+
+
+def run_shared(key, func, *args, **kwargs):
+    metrics.incr("singleflight.calls")
+
+    if not (settings.SINGLEFLIGHT_SHARED and shared_cache_available()):
+        return func(*args, **kwargs)
+
+    lock_key = f"singleflight:lock:{key}"
+    result_key = f"singleflight:result:{key}"
+    timeout = settings.SINGLEFLIGHT_LOCK_TIMEOUT
+
+    if not cache.add(lock_key, 1, timeout=timeout):
+        # Outro processo está buscando: espera a resposta dele
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            found = cache.get(result_key)
+            if found is not None:
+                metrics.incr("singleflight.avoided_remote")
+                return load_response(found)
+            if cache.get(lock_key) is None:
+                break
+            time.sleep(settings.SINGLEFLIGHT_POLL_INTERVAL)
+
+        # O dono do lock falhou ou demorou demais: busca por conta própria
+        return func(*args, **kwargs)
+
+    try:
+        cache.delete(result_key)
+        response = func(*args, **kwargs)
+        cache.set(
+            result_key,
+            dump_response(response),
+            timeout=settings.SINGLEFLIGHT_RESULT_TTL,
+        )
+        return response
+    finally:
+        cache.delete(lock_key)
+
+
+##-- Serialização da resposta para o cache
+def dump_response(response: httpx.Response) -> dict:
+    return {
+        "status_code": response.status_code,
+        "headers": dict(response.headers),
+        "content": base64.b64encode(response.content).decode(),
+    }
+
+
+def load_response(data) -> httpx.Response:
+    headers = {
+        key: value
+        for key, value in data["headers"].items()
+        # O conteúdo já está descomprimido
+        if key.lower() not in ("content-encoding", "content-length")
+    }
+    return httpx.Response(
+        data["status_code"],
+        headers=headers,
+        content=base64.b64decode(data["content"]),
+    )
+
+
+def stats():
+    calls = metrics.get("singleflight.calls")
+    avoided = metrics.get("singleflight.avoided_local") + metrics.get(
+        "singleflight.avoided_remote"
+    )
+    return {
+        "calls": calls,
+        "avoided": avoided,
+        "avoided_ratio": round(avoided / (calls + avoided), 3) if calls else 0.0,
+    }
+
+
+metrics.register_provider("singleflight", stats)
@@ -0,0 +1,26 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+
+def with_db_connections(func):
+    # Threads fora do ciclo de requisição do Django (pool do sync_to_async,
+    # pool do gather) não fecham a conexão com o banco sozinhas. Fecha as
+    # vencidas antes e depois, como o Django faz em cada requisição.
+    @wraps(func)
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return run
+
+
+def to_thread(func):
+    # sync_to_async com thread_sensitive=True (o padrão) manda todo o código
+    # síncrono do processo para uma única thread, e o caminho ASGI inteiro fica
+    # em fila atrás dela. Aqui cada chamada vai para o pool de threads.
+    return sync_to_async(with_db_connections(func), thread_sensitive=False)
@@ -6,10 +6,18 @@ from datetime import timedelta
 from typing import Union
 
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
 from dotenv import load_dotenv
-from httpx import Client, get
-
-from webhook.utils.get_objects import get_digisac_contact_by_id, get_message, get_ticket
+from httpx import get
+
+from control.models import refresh_last_message_snapshot
+from webhook.exceptions import DigisacRequestError
+from webhook.utils import (digisac_cache, http, ratelimit, resilience,
+                           singleflight)
+from webhook.utils.dependencies import DependencyTask
+from webhook.utils.get_objects import (get_digisac_contact_by_id, get_message,
+                                       get_ticket, get_valid_ticket)
 from webhook.utils.logger import Logger
 
 load_dotenv()
@@ -25,58 +33,160 @@ class request_methods(enum.Enum):
     post = "post"
 
 
-def get_digisac_ticket(ticket_id):
-    response = any_digisac_request(f"/tickets/{ticket_id}", method="get", json=False)
+##-- Digisac requests
+def get_digisac_header():
+    return {
+        "Authorization": f"Bearer {os.environ.get('TOKEN_DIGISAC_API', os.getenv('TOKEN_DIGISAC_API'))}",
+        "Content-Type": "application/json",
+    }
 
-    if response.status_code == 200:
-        response_dict = {}
-        ticket = response_dict.json()
 
-        response_dict["ticket_id"] = ticket_id
-        response_dict["period"] = get_current_period(dtObject=True)
-        response_dict["contact_id"] = ticket["contactId"]
-        response_dict["last_message_id"] = ticket["lastMessageId"]
+def get_digisac_client():
+    # Cliente keep-alive compartilhado pelo processo (ver webhook/utils/http.py)
+    return http.get_client(
+        "digisac",
+        base_url=os.environ.get("DIGISAC_API_URL", os.getenv("DIGISAC_API_URL")),
+        headers=get_digisac_header(),
+    )
+
+
+def get_async_digisac_client():
+    # Usar com "async with" dentro de um único event loop
+    return http.build_async_client(
+        "digisac",
+        base_url=os.environ.get("DIGISAC_API_URL", os.getenv("DIGISAC_API_URL")),
+        headers=get_digisac_header(),
+    )
 
 
-##-- Digisac requests
 def any_digisac_request(
     url, body=None, method: Union[request_methods, str] = request_methods.get, json=True
 ):
-    header = {
-        "Authorization": f"Bearer {os.environ.get('TOKEN_DIGISAC_API', os.getenv('TOKEN_DIGISAC_API'))}",
-        "Content-Type": "application/json",
-    }
+    client = get_digisac_client()
+    method = getattr(method, "value", method)
+
+    if method == "get":
+        get_response: get = send_digisac_request(client, "get", url)
+        return get_response.json() if json else get_response
+    if method == "post":
+        response = send_digisac_request(client, "post", url, body)
+        if response.status_code == 200:
+            return response.json() if json else response
+        else:
+            raise get_digisac_error(response)
 
-    with Client(
-        base_url=os.environ.get("DIGISAC_API_URL", os.getenv("DIGISAC_API_URL")),
-        headers=header,
-    ) as client:
-        if method == "get":
-            get_response: get = client.get(url, timeout=6000)
-            return get_response.json() if json else get_response
-        if method == "post":
-            response = client.post(url, json=body, timeout=6000)
-            if response.status_code == 200:
-                return response.json() if json else response
-            else:
-                raise ValueError(f"Something wrong - {response} - {response.json()}")
+
+def send_digisac_request(client, method, url, body=None):
+    # GETs iguais ao mesmo tempo viram uma requisição só
+    if method == "get" and settings.SINGLEFLIGHT_ENABLED:
+        return singleflight.do(
+            f"digisac:{url}", send_digisac_request_now, client, method, url, body
+        )
+
+    return send_digisac_request_now(client, method, url, body)
+
+
+def send_digisac_request_now(client, method, url, body=None):
+    # Passa pelo rate limit do endpoint e repete 429 (e 5xx nos GETs) respeitando o
+    # Retry-After. Se o Retry-After passar de DIGISAC_BACKOFF_MAX, desiste e
+    # devolve a resposta.
+    name = ratelimit.endpoint_name(method, url)
+
+    for attempt in range(settings.DIGISAC_MAX_RETRIES + 1):
+        ratelimit.acquire(name)
+        # 429/5xx são repetidos aqui pelo rate limit, o breaker só conta as falhas
+        response = resilience.call(
+            "digisac",
+            client.request,
+            method.upper(),
+            url,
+            json=body,
+            retry_statuses=(),
+            idempotent=method.upper() in ratelimit.IDEMPOTENT_METHODS,
+        )
+        if not ratelimit.is_throttled(response, method):
+            return response
+
+        ratelimit.record_throttled(name)
+        delay = ratelimit.get_retry_delay(response, attempt)
+        ratelimit.pause(name, delay)
+        if delay > settings.DIGISAC_BACKOFF_MAX:
+            break
+
+    return response
+
+
+async def async_send_digisac_request(client, method, url, body=None):
+    name = ratelimit.endpoint_name(method, url)
+
+    for attempt in range(settings.DIGISAC_MAX_RETRIES + 1):
+        await ratelimit.aacquire(name)
+        response = await resilience.acall(
+            "digisac",
+            client.request,
+            method.upper(),
+            url,
+            json=body,
+            retry_statuses=(),
+            idempotent=method.upper() in ratelimit.IDEMPOTENT_METHODS,
+        )
+        if not ratelimit.is_throttled(response, method):
+            return response
+
+        ratelimit.record_throttled(name)
+        delay = ratelimit.get_retry_delay(response, attempt)
+        ratelimit.pause(name, delay)
+        if delay > settings.DIGISAC_BACKOFF_MAX:
+            break
+
+    return response
+
+
+def get_digisac_error(response) -> DigisacRequestError:
+    try:
+        detail = response.json()
+    except ValueError:
+        detail = response.text
+
+    return DigisacRequestError(
+        f"Something wrong - {response} - {detail}",
+        status_code=response.status_code,
+        retry_after=response.headers.get("Retry-After"),
+    )
+
+
+async def async_digisac_request(
+    url,
+    body=None,
+    method: Union[request_methods, str] = request_methods.get,
+    json=True,
+    client=None,
+):
+    # Mesma interface do any_digisac_request. Passe o client quando for fazer
+    # várias chamadas no mesmo loop para reaproveitar as conexões.
+    if client is None:
+        async with get_async_digisac_client() as client:
+            return await async_digisac_request(url, body, method, json, client)
+
+    method = getattr(method, "value", method)
+
+    if method == "get":
+        get_response = await async_send_digisac_request(client, "get", url)
+        return get_response.json() if json else get_response
+    if method == "post":
+        response = await async_send_digisac_request(client, "post", url, body)
+        if response.status_code == 200:
+            return response.json() if json else response
+        else:
+            raise get_digisac_error(response)
 
 
 def get_chat_protocol(ticketId):
     try:
-        header = {
-            "Authorization": f"Bearer {os.environ.get('TOKEN_DIGISAC_API', os.getenv('TOKEN_DIGISAC_API'))}",
-            "Content-Type": "application/json",
-        }
-
-        with Client(
-            base_url=os.environ.get("DIGISAC_API_URL", os.getenv("DIGISAC_API_URL"))
-        ) as client:
-            response = client.get(f"/tickets/{ticketId}", headers=header)
-
-            if response.status_code == 200:
-                data = response.json()
-                return data["protocol"]
+        ticket = digisac_cache.fetch_ticket(ticketId)
+
+        if ticket:
+            return ticket["protocol"]
     except Exception as e:
         logger.error(f"Exception occurred: \n{e}")
 
@@ -138,19 +248,24 @@ def get_event_status(event, message_id: str = None, ticket_id: str = None):
         return message.status if message else 0
 
 
+@shared_task(name="update_ticket_last_message", base=DependencyTask)
 def update_ticket_last_message(ticket_id: str):
-    response = any_digisac_request(f"/tickets/{ticket_id}", method="get", json=False)
+    # Sem cache: logo depois de um message.created o lastMessageId em cache
+    # ainda é o da mensagem anterior
+    digisac_ticket = digisac_cache.fetch_ticket(ticket_id, fresh=True)
 
-    if response.status_code == 200:
+    if digisac_ticket:
+        # Se o ticket.created ainda não foi processado a task é reagendada
+        ticket = get_valid_ticket(ticket_id=ticket_id)
         try:
-            digisac_ticket = response.json()
             last_message_id = digisac_ticket.get("lastMessageId")
             is_open = digisac_ticket.get("isOpen")
 
-            ticket = get_ticket(ticket_id=ticket_id)
             ticket.last_message_id = last_message_id
             ticket.is_open = is_open
-            ticket.save()
+            with transaction.atomic():
+                ticket.save()
+                refresh_last_message_snapshot(ticket_id, last_message_id)
 
             return "Show Papai. Atualizado!!"
         except Exception as e:
@@ -160,14 +275,20 @@ def update_ticket_last_message(ticket_id: str):
 
 
 def message_exists_in_digisac(message_id):
-    message = any_digisac_request(f"/messages/{message_id}", method="get", json=True)
+    message = digisac_cache.fetch_message(message_id)
 
-    if message["sent"]:
+    if message and message.get("sent"):
         return True
     else:
         return False
 
 
+def get_message_ack(data):
+    # Recebe o "data" do evento message.updated/created da digisac
+    ack = (data.get("data") or {}).get("ack")
+    return ack[0] if isinstance(ack, (list, tuple)) else ack
+
+
 def message_is_already_saved(message_id) -> bool:
     # Esse método retorna None se não encontrar o objeto, logo num if qualquer resposta
     # não deverá ter problema
@@ -5,13 +5,17 @@ import random
 import sys
 import traceback
 
+from django.conf import settings
 from django.http.request import HttpRequest
 from django.http.response import JsonResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
-from messages_api import event
+from messages_api import event, journal
+from webhook.utils import metrics
+from webhook.utils.capture import capture, capture_many
 from webhook.utils.logger import Logger
+from webhook.utils.threads import to_thread
 
 logger = Logger(__name__)
 
@@ -19,9 +23,14 @@ logger = Logger(__name__)
 @api_view(["POST"])
 def webhook_receiver(request: HttpRequest):
     data = json.loads(request.body) if request.body else {}
+    capture(data)
     # try:
     # event.manage.apply_async(args=[data])
-    event.manage(data)
+    if settings.WEBHOOK_INGESTION_MODE == "journal":
+        # Grava no journal, publica no celery e responde sem esperar o processamento
+        journal.ingest(data)
+    else:
+        event.manage(data)
 
     # except Exception as e:
     #     exc_type, exc_obj, exc_tb = sys.exc_info()
@@ -46,3 +55,94 @@ def webhook_receiver(request: HttpRequest):
         {"code": "201", "message": "Webhook received a request", "data": [data]},
         status=201,
     )
+
+
+async def async_webhook_receiver(request: HttpRequest):
+    # Versão nativa assíncrona do webhook_receiver para rodar sob ASGI
+    # (gunicorn_asgi.conf.py). Não usa o api_view do DRF porque ele é só síncrono.
+    if request.method != "POST":
+        return JsonResponse(
+            {"detail": f'Method "{request.method}" not allowed.'}, status=405
+        )
+
+    try:
+        data = json.loads(request.body) if request.body else {}
+    except ValueError as e:
+        return JsonResponse({"error": "Bad Request", "message": str(e)}, status=400)
+
+    if settings.WEBHOOK_CAPTURE_FILE:
+        await to_thread(capture)(data)
+
+    if settings.WEBHOOK_INGESTION_MODE == "journal":
+        await journal.aingest(data)
+    else:
+        await event.amanage(data)
+
+    return JsonResponse(
+        {"code": "201", "message": "Webhook received a request", "data": [data]},
+        status=201,
+    )
+
+
+# O csrf_exempt do django 4.2 transforma a view em síncrona, então marca direto
+async_webhook_receiver.csrf_exempt = True
+
+
+def parse_batch_body(body: bytes):
+    # Aceita um array JSON ou NDJSON (um evento por linha). Linhas que não são
+    # JSON válido viram None para serem recusadas na validação.
+    text = body.decode("utf-8").strip() if body else ""
+
+    if text.startswith("["):
+        return json.loads(text)
+
+    items = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+@api_view(["POST"])
+def webhook_batch_receiver(request: HttpRequest):
+    try:
+        items = parse_batch_body(request.body)
+    except ValueError as e:
+        return Response({"error": "Bad Request", "message": str(e)}, status=400)
+
+    capture_many(items)
+
+    results = []
+    accepted = []
+    for index, data in enumerate(items):
+        reason = event.validate(data)
+        if reason:
+            results.append({"index": index, "status": "rejected", "reason": reason})
+        else:
+            results.append({"index": index, "status": "accepted"})
+            accepted.append(data)
+
+    # Um INSERT no journal e uma publicação por tipo de evento
+    journal.ingest_many(accepted)
+
+    return Response(
+        {
+            "code": "201",
+            "message": "Webhook received a batch",
+            "accepted": len(accepted),
+            "rejected": len(items) - len(accepted),
+            "items": results,
+        },
+        status=201,
+    )
+
+
+@api_view(["GET"])
+def metrics_view(request: HttpRequest):
+    # ?reset=1 zera os contadores depois de ler (leitura por período)
+    reset = request.query_params.get("reset") in ("1", "true")
+    return Response(metrics.snapshot(reset=reset), status=200)